@@ -0,0 +1,465 @@
+"""
+End-to-end benchmarks of the ticket system against a fake llm provider.
+
+Usage: python -m benchmarks.run [--scenarios ingest,latency,stream,brownout,list,list_fields,
+                                             search,export,process,startup]
+                                [--rows 10000] [--concurrency 50] [--output bench.json]
+
+The benchmarks run on a fresh sqlite database in a temporary directory and a redis
+database(redis://localhost:6379/15 by default) whose queue is emptied first.
+Results are written as json so that runs can be compared for regressions.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+from datetime import datetime, timedelta
+
+WORKDIR = tempfile.mkdtemp(prefix="ticket-bench-")
+# settings are read at import time, so the environment is set before importing src
+os.environ.setdefault("DATABASE_URL", f"sqlite:///{WORKDIR}/bench.db")
+os.environ.setdefault("REDIS_URL", "redis://localhost:6379/15")
+os.environ.setdefault("ANTHROPIC_API_KEY", "fake")
+os.environ.setdefault("OPENAI_API_KEY", "fake")
+os.environ.setdefault("FAKE_LLM", "true")
+os.environ.setdefault("LLM_CACHE_ENABLED", "false")
+os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+os.environ.setdefault("LOCAL_CLASSIFIER_PATH", "")
+os.environ.setdefault("GROUP_COMMIT_ENABLED", "true")
+
+import httpx  # noqa: E402
+import orjson  # noqa: E402
+from sqlalchemy import delete, func, select  # noqa: E402
+
+from src.api.v1.ticket_api import LIST_FIELDS, SUMMARY_FIELDS  # noqa: E402
+from src.core.ai import categorize_prioritize_ticket, get_llm, provider_router  # noqa: E402
+from src.core.async_worker import AsyncWorker  # noqa: E402
+from src.core.broker import queue, response_queues  # noqa: E402
+from src.core.config import settings  # noqa: E402
+from src.core.response_stream import read_response_stream  # noqa: E402
+from src.core.worker import claim_and_process_tickets, respond_ticket  # noqa: E402
+from src.main import app  # noqa: E402
+from src.models.database import AsyncSessionLocal, SessionLocal  # noqa: E402
+from src.models.schemas import PaginatedTickets, TicketCategory, TicketPriority  # noqa: E402
+from src.models.schemas import TicketStatus  # noqa: E402
+from src.models.ticket import Ticket, filter_ticket_async, filter_ticket_rows_async  # noqa: E402
+from src.models.ticket import save_tickets  # noqa: E402
+
+
+def percentiles(samples: list) -> dict:
+    if not samples:
+        return {}
+    samples = sorted(samples)
+
+    def at(p):
+        return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+    return {"count": len(samples),
+            "mean": statistics.fmean(samples),
+            "p50": at(50),
+            "p95": at(95),
+            "p99": at(99),
+            "max": samples[-1]}
+
+
+def ticket_payload(i: int) -> dict:
+    return {"subject": f"Ticket {i}",
+            "body": f"I can't access my account, attempt {i}. " * random.randint(1, 20),
+            "customer_email": "bench@example.com"}
+
+
+def reset():
+    with SessionLocal() as db:
+        db.execute(delete(Ticket))
+        db.commit()
+    for rq_queue in (queue, *response_queues.values()):
+        rq_queue.empty()
+
+
+def seed(rows: int, status: TicketStatus = None, chunk: int = 10000):
+    """Insert rows tickets with random status, category and priority."""
+    start = datetime.utcnow() - timedelta(days=365)
+    with SessionLocal() as db:
+        for offset in range(0, rows, chunk):
+            save_tickets(db, [dict(id=uuid.uuid4(),
+                                   subject=f"Ticket {i}",
+                                   body=ticket_payload(i)["body"],
+                                   customer_email="bench@example.com",
+                                   status=status or random.choice(list(TicketStatus)),
+                                   category=random.choice(list(TicketCategory)),
+                                   priority=random.choice(list(TicketPriority)),
+                                   created_at=start + timedelta(seconds=i))
+                              for i in range(offset, min(rows, offset + chunk))])
+
+
+def client() -> httpx.AsyncClient:
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://bench")
+
+
+async def timed(coro) -> float:
+    start = time.perf_counter()
+    response = await coro
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+async def bench_ingest(rows: int, concurrency: int = 50) -> dict:
+    """Throughput of single ticket creation and of NDJSON bulk creation."""
+    reset()
+    semaphore = asyncio.Semaphore(concurrency)
+    singles = min(rows, 2000)
+
+    async def create(c, i):
+        async with semaphore:
+            return await timed(c.post("/v1/ticket", json=ticket_payload(i)))
+
+    async with client() as c:
+        start = time.perf_counter()
+        results = await asyncio.gather(*(create(c, i) for i in range(singles)),
+                                       return_exceptions=True)
+        single_elapsed = time.perf_counter() - start
+        latencies = [result for result in results if not isinstance(result, BaseException)]
+
+        body = "\n".join(json.dumps(ticket_payload(i)) for i in range(rows))
+        start = time.perf_counter()
+        await timed(c.post("/v1/tickets/bulk", content=body,
+                           headers={"content-type": "application/x-ndjson"}, timeout=None))
+        bulk_elapsed = time.perf_counter() - start
+    queue.empty()
+    return {"single": {"tickets": singles,
+                       "concurrency": concurrency,
+                       "errors": singles - len(latencies),
+                       "tickets_per_second": len(latencies) / single_elapsed,
+                       "latency_seconds": percentiles(latencies)},
+            "bulk": {"tickets": rows,
+                     "tickets_per_second": rows / bulk_elapsed}}
+
+
+async def bench_latency(tickets: int, concurrency: int = 50) -> dict:
+    """
+    Latency from ticket creation to processed by priority, with an async worker draining
+    the backlog of all tickets created at once.
+    """
+    reset()
+    async with client() as c:
+        payload = "\n".join(json.dumps(ticket_payload(i)) for i in range(tickets))
+        await timed(c.post("/v1/tickets/bulk", content=payload,
+                           headers={"content-type": "application/x-ndjson"}, timeout=None))
+
+    worker = AsyncWorker(concurrency=settings.WORKER_CONCURRENCY)
+    task = asyncio.create_task(worker.run())
+    start = time.perf_counter()
+    while True:
+        await asyncio.sleep(0.2)
+        with SessionLocal() as db:
+            done = db.scalar(select(func.count(Ticket.id))
+                             .where(Ticket.status == TicketStatus.PROCESSED))
+        if done >= tickets or time.perf_counter() - start > 600:
+            break
+    worker.stop()
+    await task
+
+    with SessionLocal() as db:
+        rows = db.execute(select(Ticket.priority, Ticket.created_at, Ticket.processed_at,
+                                 Ticket.input_tokens, Ticket.output_tokens)
+                          .where(Ticket.status == TicketStatus.PROCESSED)).all()
+    latencies = [(row.priority, (row.processed_at - row.created_at).total_seconds())
+                 for row in rows]
+    return {"tickets": tickets,
+            "processed": len(rows),
+            "fake_llm_latency": settings.FAKE_LLM_LATENCY,
+            "tickets_per_second": len(rows) / (time.perf_counter() - start),
+            "latency_seconds": percentiles([latency for _, latency in latencies]),
+            "latency_seconds_by_priority": {
+                priority.value: percentiles([latency for row_priority, latency in latencies
+                                             if row_priority == priority])
+                for priority in TicketPriority},
+            "tokens_per_ticket": {
+                "input": statistics.fmean([row.input_tokens or 0 for row in rows] or [0]),
+                "output": statistics.fmean([row.output_tokens or 0 for row in rows] or [0])}}
+
+
+async def bench_stream(tickets: int, concurrency: int = 50) -> dict:
+    """Time to the first streamed token and to the whole response of classified tickets."""
+    reset()
+    seed(tickets, status=TicketStatus.PROCESSING)
+    with SessionLocal() as db:
+        ticket_ids = db.scalars(select(Ticket.id)).all()
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def respond(ticket_id):
+        async with semaphore:
+            start = time.perf_counter()
+            first_token = None
+            task = asyncio.create_task(respond_ticket(ticket_id))
+            async for event in read_response_stream(ticket_id, block=1, timeout=60):
+                if event is not None and first_token is None:
+                    first_token = time.perf_counter() - start
+                if event is not None and event.event != "token":
+                    break
+            await task
+            return first_token, time.perf_counter() - start
+
+    results = await asyncio.gather(*(respond(ticket_id) for ticket_id in ticket_ids),
+                                   return_exceptions=True)
+    timings = [result for result in results if not isinstance(result, BaseException)]
+    return {"tickets": len(ticket_ids),
+            "errors": len(ticket_ids) - len(timings),
+            "fake_llm_latency": settings.FAKE_LLM_LATENCY,
+            "first_token_seconds": percentiles([first for first, _ in timings]),
+            "response_seconds": percentiles([done for _, done in timings])}
+
+
+async def bench_list(rows: int, concurrency: int = 50, repeat: int = 20) -> dict:
+    """Latency of listing tickets, first page, deep page by offset and by cursor, filtered."""
+    reset()
+    seed(rows)
+    per_page = 50
+    deep_page = max(2, rows // per_page - 1)
+    results = {"rows": rows}
+    async with client() as c:
+        response = await c.get("/v1/tickets", params={"page": deep_page - 1,
+                                                      "per_page": per_page})
+        deep_cursor = response.json()["next_cursor"]
+        cases = {"first_page": {"per_page": per_page},
+                 "deep_page_offset": {"page": deep_page, "per_page": per_page},
+                 "deep_page_cursor": {"cursor": deep_cursor, "per_page": per_page},
+                 "filtered": {"status": TicketStatus.PROCESSED.value,
+                              "priority": TicketPriority.HIGH.value,
+                              "per_page": per_page}}
+        for name, params in cases.items():
+            latencies = [await timed(c.get("/v1/tickets", params=params)) for _ in range(repeat)]
+            results[name] = percentiles(latencies)
+    return results
+
+
+async def bench_list_fields(rows: int, concurrency: int = 50, repeat: int = 50) -> dict:
+    """
+    Latency and payload size of a page of tickets read as orm objects and validated by the
+    response model, against plain rows encoded by orjson with all fields and summary fields,
+    in process and through the api.
+    """
+    reset()
+    seed(rows)
+    per_page = 50
+
+    async def orm_page() -> bytes:
+        async with AsyncSessionLocal() as db:
+            tickets = await filter_ticket_async(db, 1, per_page)
+        return PaginatedTickets(tickets=tickets, total=rows, page=1,
+                                per_page=per_page).model_dump_json().encode()
+
+    async def rows_page(fields: list) -> bytes:
+        async with AsyncSessionLocal() as db:
+            ticket_rows = await filter_ticket_rows_async(db, fields, 1, per_page)
+        return orjson.dumps({"tickets": [dict(zip(fields, row)) for row in ticket_rows],
+                             "total": rows, "page": 1, "per_page": per_page})
+
+    results = {"rows": rows}
+    cases = {"orm_validated": orm_page,
+             "rows_orjson": lambda: rows_page(LIST_FIELDS),
+             "rows_orjson_summary": lambda: rows_page(SUMMARY_FIELDS)}
+    for name, page in cases.items():
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            payload = await page()
+            latencies.append(time.perf_counter() - start)
+        results[name] = {**percentiles(latencies), "payload_kb": len(payload) / 1024}
+    async with client() as c:
+        for name, params in {"api": {}, "api_summary": {"fields": "summary"}}.items():
+            params["per_page"] = per_page
+            latencies = [await timed(c.get("/v1/tickets", params=params)) for _ in range(repeat)]
+            response = await c.get("/v1/tickets", params=params)
+            results[name] = {**percentiles(latencies), "payload_kb": len(response.content) / 1024}
+    return results
+
+
+async def bench_search(rows: int, concurrency: int = 50, repeat: int = 20) -> dict:
+    """Latency of full text search, selective and common words, filtered and next page."""
+    reset()
+    seed(rows)
+    results = {"rows": rows}
+    async with client() as c:
+        response = await c.get("/v1/tickets/search", params={"q": "account"})
+        cursor = response.json()["next_cursor"]
+        cases = {"selective": {"q": f"attempt {rows // 2}"},
+                 "common": {"q": "account"},
+                 "common_filtered": {"q": "account", "status": TicketStatus.PROCESSED.value,
+                                     "priority": TicketPriority.HIGH.value},
+                 "common_next_page": {"q": "account", "cursor": cursor}}
+        for name, params in cases.items():
+            latencies = [await timed(c.get("/v1/tickets/search", params=params))
+                         for _ in range(repeat)]
+            results[name] = percentiles(latencies)
+    return results
+
+
+async def bench_export(rows: int, concurrency: int = 50) -> dict:
+    """Throughput and peak memory of streaming exports in every format."""
+    reset()
+    seed(rows)
+    results = {"rows": rows}
+    async with client() as c:
+        for export_format in ("ndjson", "csv", "parquet"):
+            tracemalloc.start()
+            start = time.perf_counter()
+            size = 0
+            async with c.stream("GET", "/v1/tickets/export",
+                                params={"format": export_format}) as response:
+                if response.status_code != 200:
+                    results[export_format] = {"error": response.status_code}
+                    tracemalloc.stop()
+                    continue
+                async for data in response.aiter_bytes():
+                    size += len(data)
+            elapsed = time.perf_counter() - start
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            results[export_format] = {"seconds": elapsed,
+                                      "rows_per_second": rows / elapsed if elapsed else 0.0,
+                                      "size_mb": size / 1024 / 1024,
+                                      "peak_memory_mb": peak / 1024 / 1024}
+    return results
+
+
+async def bench_process(rows: int, concurrency: int = 50) -> dict:
+    """Time and memory to claim and enqueue a backlog of submitted tickets."""
+    reset()
+    seed(rows, status=TicketStatus.SUBMITTED)
+    async with client() as c:
+        request_seconds = await timed(c.post("/v1/process"))
+    queue.empty()
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    claimed = claim_and_process_tickets()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    queue.empty()
+    return {"rows": rows,
+            "request_seconds": request_seconds,
+            "claimed": claimed,
+            "claim_seconds": elapsed,
+            "tickets_per_second": claimed / elapsed if elapsed else 0.0,
+            "peak_memory_mb": peak / 1024 / 1024}
+
+
+# modules of the llm stack and local classifier the api process must not import
+WORKER_ONLY_MODULES = ("langchain", "langchain_core", "langchain_anthropic", "langchain_openai",
+                       "anthropic", "openai", "sklearn")
+STARTUP_SCRIPT = f"""
+import json, resource, sys, time
+start = time.perf_counter()
+import src.main
+print(json.dumps({{"import_seconds": time.perf_counter() - start,
+                   "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                   "worker_modules": sorted({{name.split(".")[0] for name in sys.modules}}
+                                            & set({WORKER_ONLY_MODULES!r}))}}))
+"""
+
+
+async def bench_startup(rows: int, concurrency: int = 50, repeat: int = 5) -> dict:
+    """Import time and memory of the api app in fresh interpreters."""
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT], check=True,
+                                capture_output=True, text=True).stdout
+        runs.append(json.loads(output.strip().splitlines()[-1]))
+    return {"import_seconds": percentiles([run["import_seconds"] for run in runs]),
+            "max_rss_mb": max(run["max_rss_mb"] for run in runs),
+            "worker_modules": runs[-1]["worker_modules"]}
+
+
+async def bench_brownout(tickets: int, concurrency: int = 50) -> dict:
+    """
+    Classification latency while the anthropic fake llm is ten times slower than usual, with
+    the provider router hedging on openai and without it. Healthy calls go first so that
+    the router learns the usual latency.
+    """
+    anthropic = get_llm("anthropic")
+    latency = anthropic.latency
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def classify(i):
+        async with semaphore:
+            ticket = Ticket(id=uuid.uuid4(), **ticket_payload(i))
+            start = time.perf_counter()
+            await categorize_prioritize_ticket(ticket)
+            return time.perf_counter() - start
+
+    results = {"tickets": tickets, "fake_llm_latency": latency}
+    router_enabled = settings.LLM_ROUTER_ENABLED
+    try:
+        for enabled in (False, True):
+            settings.LLM_ROUTER_ENABLED = enabled
+            provider_router.reset()
+            anthropic.latency = latency
+            await asyncio.gather(*(classify(i) for i in range(settings.LLM_HEDGE_MIN_SAMPLES)))
+            anthropic.latency = latency * 10
+            latencies = await asyncio.gather(*(classify(i) for i in range(tickets)))
+            results["router" if enabled else "no_router"] = percentiles(latencies)
+    finally:
+        settings.LLM_ROUTER_ENABLED = router_enabled
+        anthropic.latency = latency
+    return results
+
+
+SCENARIOS = {
+    "ingest": bench_ingest,
+    "latency": bench_latency,
+    "stream": bench_stream,
+    "brownout": bench_brownout,
+    "list": bench_list,
+    "list_fields": bench_list_fields,
+    "search": bench_search,
+    "export": bench_export,
+    "process": bench_process,
+    "startup": bench_startup,
+}
+
+
+async def run(scenarios: list, rows: int, concurrency: int) -> dict:
+    results = {"started_at": datetime.utcnow().isoformat(),
+               "python": sys.version.split()[0],
+               "database_url": settings.DATABASE_URL,
+               "scenarios": {}}
+    for name in scenarios:
+        print(f"running {name} benchmark...", file=sys.stderr)
+        try:
+            # the llm bound scenarios get fewer tickets than the db bound ones
+            size = min(rows, 2000) if name in ("latency", "stream", "brownout") else rows
+            results["scenarios"][name] = await SCENARIOS[name](size, concurrency)
+        except Exception as e:
+            results["scenarios"][name] = {"error": repr(e)}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run ticket system benchmarks.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--rows", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=50, help="concurrent api clients")
+    parser.add_argument("--output", help="json result file, stdout if not given")
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args.scenarios.split(","), args.rows, args.concurrency))
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output)
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
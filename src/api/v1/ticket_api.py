@@ -1,22 +1,68 @@
+import asyncio
+import json
 import uuid
-from typing import Optional
+from datetime import datetime
+from typing import Any, AsyncIterator, List, Optional, Tuple, Union
 
-from fastapi import APIRouter, Depends, HTTPException, Query
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import ORJSONResponse, StreamingResponse
+from pydantic import ValidationError
+from rq.exceptions import NoSuchJobError
+from rq.job import Job
+from sqlalchemy.ext.asyncio import AsyncSession
+from starlette.concurrency import run_in_threadpool
 
-from src.core.worker import enqueue_tickets, enqueue_ticket
+from src.core.config import settings
+from src.core.export import EXPORT_FORMATS, export_tickets, parquet_available, parse_fields
+from src.core.utils import setup_logger
+from src.core.broker import redis_conn
+from src.core.response_stream import read_response_stream, sse_event
+from src.core.ticket_cache import CachedTicket, cache_ticket, get_cached_ticket_async
+from src.core.ticket_cache import invalidate_tickets
+from src.core.ticket_events import ticket_waiter
+from src.core.jobs import enqueue_claim_tickets, enqueue_ticket, bulk_enqueue_tickets
+from src.core.jobs import enqueue_reconcile_stats
+from src.core.stats import get_stats, record_created, record_transition
 from src.models import schemas, ticket
-from src.models.database import get_db
+from src.models.database import get_async_db
 from src.models.schemas import TicketCreateResponse, PaginatedTickets, TicketProcess
-from src.models.schemas import TicketStatus, TicketCategory, TicketPriority
-from src.models.ticket import save_ticket, get_ticket as query_ticket
-from src.models.ticket import filter_ticket, filter_ticket_status
+from src.models.schemas import TicketProcessStatus
+from src.models.schemas import TicketBulkItem, TicketBulkResponse
+from src.models.schemas import DONE_STATUSES, TicketStatus, TicketCategory, TicketPriority
+from src.models.schemas import SearchTickets, TicketSearchResult, TicketStats
+from src.models.search import search_terms, search_tickets_async, search_truncated_async
+from src.models.search import encode_search_cursor, decode_search_cursor
+from src.models.ticket import save_ticket_async, save_tickets_async, get_ticket_async
+from src.models.ticket import filter_ticket_rows_async, count_ticket_async
+from src.models.ticket import requeue_failed_ticket_async
+from src.models.ticket import encode_cursor, decode_cursor
+from src.models.writer import ticket_writer
 
 router = APIRouter(prefix="/v1")
+logger = setup_logger(__name__)
+
+LIST_FIELDS = list(schemas.Ticket.model_fields)
+SUMMARY_FIELDS = list(schemas.TicketSummary.model_fields)
+
+
+def parse_list_fields(fields: Optional[str]) -> List[str]:
+    """
+    Comma separated ticket fields to list, all of them if empty, or the TicketSummary ones
+    for summary. Raise ValueError on unknown ones.
+    """
+    if not fields:
+        return LIST_FIELDS
+    if fields == "summary":
+        return SUMMARY_FIELDS
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in LIST_FIELDS]
+    if unknown or not names:
+        raise ValueError(f"Unknown fields {unknown}, choose among {LIST_FIELDS} or summary")
+    return names
 
 
 @router.post("/ticket", response_model=TicketCreateResponse, status_code=201)
-def create_ticket(data: schemas.TicketCreate, db: Session = Depends(get_db)):
+async def create_ticket(data: schemas.TicketCreate, db: AsyncSession = Depends(get_async_db)):
     """
     Create a ticket given ticket subject, body and customer email.
 
@@ -34,76 +80,434 @@ def create_ticket(data: schemas.TicketCreate, db: Session = Depends(get_db)):
     Status Code:
     - **201**: Ticket created successfully.
     """
-    db_ticket = ticket.Ticket(
+    row = dict(
         id=uuid.uuid4(),
         subject=data.subject,
         body=data.body,
         customer_email=data.customer_email,
-        status=TicketStatus.SUBMITTED
+        status=TicketStatus.SUBMITTED,
+        created_at=datetime.utcnow()
     )
-    save_ticket(db, db_ticket)
-    enqueue_ticket(db_ticket.id)
-    return TicketCreateResponse(ticket_id=db_ticket.id,
+    if settings.GROUP_COMMIT_ENABLED:
+        await ticket_writer.save(row)
+    else:
+        await save_ticket_async(db, ticket.Ticket(**row))
+    # rq talks to redis synchronously, keep it off the event loop
+    await run_in_threadpool(enqueue_ticket, row["id"])
+    await run_in_threadpool(record_created, 1, row["created_at"])
+    return TicketCreateResponse(ticket_id=row["id"],
                                 status=TicketStatus.SUBMITTED.value,
                                 message="Ticket submitted successfully and queued for processing")
 
 
-@router.get("/ticket/{ticket_id}", response_model=schemas.Ticket)
-def get_ticket(ticket_id: uuid.UUID, db: Session = Depends(get_db)):
+async def _read_bulk(request: Request) -> AsyncIterator[Union[bytes, Any]]:
+    """
+    Yield ticket items from a json array or a streamed NDJSON request body,
+    NDJSON lines are yielded as raw bytes to be validated one by one.
+    """
+    if request.headers.get("content-type", "").startswith("application/x-ndjson"):
+        buffer = b""
+        async for data in request.stream():
+            *lines, buffer = (buffer + data).split(b"\n")
+            for line in lines:
+                if line.strip():
+                    yield line
+        if buffer.strip():
+            yield buffer
+        return
+
+    try:
+        items = json.loads(await request.body())
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body is not valid json")
+    if not isinstance(items, list):
+        raise HTTPException(status_code=400, detail="Request body must be a json array")
+    for item in items:
+        yield item
+
+
+async def _save_and_enqueue(db: AsyncSession,
+                            chunk: List[Tuple[int, schemas.TicketCreate]]) -> List[TicketBulkItem]:
+    now = datetime.utcnow()
+    rows = [dict(id=uuid.uuid4(),
+                 subject=data.subject,
+                 body=data.body,
+                 customer_email=data.customer_email,
+                 status=TicketStatus.SUBMITTED,
+                 created_at=now) for _, data in chunk]
+    try:
+        await save_tickets_async(db, rows)
+    except Exception as e:
+        await db.rollback()
+        logger.error(f"Save chunk of {len(rows)} tickets failed: {e}")
+        return [TicketBulkItem(index=index, error="Failed to save ticket") for index, _ in chunk]
+    await run_in_threadpool(record_created, len(rows), now)
+
+    error = None
+    try:
+        await run_in_threadpool(bulk_enqueue_tickets, [row["id"] for row in rows])
+    except Exception as e:
+        # tickets stay submitted and can be picked up again by /v1/process
+        logger.error(f"Enqueue chunk of {len(rows)} tickets failed: {e}")
+        error = "Ticket saved but not queued for processing"
+    return [TicketBulkItem(index=index, ticket_id=row["id"], error=error)
+            for (index, _), row in zip(chunk, rows)]
+
+
+@router.post("/tickets/bulk", response_model=TicketBulkResponse, status_code=201)
+async def create_tickets(request: Request, db: AsyncSession = Depends(get_async_db)):
+    """
+    Create tickets in bulk from a json array or a NDJSON stream(content type application/x-ndjson).
+    Tickets are inserted and queued for processing in chunks.
+
+    Parameters:
+    - **request body**: Tickets with the same fields as a single ticket creation.
+
+    Returns:
+    - **created**: Number of tickets created.
+    - **failed**: Number of tickets failed to be created or queued.
+    - **items**: Per ticket result in request order, with its ticket_id or error.
+    """
+    items, chunk = [], []
+    index = 0
+    async for raw in _read_bulk(request):
+        try:
+            if isinstance(raw, bytes):
+                data = schemas.TicketCreate.model_validate_json(raw)
+            else:
+                data = schemas.TicketCreate.model_validate(raw)
+            chunk.append((index, data))
+        except ValidationError as e:
+            items.append(TicketBulkItem(index=index, error=str(e)))
+        index += 1
+        if len(chunk) >= settings.BULK_CHUNK_SIZE:
+            items.extend(await _save_and_enqueue(db, chunk))
+            chunk = []
+    if chunk:
+        items.extend(await _save_and_enqueue(db, chunk))
+
+    items.sort(key=lambda item: item.index)
+    failed = sum(1 for item in items if item.error)
+    return TicketBulkResponse(created=sum(1 for item in items if item.ticket_id),
+                              failed=failed,
+                              items=items)
+
+
+def _not_modified(request: Request, cached: CachedTicket) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etags = [etag.strip().removeprefix("W/") for etag in if_none_match.split(",")]
+        return "*" in etags or cached.etag in etags
+    # status changes before processing don't move the last modified time,
+    # so the date is only a valid validator once the ticket is processed
+    return cached.final and request.headers.get("if-modified-since") == cached.last_modified
+
+
+@router.get("/ticket/{ticket_id}", response_model=schemas.Ticket,
+            responses={304: {"description": "Ticket not modified since the given validators"}})
+async def get_ticket(ticket_id: uuid.UUID, request: Request,
+                     db: AsyncSession = Depends(get_async_db),
+                     wait: float = Query(0, ge=0, le=settings.TICKET_WAIT_MAX)):
     """
     Query ticket by ticket id.
+    Tickets are served from cache with ETag and Last-Modified headers, pass them back by
+    If-None-Match or If-Modified-Since to get a 304 response while the ticket is unchanged.
 
     Parameters:
     - **ticket_id**: The ticket id(uuid).
+    - **wait**: Seconds to wait for the ticket to be done(processed or failed) instead of
+      polling, it's returned as soon as it's done, or as it is once the time is up.
 
     Returns:
     - All fields of the ticket.
     """
-    db_ticket = query_ticket(db, ticket_id)
+    cached = await get_cached_ticket_async(ticket_id)
+    if cached is None:
+        db_ticket = await get_ticket_async(db, ticket_id)
+        if db_ticket is None:
+            raise HTTPException(status_code=404, detail="Ticket %s not found" % ticket_id)
+        cached = await run_in_threadpool(cache_ticket, db_ticket, nx=True)
+    if wait and not cached.done:
+        try:
+            cached = await asyncio.wait_for(_wait_done(ticket_id, db), wait)
+        except asyncio.TimeoutError:
+            pass
+
+    headers = {"ETag": cached.etag, "Last-Modified": cached.last_modified,
+               "Cache-Control": "no-cache"}
+    if _not_modified(request, cached):
+        return Response(status_code=304, headers=headers)
+    return Response(cached.body, media_type="application/json", headers=headers)
+
+
+async def _wait_done(ticket_id: uuid.UUID, db: AsyncSession) -> CachedTicket:
+    async with ticket_waiter.waiting(ticket_id) as done:
+        # read again once subscribed, the ticket may be done since it was cached or read
+        await db.close()
+        db_ticket = await get_ticket_async(db, ticket_id)
+        # no db connection is held while waiting
+        await db.close()
+        if db_ticket is None or db_ticket.status not in DONE_STATUSES:
+            return await done
+        return await run_in_threadpool(cache_ticket, db_ticket, nx=True)
+
+
+@router.get("/ticket/{ticket_id}/response/stream", response_class=StreamingResponse,
+            responses={200: {"content": {"text/event-stream": {}}}})
+async def stream_ticket_response(ticket_id: uuid.UUID, request: Request,
+                                 db: AsyncSession = Depends(get_async_db)):
+    """
+    Stream the initial response of a ticket as server-sent events while it is generated.
+
+    Events, with json encoded data:
+    - **token**: The next part of the response.
+    - **done**: The whole response, sent once it is saved, the stream ends.
+    - **error**: Generating the response failed, the stream ends.
+
+    Processed tickets get their response as a single done event, failed tickets an error
+    event. Reconnecting clients pass the id of the last event they got by the Last-Event-ID
+    header.
+    """
+    db_ticket = await get_ticket_async(db, ticket_id)
     if db_ticket is None:
         raise HTTPException(status_code=404, detail="Ticket %s not found" % ticket_id)
-    return db_ticket
+    status = db_ticket.status
+    response = db_ticket.initial_response or ""
+    error = f"Processing failed: {db_ticket.last_error}"
+    last_event_id = request.headers.get("last-event-id")
+
+    async def events() -> AsyncIterator[str]:
+        if status == TicketStatus.PROCESSED:
+            yield sse_event("done", response)
+            return
+        if status == TicketStatus.FAILED:
+            yield sse_event("error", error)
+            return
+        async for event in read_response_stream(ticket_id, last_event_id,
+                                                timeout=settings.RESPONSE_STREAM_TIMEOUT):
+            # comments keep idle connections open through proxies
+            yield sse_event(event.event, event.data, event.id) if event else ": keep-alive\n\n"
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@router.post("/ticket/{ticket_id}/retry", response_model=TicketCreateResponse)
+async def retry_ticket(ticket_id: uuid.UUID, db: AsyncSession = Depends(get_async_db)):
+    """
+    Queue a failed ticket for processing again, with a fresh set of attempts.
+    Tickets fail once their processing failed TICKET_MAX_ATTEMPTS times, their last error
+    is kept in last_error.
+
+    Status Code:
+    - **404**: Ticket not found.
+    - **409**: Ticket is not failed, it's processed or still being retried.
+    """
+    if not await requeue_failed_ticket_async(db, ticket_id):
+        if await get_ticket_async(db, ticket_id) is None:
+            raise HTTPException(status_code=404, detail="Ticket %s not found" % ticket_id)
+        raise HTTPException(status_code=409, detail="Ticket %s is not failed" % ticket_id)
+    await run_in_threadpool(invalidate_tickets, [ticket_id])
+    await run_in_threadpool(record_transition, TicketStatus.FAILED, TicketStatus.SUBMITTED)
+    await run_in_threadpool(enqueue_ticket, ticket_id)
+    return TicketCreateResponse(ticket_id=ticket_id,
+                                status=TicketStatus.SUBMITTED.value,
+                                message="Ticket queued for processing again")
 
 
 @router.get("/tickets", response_model=PaginatedTickets)
-def get_tickets(status: Optional[TicketStatus] = None,
-                category: Optional[TicketCategory] = None,
-                priority: Optional[TicketPriority] = None,
-                db: Session = Depends(get_db),
-                page: int = Query(1, ge=1),  # Default page is 1, must be >= 1
-                per_page: int = Query(50, gt=0, le=50)  # Default per_page is 50, max is 50
-                ):
+async def get_tickets(status: Optional[TicketStatus] = None,
+                      category: Optional[TicketCategory] = None,
+                      priority: Optional[TicketPriority] = None,
+                      db: AsyncSession = Depends(get_async_db),
+                      page: int = Query(1, ge=1),  # Default page is 1, must be >= 1
+                      per_page: int = Query(50, gt=0, le=50),  # Default per_page is 50, max is 50
+                      cursor: Optional[str] = None,
+                      fields: Optional[str] = None,
+                      include_archived: bool = False
+                      ):
     """
     Filter tickets by status, category, and priority with pagination support.
+    Tickets are ordered by creation time. Only the listed columns are read and the rows
+    are serialized as they are, without building orm objects or validating each ticket.
 
     Parameters:
     - **status**: Filter by ticket status (submitted, processing, processed).
     - **category**: Filter by ticket category(Account Access, Feature Request, Unknown).
     - **priority**: Filter by ticket priority(Low, High).
-    - **page**: Page number for pagination (default is 1).
+    - **page**: Page number for pagination (default is 1), ignored if cursor is given.
     - **per_page**: Number of items per page for pagination (default is 50, max is 50).
+    - **cursor**: The next_cursor of the previous page, preferred over page for deep pages.
+    - **fields**: Comma separated ticket fields to list(e.g. id,subject,status), or summary for
+      the TicketSummary fields, all of them by default.
+    - **include_archived**: List the archived tickets too, old processed tickets are moved to
+      the archive.
 
     Returns:
-    - **total**: Total number of tickets.
+    - **total**: Total number of tickets matching the filters.
     - **page**: Current page number.
     - **per_page**: Number of tickets per page.
-    - **tickets**: List of tickets.
+    - **next_cursor**: Cursor of the next page, null if this is the last page.
+    - **tickets**: List of tickets, with the given fields only.
+    """
+    try:
+        after = decode_cursor(cursor) if cursor else None
+        names = parse_list_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    # the cursor is made of the created_at and id of the last ticket
+    columns = names + [name for name in ("created_at", "id") if name not in names]
+    rows = await filter_ticket_rows_async(db, columns, page, per_page, status, category,
+                                          priority, after, include_archived)
+    next_cursor = encode_cursor(rows[-1]) if len(rows) == per_page else None
+    total = await count_ticket_async(db, status, category, priority, include_archived)
+    return ORJSONResponse({"tickets": [dict(zip(names, row)) for row in rows],
+                           "total": total,
+                           "page": page,
+                           "per_page": per_page,
+                           "next_cursor": next_cursor})
+
+
+@router.get("/tickets/search", response_model=SearchTickets)
+async def search(q: str = Query(..., min_length=1, max_length=200),
+                 status: Optional[TicketStatus] = None,
+                 category: Optional[TicketCategory] = None,
+                 priority: Optional[TicketPriority] = None,
+                 db: AsyncSession = Depends(get_async_db),
+                 per_page: int = Query(50, gt=0, le=50),
+                 cursor: Optional[str] = None
+                 ):
+    """
+    Full text search of tickets by the words of their subject, body and initial response,
+    optionally filtered by status, category and priority. Best matches come first.
+
+    Parameters:
+    - **q**: Search words, tickets must contain all of them(stemmed, case insensitive).
+    - **status**, **category**, **priority**: Same filters as listing tickets.
+    - **per_page**: Number of results per page(default is 50, max is 50).
+    - **cursor**: The next_cursor of the previous page.
+
+    Returns:
+    - **tickets**: Matching tickets with their relevance score.
+    - **per_page**: Number of results per page.
+    - **next_cursor**: Cursor of the next page, null if this is the last page.
+    - **truncated**: True if more tickets match than ranked. On sqlite only the
+      SEARCH_MAX_CANDIDATES most recent matches are ranked, older ones are left out of every
+      page, narrow the search with more words or filters to reach them.
+    """
+    if not search_terms(q):
+        raise HTTPException(status_code=400, detail="Search query has no words")
+    try:
+        after = decode_search_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+    results = await search_tickets_async(db, q, per_page, status, category, priority, after)
+    truncated = await search_truncated_async(db, q, status, category, priority)
+    next_cursor = None
+    if len(results) == per_page:
+        last_ticket, last_score = results[-1]
+        next_cursor = encode_search_cursor(last_score, last_ticket.id)
+    tickets = [TicketSearchResult(**schemas.Ticket.model_validate(db_ticket).model_dump(),
+                                  score=score) for db_ticket, score in results]
+    return SearchTickets(tickets=tickets,
+                         per_page=per_page,
+                         next_cursor=next_cursor,
+                         truncated=truncated)
+
+
+@router.get("/tickets/export", response_class=StreamingResponse,
+            responses={200: {"content": {media: {} for media in EXPORT_FORMATS.values()}}})
+async def export(export_format: str = Query("ndjson", alias="format",
+                                            pattern="^(ndjson|csv|parquet)$"),
+                 status: Optional[TicketStatus] = None,
+                 category: Optional[TicketCategory] = None,
+                 priority: Optional[TicketPriority] = None,
+                 created_from: Optional[datetime] = None,
+                 created_to: Optional[datetime] = None,
+                 fields: Optional[str] = None):
+    """
+    Stream all tickets matching the filters, ordered by creation time, in constant memory.
+
+    Parameters:
+    - **format**: ndjson(default), csv or parquet(one row group per chunk of tickets).
+    - **status**, **category**, **priority**: Same filters as listing tickets.
+    - **created_from**, **created_to**: Tickets created in [created_from, created_to).
+    - **fields**: Comma separated ticket fields to export, all of them by default.
     """
-    tickets = filter_ticket(db, page, per_page, status, category, priority)
-    return PaginatedTickets(tickets=tickets,
-                            total=len(tickets),
-                            page=page,
-                            per_page=per_page)
+    try:
+        names = parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    if export_format == "parquet" and not parquet_available():
+        raise HTTPException(status_code=501, detail="Parquet export is not installed")
+
+    # a sync generator, starlette iterates it in the threadpool off the event loop
+    chunks = export_tickets(export_format, names, status, category, priority,
+                            created_from, created_to, settings.EXPORT_CHUNK_SIZE)
+    return StreamingResponse(chunks, media_type=EXPORT_FORMATS[export_format],
+                             headers={"Content-Disposition":
+                                      f'attachment; filename="tickets.{export_format}"'})
+
+
+@router.get("/tickets/stats", response_model=TicketStats)
+async def get_ticket_stats():
+    """
+    Ticket statistics, read from counters updated as tickets are created and processed.
+
+    Returns:
+    - **total**: Number of tickets.
+    - **by_status**, **by_category**, **by_priority**: Number of tickets per value.
+    - **processing_seconds**: Count, mean and p50/p95/p99 of the creation to processed latency,
+      percentiles are estimated from a histogram.
+    - **per_minute**, **per_hour**: Tickets created and processed in each of the last 60 minutes
+      and 24 hours, oldest first.
+    """
+    return await run_in_threadpool(get_stats)
+
+
+@router.post("/tickets/stats/reconcile", response_model=TicketProcess)
+async def reconcile_ticket_stats():
+    """
+    Rebuild the ticket statistics from the tickets table in a background job,
+    its progress could be queried by the returned job id at /v1/process/{job_id}.
+    """
+    job = await run_in_threadpool(enqueue_reconcile_stats)
+    return TicketProcess(message="Stats reconciliation started", job_id=job.id)
 
 
 @router.post("/process", response_model=TicketProcess)
-def process_tickets(db: Session = Depends(get_db)):
-    """Manually trigger process of all unprocessed tickets"""
-    unprocessed_tickets = filter_ticket_status(db, TicketStatus.SUBMITTED)
-    if not unprocessed_tickets:
+async def process_tickets(db: AsyncSession = Depends(get_async_db)):
+    """
+    Manually trigger process of all unprocessed tickets.
+    A background job claims submitted tickets chunk by chunk and queues them for processing,
+    its progress could be queried by the returned job id.
+    """
+    unprocessed = await count_ticket_async(db, status=TicketStatus.SUBMITTED)
+    if not unprocessed:
         raise HTTPException(status_code=404, detail="No tickets remain to be processed")
 
-    tickets = [ticket.id for ticket in unprocessed_tickets]
-    job = enqueue_tickets(tickets)
-    return TicketProcess(message=f"Processing started for {len(unprocessed_tickets)} tickets",
+    job = await run_in_threadpool(enqueue_claim_tickets)
+    return TicketProcess(message=f"Processing started for {unprocessed} tickets",
                          job_id=job.id)
+
+
+@router.get("/process/{job_id}", response_model=TicketProcessStatus)
+async def get_process_status(job_id: uuid.UUID):
+    """
+    Query progress of a process job.
+
+    Returns:
+    - **job_id**: The process job id.
+    - **status**: Job status(queued, started, finished, failed).
+    - **claimed**: Number of tickets claimed and queued for processing so far.
+    """
+    try:
+        job = await run_in_threadpool(Job.fetch, str(job_id), connection=redis_conn)
+    except NoSuchJobError:
+        raise HTTPException(status_code=404, detail="Job %s not found" % job_id)
+    status = job.get_status()
+    return TicketProcessStatus(job_id=job.id,
+                               status=status.value if status else "unknown",
+                               claimed=job.meta.get("claimed", 0))
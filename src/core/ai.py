@@ -1,87 +1,532 @@
+import asyncio
+import json
+import time
+from functools import lru_cache
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterator, List, Optional, Set
+from typing import Tuple, TypeVar
+from uuid import UUID
+
 from langchain.output_parsers import PydanticOutputParser
-from langchain.prompts import PromptTemplate
-from langchain_anthropic import ChatAnthropic
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.exceptions import OutputParserException
+from langchain_core.outputs import LLMResult
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import SystemMessage
 from langchain_core.output_parsers import StrOutputParser
-from langchain_openai import ChatOpenAI
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_core.runnables import Runnable
 
+from src.core.broker import redis_conn
+from src.core.cache import LLMCache
+from src.core.classifier import classify_locally
 from src.core.config import settings
+from src.core.fake_llm import FakeChatModel
+from src.core.metrics import LLM_ERRORS, LLM_FIRST_TOKEN_SECONDS, LLM_REQUEST_SECONDS, LLM_TOKENS
+from src.core.prompt_budget import fit_body
+from src.core.ratelimit import RateLimiter, estimate_tokens
+from src.core.response_stream import stream_response
+from src.core.router import ProviderRouter
 from src.core.utils import enum2csv, setup_logger
-from src.models.schemas import TicketClassified, TicketCategory, TicketPriority
+from src.models.schemas import TicketClassified, TicketCategory, TicketPriority, TicketsClassified
 from src.models.ticket import Ticket
 
 logger = setup_logger(__name__)
 
-classify_prompt = PromptTemplate(
-    input_variables=["ticket_subject", "ticket_body", "categories", "priorities"],
-    template="""
-    Analyze the following ticket and categorize it into one of these categories: {categories}
-    Also, assign a priority among {priorities}
-    Finally, provide a confidence level (0.0 to 1.0) for both the category and priority.
-
-    Ticket Subject: {ticket_subject}
-    Ticket Content: {ticket_body}
-
-    Respond only with a JSON object in the following format without any extra words:
-    {{
-        "category": "Category name",
-        "category_confidence": 0.0,
-        "priority": "Priority level",
-        "priority_confidence": 0.0
-    }}
-    
-    Ensure the JSON is valid and contains only the specified fields.
+T = TypeVar("T")
+
+
+def _token_usages(response: LLMResult) -> Iterator[Dict[str, int]]:
+    """
+    Token usage of the generations of an llm call. Anthropic input tokens don't include
+    the prompt tokens read from its cache, which are billed at a fraction of the price.
+    """
+    for generations in response.generations:
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            usage = getattr(message, "usage_metadata", None)
+            if usage:
+                provider_usage = message.response_metadata.get("usage") or {}
+                yield {"input_tokens": usage.get("input_tokens", 0),
+                       "output_tokens": usage.get("output_tokens", 0),
+                       "cache_read_tokens": provider_usage.get("cache_read_input_tokens") or 0}
+
+
+class LLMMetricsCallback(BaseCallbackHandler):
+    """Records latency, token usage and errors of the llm calls of a provider."""
+    run_inline = True
+
+    def __init__(self, provider: str):
+        self.provider = provider
+        self._starts: Dict[UUID, float] = {}
+        self._streamed: Set[UUID] = set()
+
+    def on_chat_model_start(self, serialized: Dict[str, Any], messages: Any, *,
+                            run_id: UUID, **kwargs: Any):
+        self._starts[run_id] = time.perf_counter()
+
+    def on_llm_new_token(self, token: str, *, run_id: UUID, **kwargs: Any):
+        # only called when streaming
+        start = self._starts.get(run_id)
+        if start is not None and run_id not in self._streamed:
+            self._streamed.add(run_id)
+            LLM_FIRST_TOKEN_SECONDS.labels(self.provider).observe(time.perf_counter() - start)
+
+    def on_llm_end(self, response: LLMResult, *, run_id: UUID, **kwargs: Any):
+        self._streamed.discard(run_id)
+        start = self._starts.pop(run_id, None)
+        if start is not None:
+            LLM_REQUEST_SECONDS.labels(self.provider).observe(time.perf_counter() - start)
+        for usage in _token_usages(response):
+            LLM_TOKENS.labels(self.provider, "input").inc(usage["input_tokens"])
+            LLM_TOKENS.labels(self.provider, "output").inc(usage["output_tokens"])
+            if usage["cache_read_tokens"]:
+                LLM_TOKENS.labels(self.provider, "cache_read").inc(usage["cache_read_tokens"])
+
+    def on_llm_error(self, error: BaseException, *, run_id: UUID, **kwargs: Any):
+        self._streamed.discard(run_id)
+        self._starts.pop(run_id, None)
+        LLM_ERRORS.labels(self.provider).inc()
+
+
+# input and output tokens spent on tickets by id, until they are saved with the tickets
+_ticket_tokens: Dict[UUID, Tuple[int, int]] = {}
+
+
+def take_ticket_tokens(ticket_id: UUID) -> Tuple[int, int]:
+    """Input and output tokens spent on a ticket since last taken."""
+    return _ticket_tokens.pop(ticket_id, (0, 0))
+
+
+class TokenUsageCallback(BaseCallbackHandler):
+    """Sums the token usage of the llm calls of a chain run, to charge it to its tickets."""
+    run_inline = True
+
+    def __init__(self):
+        self.input_tokens = 0
+        self.output_tokens = 0
+
+    def on_llm_end(self, response: LLMResult, **kwargs: Any):
+        for usage in _token_usages(response):
+            self.input_tokens += usage["input_tokens"]
+            self.output_tokens += usage["output_tokens"]
+
+    def charge(self, tickets: List[Ticket]):
+        """Charge the usage to the tickets, split evenly between them."""
+        if not self.input_tokens and not self.output_tokens:
+            return
+        input_share, input_left = divmod(self.input_tokens, len(tickets))
+        output_share, output_left = divmod(self.output_tokens, len(tickets))
+        for i, ticket in enumerate(tickets):
+            input_tokens, output_tokens = _ticket_tokens.get(ticket.id, (0, 0))
+            _ticket_tokens[ticket.id] = (input_tokens + input_share + (i < input_left),
+                                         output_tokens + output_share + (i < output_left))
+
+
+# bump the versions when prompts change to invalidate cached llm results
+CLASSIFY_PROMPT_VERSION = "2"
+RESPONSE_PROMPT_VERSION = "2"
+
+anthropic_limiter = RateLimiter("anthropic",
+                                settings.ANTHROPIC_REQUESTS_PER_MINUTE,
+                                settings.ANTHROPIC_TOKENS_PER_MINUTE,
+                                redis_conn,
+                                settings.RATE_LIMIT_ENABLED)
+openai_limiter = RateLimiter("openai",
+                             settings.OPENAI_REQUESTS_PER_MINUTE,
+                             settings.OPENAI_TOKENS_PER_MINUTE,
+                             redis_conn,
+                             settings.RATE_LIMIT_ENABLED)
+
+limiters = {"anthropic": anthropic_limiter, "openai": openai_limiter}
+provider_router = ProviderRouter(settings.LLM_ROUTER_WINDOW,
+                                 settings.LLM_BREAKER_ERROR_RATE,
+                                 settings.LLM_BREAKER_MIN_CALLS,
+                                 settings.LLM_BREAKER_COOLDOWN,
+                                 settings.LLM_HEDGE_MIN_SAMPLES,
+                                 settings.LLM_HEDGE_MAX_DELAY)
+
+classify_cache = LLMCache("classify", settings.LLM_CACHE_SIZE, settings.LLM_CACHE_TTL, redis_conn)
+response_cache = LLMCache("response", settings.LLM_CACHE_SIZE, settings.LLM_CACHE_TTL, redis_conn)
+
+# static instructions are built once and sent first, ahead of the ticket, so that providers
+# can cache them as a prompt prefix
+CATEGORIES = enum2csv(TicketCategory, ", ")
+PRIORITIES = enum2csv(TicketPriority, ", ")
+
+CLASSIFY_INSTRUCTIONS = f"""
+Analyze the ticket given by the user and categorize it into one of these categories: {CATEGORIES}
+Also, assign a priority among {PRIORITIES}
+Finally, provide a confidence level (0.0 to 1.0) for both the category and priority.
+
+Respond only with a JSON object in the following format without any extra words:
+{{
+    "category": "Category name",
+    "category_confidence": 0.0,
+    "priority": "Priority level",
+    "priority_confidence": 0.0
+}}
+
+Ensure the JSON is valid and contains only the specified fields.
+"""
+
+BATCH_CLASSIFY_INSTRUCTIONS = f"""
+Analyze each of the tickets given by the user and categorize it into one of these
+categories: {CATEGORIES}
+Also, assign a priority among {PRIORITIES} to each ticket.
+Finally, provide a confidence level (0.0 to 1.0) for both the category and priority.
+
+Tickets are given as a JSON array, each with an id, subject and content.
+
+Respond only with a JSON object in the following format without any extra words,
+with exactly one entry per ticket id:
+{{
+    "tickets": [
+        {{
+            "ticket_id": "Ticket id",
+            "category": "Category name",
+            "category_confidence": 0.0,
+            "priority": "Priority level",
+            "priority_confidence": 0.0
+        }}
+    ]
+}}
+
+Ensure the JSON is valid and contains only the specified fields.
+"""
+
+RESPONSE_INSTRUCTIONS = """
+Craft an initial response to the ticket given by the user.
+
+Respond only with a text containing the initial response to the customer.
+Don't add any ending words like 'best regards 'in the response.
+"""
+
+TICKET_TEMPLATE = """Ticket Subject: {ticket_subject}
+Ticket Content: {ticket_body}"""
+
+
+def _prompt(instructions: str, template: str, provider: str) -> ChatPromptTemplate:
+    """
+    Chat prompt of the static instructions followed by the ticket. Anthropic caches the
+    instructions up to an explicit breakpoint, openai caches long enough prefixes by itself.
     """
-)
+    if provider == "anthropic":
+        system = SystemMessage(content=[{"type": "text", "text": instructions,
+                                         "cache_control": {"type": "ephemeral"}}])
+    else:
+        system = SystemMessage(content=instructions)
+    return ChatPromptTemplate.from_messages([system, ("human", template)])
+
 
-anthropic_llm = ChatAnthropic(model=settings.ANTHROPIC_MODEL,
-                              api_key=settings.ANTHROPIC_API_KEY,
-                              base_url=settings.ANTHROPIC_PROXY_URL,
-                              max_tokens=100)
+classify_prompt = _prompt(CLASSIFY_INSTRUCTIONS, TICKET_TEMPLATE, "anthropic")
 output_parser = PydanticOutputParser(pydantic_object=TicketClassified)
-classify_chain = classify_prompt | anthropic_llm | output_parser
 
-response_prompt = PromptTemplate(
-    input_variables=["ticket_subject", "ticket_body"],
-    template="""
-    Craft an initial response to the following ticket.
+batch_classify_prompt = _prompt(BATCH_CLASSIFY_INSTRUCTIONS, "{tickets}", "anthropic")
+batch_output_parser = PydanticOutputParser(pydantic_object=TicketsClassified)
 
-    Ticket Subject: {ticket_subject}
-    Ticket Content: {ticket_body}
+response_prompt = _prompt(RESPONSE_INSTRUCTIONS, TICKET_TEMPLATE, "openai")
 
-    Respond only with a text containing the initial response to the customer.
-    Don't add any ending words like 'best regards 'in the response.
+
+@lru_cache(maxsize=None)
+def get_llm(provider: str) -> BaseChatModel:
+    """
+    Build the chat client of provider("anthropic" or "openai") on first use, provider sdks
+    are imported here so that only the processes calling the llms load them.
     """
-)
-openai_llm = ChatOpenAI(model=settings.OPENAI_MODEL,
-                        api_key=settings.OPENAI_API_KEY,
-                        base_url=settings.OPENAI_PROXY_URL,
-                        max_tokens=100)
-response_chain = response_prompt | openai_llm | StrOutputParser()
+    if settings.FAKE_LLM:
+        # stand-in provider for benchmarks, see src/core/fake_llm.py
+        llm = FakeChatModel(latency=settings.FAKE_LLM_LATENCY,
+                            jitter=settings.FAKE_LLM_JITTER,
+                            error_rate=settings.FAKE_LLM_ERROR_RATE)
+    elif provider == "anthropic":
+        if not settings.ANTHROPIC_API_KEY:
+            raise RuntimeError("ANTHROPIC_API_KEY is required to call anthropic")
+        from langchain_anthropic import ChatAnthropic
+        llm = ChatAnthropic(model=settings.ANTHROPIC_MODEL,
+                            api_key=settings.ANTHROPIC_API_KEY,
+                            base_url=settings.ANTHROPIC_PROXY_URL,
+                            max_tokens=100,
+                            # cache the static instructions of the classify prompts
+                            default_headers={"anthropic-beta": "prompt-caching-2024-07-31"})
+    elif provider == "openai":
+        if not settings.OPENAI_API_KEY:
+            raise RuntimeError("OPENAI_API_KEY is required to call openai")
+        from langchain_openai import ChatOpenAI
+        llm = ChatOpenAI(model=settings.OPENAI_MODEL,
+                         api_key=settings.OPENAI_API_KEY,
+                         base_url=settings.OPENAI_PROXY_URL,
+                         max_tokens=100,
+                         # token usage of streamed responses
+                         stream_usage=True)
+    else:
+        raise ValueError(f"Unknown llm provider {provider}")
+    llm.callbacks = [LLMMetricsCallback(provider)]
+    return llm
 
 
-async def categorize_prioritize_ticket(ticket: Ticket) -> TicketClassified:
-    logger.info("Classify ticket by Anthropic llm")
+@lru_cache(maxsize=None)
+def get_classify_chain(provider: str = "anthropic") -> Runnable:
+    return (_prompt(CLASSIFY_INSTRUCTIONS, TICKET_TEMPLATE, provider)
+            | get_llm(provider)
+            | output_parser)
+
+
+@lru_cache(maxsize=None)
+def get_batch_classify_chain(provider: str = "anthropic") -> Runnable:
+    # each classified ticket takes roughly 60 output tokens
+    return (_prompt(BATCH_CLASSIFY_INSTRUCTIONS, "{tickets}", provider)
+            | get_llm(provider).bind(max_tokens=60 * settings.CLASSIFY_BATCH_SIZE)
+            | batch_output_parser)
+
+
+@lru_cache(maxsize=None)
+def get_response_chain(provider: str = "openai") -> Runnable:
+    return (_prompt(RESPONSE_INSTRUCTIONS, TICKET_TEMPLATE, provider)
+            | get_llm(provider)
+            | StrOutputParser())
+
+
+def _providers(providers: List[str]) -> List[str]:
+    """
+    Providers a call may be routed to in order of preference, those with an api key.
+    Only the first one is used if routing is disabled or none has a key, to report it.
+    """
+    keys = {"anthropic": settings.ANTHROPIC_API_KEY, "openai": settings.OPENAI_API_KEY}
+    configured = [provider for provider in providers if settings.FAKE_LLM or keys.get(provider)]
+    if not settings.LLM_ROUTER_ENABLED or not configured:
+        return providers[:1]
+    return configured
+
+
+async def _route(operation: str, providers: List[str], call: Callable[[str], Awaitable[T]]) -> T:
+    providers = _providers(providers)
+    if len(providers) == 1:
+        return await call(providers[0])
+    return await provider_router.call(operation, providers, call)
+
+
+def _model(provider: str) -> str:
+    """Model answering the calls routed to provider."""
+    if settings.FAKE_LLM:
+        return "fake"
+    return {"anthropic": settings.ANTHROPIC_MODEL, "openai": settings.OPENAI_MODEL}[provider]
+
+
+# llm results are cached under the provider and model which answered, a call may be failed over
+# or hedged to another provider than the first one, or answered by the fake llm. Lookups try
+# the providers the call may be routed to in order, results of models no longer configured
+# aren't used.
+def _classify_cache_key(ticket: Ticket, provider: str) -> str:
+    return classify_cache.key(ticket.subject, ticket.body,
+                              f"{provider}/{_model(provider)}", CLASSIFY_PROMPT_VERSION)
+
+
+def _response_cache_key(ticket: Ticket, provider: str) -> str:
+    return response_cache.key(ticket.subject, ticket.body,
+                              f"{provider}/{_model(provider)}", RESPONSE_PROMPT_VERSION)
+
+
+async def _cached_classified(ticket: Ticket) -> Optional[TicketClassified]:
+    if not settings.LLM_CACHE_ENABLED:
+        return None
+    for provider in _providers(settings.CLASSIFY_PROVIDERS):
+        cached = await classify_cache.aget(_classify_cache_key(ticket, provider))
+        if cached is not None:
+            return TicketClassified.model_validate_json(cached)
+    return None
+
+
+async def _cache_classified(ticket: Ticket, provider: str, ticket_classified: TicketClassified):
+    if settings.LLM_CACHE_ENABLED:
+        await classify_cache.aset(_classify_cache_key(ticket, provider),
+                                  ticket_classified.model_dump_json())
+
+
+async def _classify_ticket(ticket: Ticket) -> Tuple[str, TicketClassified]:
+    """Classify a ticket with one llm call, returns the provider which answered too."""
+    usage = TokenUsageCallback()
     try:
+        body = fit_body(ticket.body, settings.CLASSIFY_BODY_MAX_TOKENS)
         chain_input = {
             "ticket_subject": ticket.subject,
-            "ticket_body": ticket.body,
-            "categories": enum2csv(TicketCategory, ", "),
-            "priorities": enum2csv(TicketPriority, ", ")
+            "ticket_body": body
         }
-        return await classify_chain.ainvoke(chain_input)
+
+        async def classify(provider: str) -> Tuple[str, TicketClassified]:
+            # prompt and output take about 300 tokens besides the ticket
+            async with limiters[provider].limit(estimate_tokens(ticket.subject, body) + 300):
+                return provider, await get_classify_chain(provider).ainvoke(
+                    chain_input, {"callbacks": [usage]})
+
+        return await _route("classify", settings.CLASSIFY_PROVIDERS, classify)
     except Exception as e:
         logger.error(f"Classify ticket {ticket.id} failed: {e}")
         raise e
+    finally:
+        usage.charge([ticket])
+
+
+async def categorize_prioritize_ticket(ticket: Ticket) -> TicketClassified:
+    ticket_classified = classify_locally(ticket)
+    if ticket_classified is not None:
+        logger.info(f"Classify ticket {ticket.id} by local classifier")
+        return ticket_classified
+
+    ticket_classified = await _cached_classified(ticket)
+    if ticket_classified is not None:
+        logger.info(f"Classify ticket {ticket.id} from cache")
+        return ticket_classified
+
+    logger.info("Classify ticket by Anthropic llm")
+    provider, ticket_classified = await _classify_ticket(ticket)
+    await _cache_classified(ticket, provider, ticket_classified)
+    return ticket_classified
+
+
+async def _classify_batch(tickets: List[Ticket]) -> Dict[UUID, Tuple[str, TicketClassified]]:
+    """
+    Classify a batch with one llm call, along with the provider which answered. Invalid or
+    partial answers are retried by splitting the batch, provider errors are raised so that
+    the batch is retried after a backoff instead of calling the provider again right away.
+    """
+    if len(tickets) == 1:
+        ticket = tickets[0]
+        try:
+            return {ticket.id: await _classify_ticket(ticket)}
+        except OutputParserException:
+            return {}
+
+    classified = {}
+    usage = TokenUsageCallback()
+    try:
+        chain_input = {
+            "tickets": json.dumps([{"id": str(ticket.id),
+                                    "subject": ticket.subject,
+                                    "content": fit_body(ticket.body,
+                                                        settings.CLASSIFY_BODY_MAX_TOKENS)}
+                                   for ticket in tickets]),
+        }
+        tokens = estimate_tokens(chain_input["tickets"]) + 300 + 60 * len(tickets)
+
+        async def classify(provider: str) -> Tuple[str, TicketsClassified]:
+            async with limiters[provider].limit(tokens):
+                return provider, await get_batch_classify_chain(provider).ainvoke(
+                    chain_input, {"callbacks": [usage]})
+
+        provider, result = await _route("classify_batch", settings.CLASSIFY_PROVIDERS, classify)
+        ids = {ticket.id for ticket in tickets}
+        classified = {item.ticket_id: (provider,
+                                       TicketClassified(**item.model_dump(exclude={"ticket_id"})))
+                      for item in result.tickets if item.ticket_id in ids}
+    except OutputParserException as e:
+        logger.error(f"Classify batch of {len(tickets)} tickets failed, invalid answer: {e}")
+    finally:
+        usage.charge(tickets)
+
+    failed = [ticket for ticket in tickets if ticket.id not in classified]
+    if not failed:
+        return classified
+    if len(failed) < len(tickets):
+        # the batch partially succeeded, retry the missing tickets only
+        classified.update(await _classify_batch(failed))
+    else:
+        # the whole batch failed, split it in halves to isolate the bad tickets
+        middle = len(failed) // 2
+        for part in await asyncio.gather(_classify_batch(failed[:middle]),
+                                         _classify_batch(failed[middle:])):
+            classified.update(part)
+    return classified
+
+
+async def categorize_prioritize_tickets(tickets: List[Ticket]) -> Dict[UUID, TicketClassified]:
+    """
+    Classify tickets with one Anthropic llm call per batch of CLASSIFY_BATCH_SIZE tickets.
+    Tickets that fail to be classified are left out of the returned mapping.
+    """
+    classified = {}
+    for ticket in tickets:
+        ticket_classified = classify_locally(ticket)
+        if ticket_classified is not None:
+            classified[ticket.id] = ticket_classified
+    uncached = [ticket for ticket in tickets if ticket.id not in classified]
+    for ticket, ticket_classified in zip(uncached, await asyncio.gather(
+            *(_cached_classified(ticket) for ticket in uncached))):
+        if ticket_classified is not None:
+            classified[ticket.id] = ticket_classified
+    tickets = [ticket for ticket in tickets if ticket.id not in classified]
+    if classified:
+        logger.info(f"Classify {len(classified)} tickets by local classifier or from cache")
+    if not tickets:
+        return classified
+
+    logger.info(f"Classify {len(tickets)} tickets by Anthropic llm in batches")
+    size = settings.CLASSIFY_BATCH_SIZE
+    batches = [tickets[i:i + size] for i in range(0, len(tickets), size)]
+    answered = {}
+    for part in await asyncio.gather(*(_classify_batch(batch) for batch in batches)):
+        answered.update(part)
+    await asyncio.gather(*(_cache_classified(ticket, *answered[ticket.id])
+                           for ticket in tickets if ticket.id in answered))
+    classified.update({ticket_id: ticket_classified
+                       for ticket_id, (_, ticket_classified) in answered.items()})
+    return classified
+
+
+async def _prepend(first: str, chunks: AsyncIterator[str]) -> AsyncIterator[str]:
+    yield first
+    async for chunk in chunks:
+        yield chunk
 
 
 async def craft_ticket_response(ticket: Ticket) -> str:
+    """
+    Generate the initial response of a ticket. With RESPONSE_STREAM_ENABLED the tokens are
+    published to the response stream of the ticket as they come, cached responses aren't
+    streamed, they are published whole once the ticket is saved.
+    """
+    if settings.LLM_CACHE_ENABLED:
+        for provider in _providers(settings.RESPONSE_PROVIDERS):
+            response = await response_cache.aget(_response_cache_key(ticket, provider))
+            if response is not None:
+                logger.info(f"Reply ticket {ticket.id} from cache")
+                return response
+
     logger.info("Reply ticket with OpenAI llm")
+    usage = TokenUsageCallback()
     try:
+        body = fit_body(ticket.body, settings.RESPONSE_BODY_MAX_TOKENS)
         chain_input = {
             "ticket_subject": ticket.subject,
-            "ticket_body": ticket.body
+            "ticket_body": body
         }
-        return await response_chain.ainvoke(chain_input)
+        config = {"callbacks": [usage]}
+        tokens = estimate_tokens(ticket.subject, body) + 200
+
+        async def respond(provider: str) -> Tuple[str, str]:
+            async with limiters[provider].limit(tokens):
+                return provider, await get_response_chain(provider).ainvoke(chain_input, config)
+
+        async def open_stream(provider: str) -> Tuple[str, str, AsyncIterator[str]]:
+            # streams are routed on their first token, the rest comes from the winning provider
+            async with limiters[provider].limit(tokens):
+                chunks = get_response_chain(provider).astream(chain_input, config)
+                return provider, await anext(chunks, ""), chunks
+
+        if settings.RESPONSE_STREAM_ENABLED:
+            provider, first, chunks = await _route("respond_stream", settings.RESPONSE_PROVIDERS,
+                                                   open_stream)
+            try:
+                response = await stream_response(ticket.id, _prepend(first, chunks))
+            except Exception as e:
+                provider_router.record_failure(provider, e)
+                raise
+        else:
+            provider, response = await _route("respond", settings.RESPONSE_PROVIDERS, respond)
+        if settings.LLM_CACHE_ENABLED:
+            await response_cache.aset(_response_cache_key(ticket, provider), response)
+        return response
     except Exception as e:
         logger.error(f"Response to ticket {ticket.id} failed: {e}")
         raise e
+    finally:
+        usage.charge([ticket])
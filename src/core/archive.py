@@ -0,0 +1,53 @@
+"""
+Archival of old processed tickets. They are moved from the tickets table to tickets_archive
+batch by batch, every batch in its own short transaction, so that the live table only keeps
+recent history and its queries stay fast however long the archive grows. Archived tickets are
+still served by id and listed with include_archived, they are not searchable anymore.
+
+Usage: python -m src.core.archive [--days 90] [--batch-size 1000], e.g. daily from cron.
+"""
+import argparse
+import time
+from datetime import datetime, timedelta
+
+from src.core.config import settings
+from src.core.utils import setup_logger
+from src.models.database import SessionLocal
+from src.models.ticket import archive_tickets
+
+logger = setup_logger(__name__)
+
+
+def archive_old_tickets(days: int = None, batch_size: int = None, pause: float = 0.05) -> int:
+    """
+    Archive the processed tickets created more than days ago, returns their number.
+    Batches are apart by pause seconds to let the other writers in.
+    """
+    days = days or settings.ARCHIVE_AFTER_DAYS
+    batch_size = batch_size or settings.ARCHIVE_BATCH_SIZE
+    before = datetime.utcnow() - timedelta(days=days)
+    archived = 0
+    db = SessionLocal()
+    try:
+        while True:
+            moved = archive_tickets(db, before, batch_size)
+            archived += moved
+            if moved < batch_size:
+                break
+            time.sleep(pause)
+    finally:
+        db.close()
+    logger.info(f"Archived {archived} tickets processed and created before {before}")
+    return archived
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archive old processed tickets.")
+    parser.add_argument("--days", type=int, default=settings.ARCHIVE_AFTER_DAYS)
+    parser.add_argument("--batch-size", type=int, default=settings.ARCHIVE_BATCH_SIZE)
+    args = parser.parse_args()
+    archive_old_tickets(args.days, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+"""
+Long-lived asyncio worker, an alternative to `rq worker` for ticket processing.
+It pulls many jobs at once from the rq queues and runs them concurrently on one event loop,
+so llm clients and their connection pools are reused across tickets. Queues are pulled by
+weighted round robin, high priority responses get most of the slots during a backlog while
+classification and low priority responses keep making progress. Every SWEEP_INTERVAL seconds
+the worker also retries tickets whose processing lease expired and enqueues due retries.
+"""
+import asyncio
+import signal
+import traceback
+from typing import Dict, List, Optional, Set
+from uuid import uuid4
+
+from prometheus_client import start_http_server
+from redis import asyncio as aioredis
+from rq import Queue
+from rq.defaults import DEFAULT_RESULT_TTL
+from rq.job import Job, JobStatus
+from rq.utils import utcnow
+
+from src.core.broker import redis_conn
+from src.core.config import settings
+from src.core.jobs import PROCESS_TICKET_BATCH_JOB, PROCESS_TICKET_JOB, RESPOND_TICKET_JOB
+from src.core.retry import sweep_tickets
+from src.core.utils import setup_logger
+from src.core.worker import process_ticket, process_ticket_batch, respond_ticket
+
+logger = setup_logger(__name__)
+
+# coroutine functions run on the worker loop for jobs enqueued with the rq job functions
+ASYNC_JOBS = {
+    PROCESS_TICKET_JOB: process_ticket,
+    PROCESS_TICKET_BATCH_JOB: process_ticket_batch,
+    RESPOND_TICKET_JOB: respond_ticket,
+}
+
+
+class WeightedRoundRobin:
+    """Smooth weighted round robin, over many picks every name gets its share of weight."""
+
+    def __init__(self, weights: Dict[str, int]):
+        self.weights = {name: weight for name, weight in weights.items() if weight > 0}
+        self._current = dict.fromkeys(self.weights, 0)
+
+    def picks(self, count: int) -> Dict[str, int]:
+        """Number of picks of each name among the next count picks."""
+        total = sum(self.weights.values())
+        picked = dict.fromkeys(self.weights, 0)
+        for _ in range(count):
+            for name, weight in self.weights.items():
+                self._current[name] += weight
+            name = max(self._current, key=self._current.get)
+            self._current[name] -= total
+            picked[name] += 1
+        return picked
+
+
+class AsyncWorker:
+
+    def __init__(self,
+                 concurrency: int = settings.WORKER_CONCURRENCY,
+                 weights: Dict[str, int] = settings.QUEUE_WEIGHTS,
+                 sweep_interval: float = settings.SWEEP_INTERVAL):
+        self.concurrency = concurrency
+        # name the started jobs are registered with, like the names of rq workers
+        self.name = uuid4().hex
+        self.sweep_interval = sweep_interval
+        self.redis = aioredis.Redis.from_url(settings.REDIS_URL)
+        self.scheduler = WeightedRoundRobin({Queue(name, connection=redis_conn).key: weight
+                                             for name, weight in weights.items()})
+        # queue keys by decreasing weight
+        self.keys = sorted(self.scheduler.weights, key=self.scheduler.weights.get, reverse=True)
+        self._tasks: Set[asyncio.Task] = set()
+        self._stopping: Optional[asyncio.Event] = None
+
+    def stop(self):
+        if not self._stopping.is_set():
+            logger.info(f"Stopping worker, waiting for {len(self._tasks)} jobs in flight")
+            self._stopping.set()
+
+    async def run(self):
+        self._stopping = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, self.stop)
+
+        logger.info(f"Async worker started on queues {self.keys}, concurrency {self.concurrency}")
+        sweeper = asyncio.create_task(self._sweep()) if self.sweep_interval > 0 else None
+        try:
+            while not self._stopping.is_set():
+                free = self.concurrency - len(self._tasks)
+                if free <= 0:
+                    await asyncio.wait(self._tasks, return_when=asyncio.FIRST_COMPLETED)
+                    continue
+                job_ids = await self._pop(free)
+                if not job_ids:
+                    continue
+                for job in await asyncio.to_thread(self._start, job_ids):
+                    task = asyncio.create_task(self._perform(job))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+            if self._tasks:
+                await asyncio.wait(self._tasks)
+        finally:
+            if sweeper is not None:
+                sweeper.cancel()
+            await self.redis.aclose()
+        logger.info("Async worker stopped")
+
+    async def _sweep(self):
+        while not self._stopping.is_set():
+            try:
+                await asyncio.to_thread(sweep_tickets)
+            except Exception as e:
+                logger.error(f"Sweep tickets failed: {e}")
+            try:
+                await asyncio.wait_for(self._stopping.wait(), timeout=self.sweep_interval)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _lpop(self, counts: Dict[str, int]) -> List[bytes]:
+        counts = {key: count for key, count in counts.items() if count > 0}
+        if not counts:
+            return []
+        async with self.redis.pipeline(transaction=False) as pipe:
+            for key, count in counts.items():
+                pipe.lpop(key, count)
+            return [job_id for job_ids in await pipe.execute() for job_id in job_ids or []]
+
+    async def _pop(self, count: int) -> List[str]:
+        """
+        Take up to count job ids, shared among the queues by weighted round robin. Slots left
+        by empty queues go to the others by weight. Block shortly if all queues are empty.
+        """
+        job_ids = await self._lpop(self.scheduler.picks(count))
+        for key in self.keys:
+            if len(job_ids) >= count:
+                break
+            job_ids.extend(await self.redis.lpop(key, count - len(job_ids)) or [])
+        if not job_ids:
+            # redis pops the first non empty queue in the given order
+            popped = await self.redis.blpop(self.keys, timeout=1)
+            job_ids = [popped[1]] if popped is not None else []
+        return [job_id.decode() for job_id in job_ids]
+
+    def _start(self, job_ids: List[str]) -> List[Job]:
+        """
+        Fetch popped jobs and add them to the started job registries of their queues, as rq
+        workers do, in one round trip. Jobs deleted while queued are skipped.
+        """
+        jobs = [job for job in Job.fetch_many(job_ids, connection=redis_conn) if job is not None]
+        with redis_conn.pipeline() as pipe:
+            for job in jobs:
+                job.prepare_for_execution(self.name, pipe)
+                ttl = -1 if job.timeout == -1 else (job.timeout or Queue.DEFAULT_TIMEOUT) + 60
+                job.heartbeat(utcnow(), ttl, pipeline=pipe)
+            pipe.execute()
+        return jobs
+
+    def _finish(self, job: Job, exc_string: Optional[str] = None):
+        """
+        Move a performed job from the started job registry to the finished one, or to the
+        failed one with its traceback, the same way rq workers handle job results.
+        """
+        job.ended_at = utcnow()
+        with redis_conn.pipeline() as pipe:
+            if exc_string is None:
+                result_ttl = job.get_result_ttl(DEFAULT_RESULT_TTL)
+                if result_ttl != 0:
+                    job._handle_success(result_ttl, pipeline=pipe)
+                job.cleanup(result_ttl, pipeline=pipe, remove_from_queue=False)
+            else:
+                job.set_status(JobStatus.FAILED, pipeline=pipe)
+                job._handle_failure(exc_string, pipeline=pipe)
+            job.started_job_registry.remove(job, pipeline=pipe)
+            pipe.execute()
+
+    async def _perform(self, job: Job):
+        """
+        Run a job within its timeout, as rq workers do. A timed out ticket job is cancelled,
+        the lease of its tickets isn't renewed anymore and the sweeper retries them once it
+        expires. Sync jobs run in a thread, which can't be stopped and only stops being waited.
+        """
+        exc_string = None
+        timeout = None if job.timeout == -1 else job.timeout or Queue.DEFAULT_TIMEOUT
+        try:
+            func = ASYNC_JOBS.get(job.func_name)
+            if func is not None:
+                await asyncio.wait_for(func(*job.args, **job.kwargs), timeout)
+            else:
+                await asyncio.wait_for(asyncio.to_thread(job.func, *job.args, **job.kwargs),
+                                       timeout)
+        except asyncio.TimeoutError:
+            logger.error(f"Job {job.id} {job.func_name} timed out after {timeout} seconds")
+            exc_string = traceback.format_exc()
+        except Exception as e:
+            logger.error(f"Job {job.id} {job.func_name} failed: {e}")
+            exc_string = traceback.format_exc()
+        try:
+            await asyncio.to_thread(self._finish, job, exc_string)
+        except Exception as e:
+            logger.error(f"Finish job {job.id} {job.func_name} failed: {e}")
+
+
+def main():
+    if settings.WORKER_METRICS_PORT:
+        start_http_server(settings.WORKER_METRICS_PORT)
+    asyncio.run(AsyncWorker().run())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,13 @@
+from redis import Redis
+from rq import Queue
+
+from src.core.config import settings
+from src.models.schemas import TicketPriority
+
+# redis connection and default rq queue shared by api, workers and caches
+redis_conn = Redis.from_url(settings.REDIS_URL)
+queue = Queue(connection=redis_conn)
+# classified tickets get their response generated from the queue of their priority,
+# workers drain high before low
+response_queues = {priority: Queue(f"respond-{priority.name.lower()}", connection=redis_conn)
+                   for priority in (TicketPriority.HIGH, TicketPriority.LOW)}
@@ -0,0 +1,126 @@
+import asyncio
+import hashlib
+import json
+import re
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from src.core.metrics import CACHE_LOOKUPS
+from src.core.utils import setup_logger
+
+logger = setup_logger(__name__)
+
+
+def normalize_text(text: str) -> str:
+    """Lower case and collapse whitespaces so near-identical texts share one cache entry."""
+    return re.sub(r"\s+", " ", text or "").strip().lower()
+
+
+class TwoTierCache:
+    """
+    Two tiers cache, an in-process LRU in front of a shared redis tier. Values are strings,
+    redis failures are logged and treated as cache misses. Entries live ttl seconds in redis
+    and local_ttl seconds(ttl by default) in process.
+    """
+
+    def __init__(self, name: str, maxsize: int, ttl: int, redis_conn: Optional[Redis] = None,
+                 local_ttl: Optional[float] = None):
+        self.name = name
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.local_ttl = ttl if local_ttl is None else local_ttl
+        self.redis = redis_conn
+        self.hits = 0
+        self.misses = 0
+        self._local = OrderedDict()
+        self._local_hits = CACHE_LOOKUPS.labels(name, "local_hit")
+        self._redis_hits = CACHE_LOOKUPS.labels(name, "redis_hit")
+        self._misses = CACHE_LOOKUPS.labels(name, "miss")
+
+    def get_local(self, key: str) -> Optional[str]:
+        entry = self._local.get(key)
+        if entry is not None:
+            expires_at, value = entry
+            if expires_at > time.monotonic():
+                self._local.move_to_end(key)
+                self.hits += 1
+                self._local_hits.inc()
+                return value
+            del self._local[key]
+        return None
+
+    def get(self, key: str) -> Optional[str]:
+        value = self.get_local(key)
+        if value is not None:
+            return value
+
+        if self.redis is not None:
+            try:
+                value = self.redis.get(key)
+            except RedisError as e:
+                logger.warning(f"Read {self.name} cache from redis failed: {e}")
+        if value is None:
+            self.misses += 1
+            self._misses.inc()
+            return None
+
+        value = value.decode() if isinstance(value, bytes) else value
+        self._set_local(key, value)
+        self.hits += 1
+        self._redis_hits.inc()
+        return value
+
+    async def aget(self, key: str) -> Optional[str]:
+        """Same as get, only goes off the event loop when it has to ask redis."""
+        value = self.get_local(key)
+        if value is not None:
+            return value
+        return await asyncio.to_thread(self.get, key)
+
+    def set(self, key: str, value: str, nx: bool = False):
+        """Cache value, with nx the redis tier is only written if it has no entry for key."""
+        self._set_local(key, value)
+        if self.redis is not None:
+            try:
+                self.redis.set(key, value, ex=self.ttl, nx=nx)
+            except RedisError as e:
+                logger.warning(f"Write {self.name} cache to redis failed: {e}")
+
+    async def aset(self, key: str, value: str, nx: bool = False):
+        """Same as set, writing redis off the event loop."""
+        await asyncio.to_thread(self.set, key, value, nx)
+
+    def delete(self, *keys: str):
+        for key in keys:
+            self._local.pop(key, None)
+        if self.redis is not None and keys:
+            try:
+                self.redis.delete(*keys)
+            except RedisError as e:
+                logger.warning(f"Delete {self.name} cache from redis failed: {e}")
+
+    def clear(self):
+        self._local.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> dict:
+        return {"hits": self.hits, "misses": self.misses, "size": len(self._local)}
+
+    def _set_local(self, key: str, value: str):
+        self._local[key] = (time.monotonic() + self.local_ttl, value)
+        self._local.move_to_end(key)
+        while len(self._local) > self.maxsize:
+            self._local.popitem(last=False)
+
+
+class LLMCache(TwoTierCache):
+    """Cache of llm results keyed by the normalized ticket text, model and prompt version."""
+
+    def key(self, subject: str, body: str, model: str, prompt_version: str) -> str:
+        content = json.dumps([model, prompt_version, normalize_text(subject), normalize_text(body)])
+        return f"llm-cache:{self.name}:{hashlib.sha256(content.encode()).hexdigest()}"
@@ -0,0 +1,170 @@
+import argparse
+import pickle
+from typing import List, Optional
+
+from sqlalchemy import select
+from sqlalchemy.orm import Session
+
+from src.core.config import settings
+from src.core.utils import setup_logger
+from src.models.database import SessionLocal
+from src.models.schemas import ClassifiedBy, TicketClassified, TicketCategory, TicketPriority
+from src.models.schemas import TicketStatus
+from src.models.ticket import Ticket
+
+try:
+    import numpy as np
+    from sklearn.feature_extraction.text import HashingVectorizer
+    from sklearn.linear_model import SGDClassifier
+except ImportError:  # optional dependency, install by `poetry install -E classifier`
+    np = HashingVectorizer = SGDClassifier = None
+
+logger = setup_logger(__name__)
+
+
+class LocalClassifier:
+    """
+    Category and priority logistic regressions over hashed ticket words, trained
+    incrementally from tickets already classified by the llm.
+    """
+
+    def __init__(self):
+        # hashing keeps memory constant and needs no vocabulary pass over the training tickets
+        self.vectorizer = HashingVectorizer(n_features=2 ** 18,
+                                            ngram_range=(1, 2),
+                                            alternate_sign=False,
+                                            norm="l2")
+        self.category_model = SGDClassifier(loss="log_loss", alpha=1e-6)
+        self.priority_model = SGDClassifier(loss="log_loss", alpha=1e-6)
+
+    @staticmethod
+    def text(subject: str, body: str) -> str:
+        return f"{subject or ''}\n{body or ''}"
+
+    def partial_fit(self, texts: List[str], categories: List[str], priorities: List[str]):
+        features = self.vectorizer.transform(texts)
+        self.category_model.partial_fit(features, categories,
+                                        classes=[item.value for item in TicketCategory])
+        self.priority_model.partial_fit(features, priorities,
+                                        classes=[item.value for item in TicketPriority])
+
+    @staticmethod
+    def _predict_proba(model: "SGDClassifier", features) -> "np.ndarray":
+        # same as model.predict_proba for a single ticket, but only gathers the weights of
+        # its non zero features instead of a sparse-dense product over the whole hash space
+        scores = model.coef_[:, features.indices] @ features.data + model.intercept_
+        proba = 1 / (1 + np.exp(-scores))
+        if len(proba) == 1:
+            return np.array([1 - proba[0], proba[0]])
+        return proba / proba.sum()
+
+    def predict(self, subject: str, body: str) -> TicketClassified:
+        features = self.vectorizer.transform([self.text(subject, body)])
+        category_proba = self._predict_proba(self.category_model, features)
+        priority_proba = self._predict_proba(self.priority_model, features)
+        category = category_proba.argmax()
+        priority = priority_proba.argmax()
+        return TicketClassified(category=TicketCategory(self.category_model.classes_[category]),
+                                category_confidence=float(category_proba[category]),
+                                priority=TicketPriority(self.priority_model.classes_[priority]),
+                                priority_confidence=float(priority_proba[priority]),
+                                classified_by=ClassifiedBy.LOCAL)
+
+    def save(self, path: str):
+        with open(path, "wb") as f:
+            pickle.dump(self, f)
+
+    @staticmethod
+    def load(path: str) -> "LocalClassifier":
+        with open(path, "rb") as f:
+            return pickle.load(f)
+
+
+def train(db: Session,
+          epochs: int = 1,
+          chunk_size: int = 10000,
+          min_confidence: float = 0.8) -> LocalClassifier:
+    """
+    Train a local classifier from processed tickets classified by the llm with confidences of
+    at least min_confidence, streaming the labeled tickets from db in chunks. Tickets classified
+    locally are left out, the classifier would learn from its own predictions.
+    """
+    if SGDClassifier is None:
+        raise RuntimeError("scikit-learn is required to train the local classifier")
+
+    statement = (select(Ticket.subject, Ticket.body, Ticket.category, Ticket.priority)
+                 .where(Ticket.status == TicketStatus.PROCESSED,
+                        Ticket.classified_by == ClassifiedBy.LLM,
+                        Ticket.category_confidence >= min_confidence,
+                        Ticket.priority_confidence >= min_confidence)
+                 .execution_options(yield_per=chunk_size))
+    classifier = LocalClassifier()
+    for epoch in range(epochs):
+        trained = 0
+        for rows in db.execute(statement).partitions():
+            classifier.partial_fit([LocalClassifier.text(row.subject, row.body) for row in rows],
+                                   [row.category.value for row in rows],
+                                   [row.priority.value for row in rows])
+            trained += len(rows)
+        logger.info(f"Trained local classifier epoch {epoch + 1} with {trained} tickets")
+    return classifier
+
+
+_local_classifier: Optional[LocalClassifier] = None
+_loaded = False
+
+
+def get_local_classifier() -> Optional[LocalClassifier]:
+    """Load the local classifier once per process, None if disabled or not available."""
+    global _local_classifier, _loaded
+    if not _loaded:
+        _loaded = True
+        if settings.LOCAL_CLASSIFIER_PATH and SGDClassifier is not None:
+            try:
+                _local_classifier = LocalClassifier.load(settings.LOCAL_CLASSIFIER_PATH)
+                logger.info(f"Loaded local classifier from {settings.LOCAL_CLASSIFIER_PATH}")
+            except FileNotFoundError:
+                logger.info("No local classifier found, classify tickets by llm only")
+            except Exception as e:
+                logger.error(f"Load local classifier failed: {e}")
+    return _local_classifier
+
+
+def classify_locally(ticket: Ticket) -> Optional[TicketClassified]:
+    """
+    Classify ticket by the local classifier, None if it's not available or
+    not confident enough on either the category or the priority.
+    """
+    classifier = get_local_classifier()
+    if classifier is None:
+        return None
+    try:
+        ticket_classified = classifier.predict(ticket.subject, ticket.body)
+    except Exception as e:
+        logger.error(f"Classify ticket {ticket.id} locally failed: {e}")
+        return None
+    threshold = settings.LOCAL_CLASSIFIER_THRESHOLD
+    if (ticket_classified.category_confidence < threshold
+            or ticket_classified.priority_confidence < threshold):
+        return None
+    return ticket_classified
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train the local ticket classifier.")
+    parser.add_argument("--output", default=settings.LOCAL_CLASSIFIER_PATH)
+    parser.add_argument("--epochs", type=int, default=1)
+    parser.add_argument("--min-confidence", type=float, default=0.8)
+    args = parser.parse_args()
+
+    db = SessionLocal()
+    try:
+        classifier = train(db, epochs=args.epochs, min_confidence=args.min_confidence)
+    finally:
+        db.close()
+    classifier.save(args.output)
+    logger.info(f"Saved local classifier to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
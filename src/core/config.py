@@ -1,16 +1,104 @@
+from typing import Dict, List
+
 from pydantic import Field
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 
 class Settings(BaseSettings):
+    # sync and async engines switch it to the drivers of its dialect, e.g. postgresql://...
     DATABASE_URL: str = Field("sqlite:///./tickets.db")
     REDIS_URL: str = Field("redis://localhost:6379")
-    ANTHROPIC_API_KEY: str
-    OPENAI_API_KEY: str
+    # only needed by the workers, checked when the llm clients are first built
+    ANTHROPIC_API_KEY: str = Field("")
+    OPENAI_API_KEY: str = Field("")
     ANTHROPIC_PROXY_URL: str = Field("")
     OPENAI_PROXY_URL: str = Field("")
     ANTHROPIC_MODEL: str = Field("claude-3-5-sonnet-20240620")
     OPENAI_MODEL: str = Field("gpt-4o")
+    # replace both providers by a fake chat model with the given latency, jitter and error rate
+    FAKE_LLM: bool = Field(False)
+    FAKE_LLM_LATENCY: float = Field(0.5)
+    FAKE_LLM_JITTER: float = Field(0.1)
+    FAKE_LLM_ERROR_RATE: float = Field(0.0)
+    # per provider quotas shared by all workers, limits adapt down on rate limited responses
+    RATE_LIMIT_ENABLED: bool = Field(True)
+    ANTHROPIC_REQUESTS_PER_MINUTE: int = Field(50)
+    ANTHROPIC_TOKENS_PER_MINUTE: int = Field(40000)
+    OPENAI_REQUESTS_PER_MINUTE: int = Field(500)
+    OPENAI_TOKENS_PER_MINUTE: int = Field(30000)
+    # llm providers in order of preference, calls slower than the p95 latency of the first one
+    # are hedged on the next one and calls to failing providers fail over to the next one
+    LLM_ROUTER_ENABLED: bool = Field(True)
+    CLASSIFY_PROVIDERS: List[str] = Field(["anthropic", "openai"])
+    RESPONSE_PROVIDERS: List[str] = Field(["openai", "anthropic"])
+    # latencies and outcomes of the last calls kept per provider
+    LLM_ROUTER_WINDOW: int = Field(100)
+    LLM_HEDGE_MIN_SAMPLES: int = Field(20)
+    LLM_HEDGE_MAX_DELAY: float = Field(10.0)
+    # a provider failing this rate of its last calls(after min calls) is skipped for cooldown
+    # seconds, then tried again with a single call
+    LLM_BREAKER_ERROR_RATE: float = Field(0.5)
+    LLM_BREAKER_MIN_CALLS: int = Field(10)
+    LLM_BREAKER_COOLDOWN: float = Field(30.0)
+    CLASSIFY_BATCH_SIZE: int = Field(20)
+    # estimated tokens of a ticket body embedded in the prompts, longer bodies are cut down to
+    # their start, end and lines looking relevant(errors, failures...)
+    CLASSIFY_BODY_MAX_TOKENS: int = Field(1000)
+    RESPONSE_BODY_MAX_TOKENS: int = Field(2000)
+    BULK_CHUNK_SIZE: int = Field(1000)
+    # coalesce concurrent ticket creations into one transaction of up to max size tickets,
+    # waiting at most max wait seconds for the batch to fill
+    GROUP_COMMIT_ENABLED: bool = Field(False)
+    GROUP_COMMIT_MAX_SIZE: int = Field(100)
+    GROUP_COMMIT_MAX_WAIT: float = Field(0.005)
+    CLAIM_CHUNK_SIZE: int = Field(1000)
+    EXPORT_CHUNK_SIZE: int = Field(10000)
+    # full text search ranks at most this many most recent matches on sqlite, 0 for all
+    SEARCH_MAX_CANDIDATES: int = Field(5000)
+    TICKET_CACHE_ENABLED: bool = Field(True)
+    TICKET_CACHE_SIZE: int = Field(10000)
+    TICKET_CACHE_TTL: int = Field(60 * 60)
+    # seconds a ticket stays in the api process cache, bounds how stale polled tickets can be
+    TICKET_CACHE_LOCAL_TTL: float = Field(1.0)
+    # longest wait of GET /v1/ticket/{id}?wait=, keep it under the read timeout of proxies
+    TICKET_WAIT_MAX: float = Field(60.0)
+    # stream initial responses token by token to GET /v1/ticket/{id}/response/stream clients
+    RESPONSE_STREAM_ENABLED: bool = Field(True)
+    # seconds a finished response stream is kept for late readers
+    RESPONSE_STREAM_TTL: int = Field(300)
+    # seconds a stream client waits for the next event before the stream is closed
+    RESPONSE_STREAM_TIMEOUT: float = Field(300.0)
+    # processing attempts of a ticket before it is dead lettered as failed
+    TICKET_MAX_ATTEMPTS: int = Field(5)
+    # a failed attempt is retried after base * 2^(attempts - 1) seconds up to max, less a jitter
+    # of up to half of it
+    RETRY_BACKOFF_BASE: float = Field(30.0)
+    RETRY_BACKOFF_MAX: float = Field(3600.0)
+    # seconds a worker holds a ticket it processes, renewed every third of it while it waits
+    # for the llms. Tickets waiting in a queue get the queued lease, which must outlast backlogs.
+    # Tickets still processing past their lease are retried.
+    TICKET_LEASE: float = Field(120.0)
+    TICKET_QUEUED_LEASE: float = Field(6 * 3600.0)
+    # seconds between sweeps of expired leases and due retries by the async worker, 0 to disable,
+    # each sweep handles at most the batch size tickets of each
+    SWEEP_INTERVAL: float = Field(15.0)
+    SWEEP_BATCH_SIZE: int = Field(200)
+    # processed tickets older than this many days are moved to the archive table by
+    # python -m src.core.archive, batch by batch
+    ARCHIVE_AFTER_DAYS: int = Field(90)
+    ARCHIVE_BATCH_SIZE: int = Field(1000)
+    WORKER_CONCURRENCY: int = Field(100)
+    # share of the jobs pulled by the async worker from each queue while they are all backlogged,
+    # the default queue classifies tickets, the respond queues answer them by priority
+    QUEUE_WEIGHTS: Dict[str, int] = Field({"respond-high": 6, "default": 3, "respond-low": 1})
+    # port of the async worker prometheus exporter, 0 to disable
+    WORKER_METRICS_PORT: int = Field(9100)
+    # tickets are classified by llm if the local classifier is less confident than the threshold
+    LOCAL_CLASSIFIER_PATH: str = Field("./classifier.pkl")
+    LOCAL_CLASSIFIER_THRESHOLD: float = Field(0.9)
+    LLM_CACHE_ENABLED: bool = Field(True)
+    LLM_CACHE_SIZE: int = Field(10000)
+    LLM_CACHE_TTL: int = Field(7 * 24 * 3600)
 
     model_config = SettingsConfigDict(
         env_file=".env",
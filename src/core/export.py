@@ -0,0 +1,204 @@
+"""
+Streaming export of tickets as NDJSON, CSV or Parquet. Rows are read in chunks from a
+server side cursor and every chunk is encoded and handed out before the next one is read.
+
+Usage: python -m src.core.export --format csv --output tickets.csv [--status processed]
+       [--category ...] [--priority ...] [--created-from 2024-01-01] [--created-to 2024-02-01]
+       [--fields id,subject,body]
+"""
+import argparse
+import csv
+import importlib.util
+import io
+import json
+import sys
+from datetime import datetime
+from operator import attrgetter
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Sequence
+
+from sqlalchemy import Row
+
+from src.core.config import settings
+from src.core.utils import setup_logger
+from src.models.database import SessionLocal
+from src.models.schemas import TicketStatus, TicketCategory, TicketPriority
+from src.models.ticket import Ticket, export_ticket_rows
+
+logger = setup_logger(__name__)
+
+EXPORT_FIELDS = [column.name for column in Ticket.__table__.columns]
+EXPORT_FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+
+def parse_fields(fields: Optional[str]) -> List[str]:
+    """Comma separated export fields, all of them if empty. Raise ValueError on unknown ones."""
+    if not fields:
+        return EXPORT_FIELDS
+    names = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in names if name not in EXPORT_FIELDS]
+    if unknown or not names:
+        raise ValueError(f"Unknown export fields {unknown}, choose among {EXPORT_FIELDS}")
+    return names
+
+
+# columns which are not json or csv friendly as read from the database, the others are kept
+CONVERTERS = {
+    "id": str,
+    "status": attrgetter("value"),
+    "category": attrgetter("value"),
+    "priority": attrgetter("value"),
+    "classified_by": attrgetter("value"),
+    "created_at": datetime.isoformat,
+    "processed_at": datetime.isoformat,
+    "next_attempt_at": datetime.isoformat,
+    "lease_expires_at": datetime.isoformat,
+}
+
+
+def _plain_rows(rows: List[Row],
+                fields: Sequence[str],
+                converters: Dict[str, Callable] = CONVERTERS) -> Iterator[list]:
+    """Rows with enums, datetimes and uuids as strings, only converting the columns needing it."""
+    converters = [(i, converters[field]) for i, field in enumerate(fields) if field in converters]
+    for row in rows:
+        values = list(row)
+        for i, convert in converters:
+            if values[i] is not None:
+                values[i] = convert(values[i])
+        yield values
+
+
+def ndjson_chunks(chunks: Iterable[List[Row]], fields: Sequence[str]) -> Iterator[bytes]:
+    for rows in chunks:
+        yield "".join(json.dumps(dict(zip(fields, values))) + "\n"
+                      for values in _plain_rows(rows, fields)).encode()
+
+
+def csv_chunks(chunks: Iterable[List[Row]], fields: Sequence[str]) -> Iterator[bytes]:
+    """The header comes first on its own, so that exports matching no ticket still have it."""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(fields)
+    yield buffer.getvalue().encode()
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(_plain_rows(rows, fields))
+        yield buffer.getvalue().encode()
+
+
+class _ChunkSink:
+    """Write only file handing out the bytes written so far, parquet only needs write and tell."""
+
+    def __init__(self):
+        self.closed = False
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self) -> bytes:
+        data, self._chunks = b"".join(self._chunks), []
+        return data
+
+
+def parquet_available() -> bool:
+    # optional dependency, install by `poetry install -E export`
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+# parquet stores timestamps natively
+TIMESTAMP_FIELDS = ("created_at", "processed_at", "next_attempt_at", "lease_expires_at")
+PARQUET_CONVERTERS = {field: convert for field, convert in CONVERTERS.items()
+                      if field not in TIMESTAMP_FIELDS}
+
+
+def _parquet_schema(pa, fields: Sequence[str]):
+    types = {"category_confidence": pa.float64(), "priority_confidence": pa.float64(),
+             "input_tokens": pa.int64(), "output_tokens": pa.int64(), "attempts": pa.int64(),
+             **dict.fromkeys(TIMESTAMP_FIELDS, pa.timestamp("us"))}
+    return pa.schema([(field, types.get(field, pa.string())) for field in fields])
+
+
+def parquet_chunks(chunks: Iterable[List[Row]], fields: Sequence[str]) -> Iterator[bytes]:
+    """Encode every chunk of rows as one parquet row group."""
+    if not parquet_available():
+        raise RuntimeError("pyarrow is required to export tickets as parquet")
+    # imported here, pyarrow is heavy and only needed by parquet exports
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = _parquet_schema(pa, fields)
+    sink = _ChunkSink()
+    with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema, compression="zstd") as writer:
+        for rows in chunks:
+            columns = list(zip(*_plain_rows(rows, fields, PARQUET_CONVERTERS)))
+            writer.write_table(pa.table(columns, schema=schema))
+            yield sink.take()
+    yield sink.take()
+
+
+ENCODERS = {"ndjson": ndjson_chunks, "csv": csv_chunks, "parquet": parquet_chunks}
+
+
+def export_tickets(export_format: str,
+                   fields: Sequence[str],
+                   status: Optional[TicketStatus] = None,
+                   category: Optional[TicketCategory] = None,
+                   priority: Optional[TicketPriority] = None,
+                   created_from: Optional[datetime] = None,
+                   created_to: Optional[datetime] = None,
+                   chunk_size: int = 10000) -> Iterator[bytes]:
+    """Yield the encoded export chunk by chunk, the db session lives as long as the iteration."""
+    db = SessionLocal()
+    try:
+        chunks = export_ticket_rows(db, fields, status, category, priority,
+                                    created_from, created_to, chunk_size)
+        yield from ENCODERS[export_format](chunks, fields)
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Export tickets as NDJSON, CSV or Parquet.")
+    parser.add_argument("--format", choices=list(EXPORT_FORMATS), default="ndjson")
+    parser.add_argument("--output", help="output file, stdout if not given")
+    parser.add_argument("--status", type=TicketStatus)
+    parser.add_argument("--category", type=TicketCategory)
+    parser.add_argument("--priority", type=TicketPriority)
+    parser.add_argument("--created-from", type=datetime.fromisoformat)
+    parser.add_argument("--created-to", type=datetime.fromisoformat)
+    parser.add_argument("--fields", help=f"comma separated among {','.join(EXPORT_FIELDS)}")
+    parser.add_argument("--chunk-size", type=int, default=settings.EXPORT_CHUNK_SIZE)
+    args = parser.parse_args()
+
+    output = open(args.output, "wb") if args.output else sys.stdout.buffer
+    try:
+        for data in export_tickets(args.format, parse_fields(args.fields), args.status,
+                                   args.category, args.priority, args.created_from,
+                                   args.created_to, args.chunk_size):
+            output.write(data)
+    finally:
+        if args.output:
+            output.close()
+    logger.info(f"Exported tickets to {args.output or 'stdout'}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+import asyncio
+import json
+import random
+import re
+import time
+from typing import Any, AsyncIterator, List, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from src.core.ratelimit import estimate_tokens
+from src.models.schemas import TicketCategory, TicketPriority
+
+TICKET_ID = re.compile(r'"id": "([0-9a-f-]{36})"')
+
+
+def _text(message: BaseMessage) -> str:
+    if isinstance(message.content, str):
+        return message.content
+    return "\n".join(block if isinstance(block, str) else block.get("text", "")
+                     for block in message.content)
+
+
+class FakeLLMError(Exception):
+    """Error raised by the fake llm, 429 errors are handled like provider rate limits."""
+
+    def __init__(self, status_code: int):
+        super().__init__(f"Fake llm error {status_code}")
+        self.status_code = status_code
+
+
+class FakeChatModel(BaseChatModel):
+    """
+    Stand-in chat model for benchmarks, answers the classify, batch classify and response
+    prompts with valid random content after a configurable latency, jitter and error rate.
+    Streamed answers get their first word after a tenth of the latency.
+    """
+    latency: float = 0.5
+    jitter: float = 0.1
+    error_rate: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def _delay(self) -> float:
+        return max(0.0, random.gauss(self.latency, self.jitter))
+
+    def _result(self, messages: List[BaseMessage]) -> ChatResult:
+        if random.random() < self.error_rate:
+            raise FakeLLMError(random.choice([429, 500, 529]))
+        prompt = "\n".join(_text(message) for message in messages)
+        if '"tickets": [' in prompt:
+            content = json.dumps({"tickets": [dict(ticket_id=ticket_id, **self._classified())
+                                              for ticket_id in TICKET_ID.findall(prompt)]})
+        elif '"category"' in prompt:
+            content = json.dumps(self._classified())
+        else:
+            content = "Thanks for reaching out, we are looking into your request."
+        usage = {"input_tokens": estimate_tokens(prompt), "output_tokens": estimate_tokens(content)}
+        usage["total_tokens"] = usage["input_tokens"] + usage["output_tokens"]
+        return ChatResult(generations=[ChatGeneration(
+            message=AIMessage(content=content, usage_metadata=usage))])
+
+    @staticmethod
+    def _classified() -> dict:
+        return {"category": random.choice(list(TicketCategory)).value,
+                "category_confidence": round(random.random(), 2),
+                "priority": random.choice(list(TicketPriority)).value,
+                "priority_confidence": round(random.random(), 2)}
+
+    def _generate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                  run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        time.sleep(self._delay())
+        return self._result(messages)
+
+    async def _agenerate(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                         run_manager: Any = None, **kwargs: Any) -> ChatResult:
+        await asyncio.sleep(self._delay())
+        return self._result(messages)
+
+    async def _astream(self, messages: List[BaseMessage], stop: Optional[List[str]] = None,
+                       run_manager: Any = None,
+                       **kwargs: Any) -> AsyncIterator[ChatGenerationChunk]:
+        delay = self._delay()
+        message = self._result(messages).generations[0].message
+        words = re.findall(r"\S+\s*", message.content)
+        await asyncio.sleep(delay / 10)
+        for i, word in enumerate(words):
+            if i:
+                await asyncio.sleep(delay * 9 / 10 / (len(words) - 1))
+            # usage comes with the last chunk, like openai streams
+            usage = message.usage_metadata if i == len(words) - 1 else None
+            chunk = ChatGenerationChunk(message=AIMessageChunk(content=word, usage_metadata=usage))
+            if run_manager:
+                await run_manager.on_llm_new_token(word, chunk=chunk)
+            yield chunk
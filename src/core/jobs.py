@@ -0,0 +1,63 @@
+"""
+Enqueue side of ticket processing. Jobs are referenced by import string so that the api
+only needs rq and redis, the llm stack is imported by the workers running the jobs.
+"""
+from typing import Iterable, List, Tuple
+from uuid import UUID
+
+from rq import Queue
+from rq.job import Job
+
+from src.core.broker import redis_conn, queue, response_queues
+from src.core.config import settings
+from src.models.schemas import TicketPriority
+
+PROCESS_TICKET_JOB = "src.core.worker.process_ticket_job"
+PROCESS_TICKET_BATCH_JOB = "src.core.worker.process_ticket_batch_job"
+RESPOND_TICKET_JOB = "src.core.worker.respond_ticket_job"
+CLAIM_TICKETS_JOB = "src.core.worker.claim_and_process_tickets"
+RECONCILE_STATS_JOB = "src.core.stats.reconcile_stats"
+
+
+def enqueue_ticket(ticket_id: UUID) -> Job:
+    return queue.enqueue(PROCESS_TICKET_JOB, ticket_id)
+
+
+def bulk_enqueue_tickets(ticket_ids: List[UUID]) -> List[Job]:
+    """Enqueue one process job per ticket through a single redis pipeline round trip."""
+    with redis_conn.pipeline() as pipe:
+        jobs = queue.enqueue_many([Queue.prepare_data(PROCESS_TICKET_JOB, (ticket_id,))
+                                   for ticket_id in ticket_ids], pipeline=pipe)
+        pipe.execute()
+    return jobs
+
+
+def process_tickets(tickets: List[UUID]):
+    """Enqueue batch process jobs of CLASSIFY_BATCH_SIZE tickets through one redis pipeline."""
+    size = settings.CLASSIFY_BATCH_SIZE
+    with redis_conn.pipeline() as pipe:
+        queue.enqueue_many([Queue.prepare_data(PROCESS_TICKET_BATCH_JOB, (tickets[i:i + size],))
+                            for i in range(0, len(tickets), size)], pipeline=pipe)
+        pipe.execute()
+
+
+def enqueue_responses(tickets: Iterable[Tuple[UUID, TicketPriority]]):
+    """Enqueue one respond job per classified ticket on the queue of its priority."""
+    ticket_ids = {priority: [] for priority in response_queues}
+    for ticket_id, priority in tickets:
+        ticket_ids[priority].append(ticket_id)
+    with redis_conn.pipeline() as pipe:
+        for priority, ids in ticket_ids.items():
+            if ids:
+                response_queues[priority].enqueue_many(
+                    [Queue.prepare_data(RESPOND_TICKET_JOB, (ticket_id,)) for ticket_id in ids],
+                    pipeline=pipe)
+        pipe.execute()
+
+
+def enqueue_claim_tickets() -> Job:
+    return queue.enqueue(CLAIM_TICKETS_JOB)
+
+
+def enqueue_reconcile_stats() -> Job:
+    return queue.enqueue(RECONCILE_STATS_JOB, job_timeout=3600)
@@ -0,0 +1,111 @@
+import time
+from functools import partial
+
+from prometheus_client import Counter, Gauge, Histogram
+from rq import Queue
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from src.core.broker import queue, response_queues
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+PROCESS_BUCKETS = (.1, .5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+
+HTTP_REQUEST_SECONDS = Histogram("http_request_duration_seconds",
+                                 "Http request latency by route",
+                                 ["method", "route", "status"],
+                                 buckets=LATENCY_BUCKETS)
+DB_QUERY_SECONDS = Histogram("db_query_duration_seconds",
+                             "Database statement latency by statement type",
+                             ["operation"],
+                             buckets=LATENCY_BUCKETS)
+LLM_REQUEST_SECONDS = Histogram("llm_request_duration_seconds",
+                                "Llm call latency by provider",
+                                ["provider"],
+                                buckets=LATENCY_BUCKETS)
+LLM_FIRST_TOKEN_SECONDS = Histogram("llm_first_token_seconds",
+                                    "Latency to the first token of streamed llm calls by provider",
+                                    ["provider"],
+                                    buckets=LATENCY_BUCKETS)
+LLM_TOKENS = Counter("llm_tokens", "Llm tokens used by provider", ["provider", "type"])
+LLM_ERRORS = Counter("llm_errors", "Failed llm calls by provider", ["provider"])
+LLM_ROUTED = Counter("llm_routed_calls",
+                     "Llm calls hedged or failed over to a fallback provider, or skipping "
+                     "an open circuit, by reason",
+                     ["operation", "provider", "reason"])
+CACHE_LOOKUPS = Counter("cache_lookups",
+                        "Two tier cache lookups by cache and result, local or redis hit, or miss",
+                        ["cache", "result"])
+TICKET_PROCESS_SECONDS = Histogram("ticket_process_duration_seconds",
+                                   "Latency from ticket creation to processed by priority",
+                                   ["priority"],
+                                   buckets=PROCESS_BUCKETS)
+QUEUE_DEPTH = Gauge("rq_queue_depth", "Number of jobs waiting in the rq queue", ["queue"])
+# set by the rate limiters of the llm providers from their stats
+RATE_LIMIT = Gauge("llm_rate_limit",
+                   "Current adaptive per minute limit of llm calls by provider, requests or tokens",
+                   ["provider", "type"])
+RATE_LIMIT_WAITING = Gauge("llm_rate_limit_waiting",
+                           "Llm calls waiting for the rate limiter by provider", ["provider"])
+RATE_LIMIT_WAIT_SECONDS = Gauge("llm_rate_limit_avg_wait_seconds",
+                                "Average wait of llm calls for the rate limiter by provider",
+                                ["provider"])
+
+
+def _queue_depth(rq_queue: Queue) -> float:
+    try:
+        return rq_queue.count
+    except Exception:
+        return float("nan")
+
+
+for _queue in (queue, *response_queues.values()):
+    QUEUE_DEPTH.labels(_queue.name).set_function(partial(_queue_depth, _queue))
+
+
+class MetricsMiddleware:
+    """Pure asgi middleware timing http requests by route template."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_SECONDS.labels(scope["method"],
+                                        route.path if route else "unmatched",
+                                        status).observe(time.perf_counter() - start)
+
+
+def instrument_engine(engine: Engine):
+    """Time every statement executed by a sync engine(or the sync_engine of an async one)."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        elapsed = time.perf_counter() - conn.info["query_start"].pop()
+        operation = statement.lstrip().split(" ", 1)[0].upper()
+        DB_QUERY_SECONDS.labels(operation).observe(elapsed)
+
+    @event.listens_for(engine, "handle_error")
+    def handle_error(context):
+        if context.connection is not None and context.connection.info.get("query_start"):
+            context.connection.info["query_start"].pop()
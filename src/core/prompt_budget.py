@@ -0,0 +1,86 @@
+"""
+Token budgets of the ticket bodies embedded in prompts. Long bodies, typically pasted logs,
+are cut down to their head, tail and the lines in between that look relevant(errors,
+exceptions, failures...), repeated lines being collapsed first, so that prompts stay fast
+and within the context limits of the providers.
+"""
+import re
+from typing import List
+
+from src.core.ratelimit import estimate_tokens
+
+RELEVANT_LINE = re.compile(r"error|exception|fail|traceback|fatal|denied|refused|timeout|"
+                           r"timed out|invalid|unable|cannot|can't|crash|panic|refund|charged",
+                           re.IGNORECASE)
+# share of the budget kept for the start and for the end of the body
+HEAD_SHARE = 0.4
+TAIL_SHARE = 0.2
+
+
+def _collapse_repeated(lines: List[str]) -> List[str]:
+    collapsed = []
+    i = 0
+    while i < len(lines):
+        j = i + 1
+        while j < len(lines) and lines[j] == lines[i]:
+            j += 1
+        collapsed.append(lines[i] if j - i == 1 else f"{lines[i]} [repeated {j - i} times]")
+        i = j
+    return collapsed
+
+
+def _omitted(count: int) -> str:
+    return f"[... {count} lines omitted ...]"
+
+
+def _cut(text: str, max_tokens: int) -> str:
+    """Keep the start and the end of a text without usable lines."""
+    chars = max(0, max_tokens * 4 - 30)
+    head = chars * 2 // 3
+    return f"{text[:head]} [... truncated ...] {text[len(text) - (chars - head):]}"
+
+
+def fit_body(body: str, max_tokens: int) -> str:
+    """Fit a ticket body in about max_tokens tokens, bodies within budget are kept as is."""
+    if not body or max_tokens <= 0 or estimate_tokens(body) <= max_tokens:
+        return body
+    lines = _collapse_repeated(body.splitlines())
+    if estimate_tokens("\n".join(lines)) <= max_tokens:
+        return "\n".join(lines)
+
+    # every kept line takes its newline and a marker may follow it
+    costs = [estimate_tokens(line) + 1 for line in lines]
+    kept = set()
+    budget = max_tokens - 10
+
+    def keep(indexes, limit):
+        spent = 0
+        for i in indexes:
+            if i in kept:
+                continue
+            if spent + costs[i] > limit:
+                break
+            kept.add(i)
+            spent += costs[i]
+        return spent
+
+    budget -= keep(range(len(lines)), budget * HEAD_SHARE)
+    budget -= keep(range(len(lines) - 1, -1, -1), max_tokens * TAIL_SHARE)
+    relevant = [i for i in range(len(lines)) if i not in kept and RELEVANT_LINE.search(lines[i])]
+    for i in relevant:
+        if costs[i] + 5 <= budget:
+            kept.add(i)
+            budget -= costs[i] + 5
+    if not kept:
+        return _cut(body, max_tokens)
+
+    fitted = []
+    last = -1
+    for i in sorted(kept):
+        if i > last + 1:
+            fitted.append(_omitted(i - last - 1))
+        fitted.append(lines[i])
+        last = i
+    if last < len(lines) - 1:
+        fitted.append(_omitted(len(lines) - 1 - last))
+    return "\n".join(fitted)
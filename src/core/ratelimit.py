@@ -0,0 +1,198 @@
+import asyncio
+import time
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Optional
+
+from redis import Redis
+from redis.exceptions import RedisError
+
+from src.core.metrics import RATE_LIMIT, RATE_LIMIT_WAITING, RATE_LIMIT_WAIT_SECONDS
+from src.core.utils import setup_logger
+
+logger = setup_logger(__name__)
+
+# Take one request and the given tokens from the per minute buckets of a provider.
+# KEYS: request bucket, token bucket, limit factor, blocked until
+# ARGV: requests per minute, tokens per minute, tokens
+# Returns the seconds to wait before retrying(0 if acquired) and the current limit factor.
+ACQUIRE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local factor = tonumber(redis.call('GET', KEYS[3]) or '1')
+local blocked_until = tonumber(redis.call('GET', KEYS[4]) or '0')
+if blocked_until > now then
+    return {tostring(blocked_until - now), tostring(factor)}
+end
+
+local function level(key, capacity)
+    local bucket = redis.call('HMGET', key, 'level', 'ts')
+    local value = tonumber(bucket[1]) or capacity
+    local ts = tonumber(bucket[2]) or now
+    return math.min(capacity, value + (now - ts) * capacity / 60)
+end
+
+local request_capacity = tonumber(ARGV[1]) * factor
+local token_capacity = tonumber(ARGV[2]) * factor
+local tokens = math.min(tonumber(ARGV[3]), token_capacity)
+local requests_left = level(KEYS[1], request_capacity)
+local tokens_left = level(KEYS[2], token_capacity)
+
+local wait = 0
+if requests_left < 1 then
+    wait = (1 - requests_left) * 60 / request_capacity
+end
+if tokens_left < tokens then
+    wait = math.max(wait, (tokens - tokens_left) * 60 / token_capacity)
+end
+if wait == 0 then
+    requests_left = requests_left - 1
+    tokens_left = tokens_left - tokens
+end
+redis.call('HSET', KEYS[1], 'level', requests_left, 'ts', now)
+redis.call('HSET', KEYS[2], 'level', tokens_left, 'ts', now)
+redis.call('EXPIRE', KEYS[1], 120)
+redis.call('EXPIRE', KEYS[2], 120)
+return {tostring(wait), tostring(factor)}
+"""
+
+# Halve the limit factor(not below ARGV[1]) and block the provider for ARGV[2] seconds.
+PENALIZE_SCRIPT = """
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+local factor = tonumber(redis.call('GET', KEYS[1]) or '1')
+factor = math.max(tonumber(ARGV[1]), factor / 2)
+redis.call('SET', KEYS[1], tostring(factor), 'EX', 3600)
+local blocked_until = now + tonumber(ARGV[2])
+if blocked_until > tonumber(redis.call('GET', KEYS[2]) or '0') then
+    redis.call('SET', KEYS[2], tostring(blocked_until), 'EX', math.ceil(tonumber(ARGV[2])) + 1)
+end
+return tostring(factor)
+"""
+
+# Raise the limit factor additively by ARGV[1] up to 1.
+RECOVER_SCRIPT = """
+local factor = tonumber(redis.call('GET', KEYS[1]) or '1')
+factor = math.min(1, factor + tonumber(ARGV[1]))
+redis.call('SET', KEYS[1], tostring(factor), 'EX', 3600)
+return tostring(factor)
+"""
+
+
+def estimate_tokens(*texts: str) -> int:
+    """Rough token count of texts, about 4 characters per token."""
+    return sum(len(text or "") for text in texts) // 4
+
+
+def is_rate_limited(e: Exception) -> bool:
+    return getattr(e, "status_code", None) == 429
+
+
+def retry_after(e: Exception) -> Optional[float]:
+    response = getattr(e, "response", None)
+    try:
+        return float(response.headers["retry-after"])
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Adaptive requests and tokens per minute limiter of a llm provider, shared by all
+    workers through redis. The limits are halved on rate limited responses and recover
+    additively on successful calls. If redis is not available, calls are not limited.
+    Redis scripts run in a thread to keep the event loop free, its stats are exported as gauges.
+    """
+    MIN_FACTOR = 0.1
+    RECOVER_STEP = 0.05
+    DEFAULT_RETRY_AFTER = 1.0
+
+    def __init__(self, provider: str, requests_per_minute: int, tokens_per_minute: int,
+                 redis_conn: Optional[Redis], enabled: bool = True):
+        self.provider = provider
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.redis = redis_conn
+        self.enabled = enabled
+        self.factor = 1.0
+        self.waiting = 0
+        self.acquired = 0
+        self.wait_seconds = 0.0
+        self.rate_limited = 0
+        self._keys = [f"ratelimit:{provider}:{name}"
+                      for name in ("requests", "tokens", "factor", "blocked_until")]
+        if redis_conn is not None:
+            self._acquire = redis_conn.register_script(ACQUIRE_SCRIPT)
+            self._penalize = redis_conn.register_script(PENALIZE_SCRIPT)
+            self._recover = redis_conn.register_script(RECOVER_SCRIPT)
+        for name in ("requests", "tokens"):
+            RATE_LIMIT.labels(provider, name).set_function(
+                partial(self._stat, f"{name}_per_minute"))
+        RATE_LIMIT_WAITING.labels(provider).set_function(partial(self._stat, "waiting"))
+        RATE_LIMIT_WAIT_SECONDS.labels(provider).set_function(
+            partial(self._stat, "avg_wait_seconds"))
+
+    async def acquire(self, tokens: int):
+        """Wait until both buckets allow one more request of the given tokens."""
+        if not self.enabled or self.redis is None:
+            return
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            while True:
+                wait, factor = await asyncio.to_thread(self._acquire,
+                                                       keys=self._keys,
+                                                       args=[self.requests_per_minute,
+                                                             self.tokens_per_minute,
+                                                             tokens])
+                self.factor = float(factor)
+                if float(wait) <= 0:
+                    break
+                await asyncio.sleep(float(wait))
+        except RedisError as e:
+            logger.warning(f"Rate limit {self.provider} by redis failed, skip limiting: {e}")
+        finally:
+            self.waiting -= 1
+            self.acquired += 1
+            self.wait_seconds += time.monotonic() - start
+
+    @asynccontextmanager
+    async def limit(self, tokens: int):
+        """Acquire before a provider call and adapt the limits to its outcome."""
+        await self.acquire(tokens)
+        try:
+            yield
+        except Exception as e:
+            if self.enabled and is_rate_limited(e):
+                await self._on_rate_limited(retry_after(e))
+            raise
+        else:
+            if self.enabled and self.factor < 1:
+                await self._call(self._recover, self._keys[2:3], [self.RECOVER_STEP])
+
+    def stats(self) -> dict:
+        return {
+            "provider": self.provider,
+            "requests_per_minute": self.requests_per_minute * self.factor,
+            "tokens_per_minute": self.tokens_per_minute * self.factor,
+            "waiting": self.waiting,
+            "avg_wait_seconds": self.wait_seconds / self.acquired if self.acquired else 0.0,
+            "rate_limited": self.rate_limited,
+        }
+
+    def _stat(self, name: str) -> float:
+        return self.stats()[name]
+
+    async def _on_rate_limited(self, seconds: Optional[float]):
+        self.rate_limited += 1
+        seconds = seconds if seconds is not None else self.DEFAULT_RETRY_AFTER
+        logger.warning(f"{self.provider} rate limited, back off for {seconds}s")
+        await self._call(self._penalize, self._keys[2:], [self.MIN_FACTOR, seconds])
+
+    async def _call(self, script, keys, args):
+        if self.redis is None:
+            return
+        try:
+            self.factor = float(await asyncio.to_thread(script, keys=keys, args=args))
+        except RedisError as e:
+            logger.warning(f"Update {self.provider} rate limit in redis failed: {e}")
@@ -0,0 +1,114 @@
+"""
+Initial responses streamed token by token while the llm generates them. The worker appends
+the tokens to a redis stream per ticket, followed by a done event carrying the whole response
+or an error event. Readers replay the stream from the start or from the last event they got,
+so clients connecting late or reconnecting don't miss tokens. Streams expire shortly after
+the response is done, the response itself is persisted to the ticket. A stream is reset when
+a response attempt starts, so that a retry doesn't follow the tokens and the error event of
+the failed attempt, nor inherit its expiry.
+"""
+import json
+from typing import AsyncIterator, NamedTuple, Optional
+from uuid import UUID
+
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+from src.core.broker import redis_conn
+from src.core.config import settings
+from src.core.utils import setup_logger
+
+logger = setup_logger(__name__)
+
+
+class ResponseEvent(NamedTuple):
+    """event is token, done or error, data is the token, the whole response or the error."""
+    id: str
+    event: str
+    data: str
+
+
+def response_stream_key(ticket_id: UUID) -> str:
+    return f"ticket-response:{ticket_id}"
+
+
+async def stream_response(ticket_id: UUID, chunks: AsyncIterator[str]) -> str:
+    """Publish the chunks of a response as they are generated, returns the whole response."""
+    key = response_stream_key(ticket_id)
+    parts = []
+    client = aioredis.Redis.from_url(settings.REDIS_URL)
+    try:
+        async for chunk in chunks:
+            parts.append(chunk)
+            if client is None or not chunk:
+                continue
+            try:
+                await client.xadd(key, {"token": chunk})
+            except RedisError as e:
+                # streaming is best effort, the response is still generated and persisted
+                logger.warning(f"Publish response tokens of ticket {ticket_id} failed: {e}")
+                client = None
+    finally:
+        if client is not None:
+            await client.aclose()
+    return "".join(parts)
+
+
+def reset_response_stream(ticket_id: UUID):
+    """Drop the events of a previous response attempt along with their expiry."""
+    try:
+        redis_conn.delete(response_stream_key(ticket_id))
+    except RedisError as e:
+        logger.warning(f"Reset response stream of ticket {ticket_id} failed: {e}")
+
+
+def finish_response_stream(ticket_id: UUID, response: str = None, error: str = None):
+    """Publish the end of a response stream, its whole response once persisted or an error."""
+    key = response_stream_key(ticket_id)
+    fields = {"error": error} if error is not None else {"done": response}
+    try:
+        with redis_conn.pipeline(transaction=False) as pipe:
+            pipe.xadd(key, fields)
+            pipe.expire(key, settings.RESPONSE_STREAM_TTL)
+            pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Finish response stream of ticket {ticket_id} failed: {e}")
+
+
+async def read_response_stream(ticket_id: UUID,
+                               last_id: Optional[str] = None,
+                               block: float = 15.0,
+                               timeout: float = 300.0) -> AsyncIterator[Optional[ResponseEvent]]:
+    """
+    Yield the response events of a ticket after last_id, from the start if not given, until
+    the done or error event. None is yielded every block seconds without events, to let
+    callers send keep alives, and the iteration stops after timeout seconds without events.
+    """
+    key = response_stream_key(ticket_id)
+    last_id = last_id or "0"
+    idle = 0.0
+    # blocking reads hold their connection, every reader gets its own
+    client = aioredis.Redis.from_url(settings.REDIS_URL)
+    try:
+        while idle < timeout:
+            result = await client.xread({key: last_id}, block=int(block * 1000))
+            if not result:
+                idle += block
+                yield None
+                continue
+            idle = 0.0
+            for entry_id, fields in result[0][1]:
+                last_id = entry_id.decode()
+                (event, data), = fields.items()
+                event = {b"token": "token", b"done": "done"}.get(event, "error")
+                yield ResponseEvent(last_id, event, data.decode())
+                if event != "token":
+                    return
+    finally:
+        await client.aclose()
+
+
+def sse_event(event: str, data: str, event_id: Optional[str] = None) -> str:
+    """Server-sent event, data is json encoded so that it fits on one line."""
+    message = f"event: {event}\ndata: {json.dumps(data)}\n\n"
+    return f"id: {event_id}\n{message}" if event_id else message
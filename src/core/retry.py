@@ -0,0 +1,171 @@
+"""
+Retries of failed ticket processing. A failed attempt sends the ticket back to submitted with
+its next attempt due after an exponential backoff with jitter, or dead letters it as failed
+after TICKET_MAX_ATTEMPTS attempts. Workers hold a lease on the tickets they process, renewed
+by heartbeats while they wait for the llms. The sweeper retries tickets whose lease expired,
+their worker crashed or hung, and enqueues the retries that are due, a bounded number per
+sweep so that failures don't come back as a storm.
+
+Usage: python -m src.core.retry, runs one sweep(e.g. from cron when using rq workers).
+"""
+import asyncio
+import random
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import List, Tuple
+from uuid import UUID
+
+from sqlalchemy.orm import Session
+
+from src.core.config import settings
+from src.core.jobs import enqueue_responses, process_tickets
+from src.core.response_stream import finish_response_stream
+from src.core.stats import record_transition
+from src.core.ticket_cache import cache_ticket, invalidate_tickets
+from src.core.ticket_events import publish_ticket_done
+from src.core.utils import setup_logger
+from src.models.database import SessionLocal
+from src.models.schemas import TicketStatus
+from src.models.ticket import Ticket, claim_due_retries, get_expired_leases, release_tickets
+from src.models.ticket import get_priorities, renew_leases
+
+logger = setup_logger(__name__)
+
+
+def backoff_delay(attempts: int) -> float:
+    """Seconds before the next attempt, the exponential delay is halved by a random jitter."""
+    delay = min(settings.RETRY_BACKOFF_MAX, settings.RETRY_BACKOFF_BASE * 2 ** max(0, attempts - 1))
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+def lease_until(seconds: float = None) -> datetime:
+    return datetime.utcnow() + timedelta(seconds=seconds or settings.TICKET_LEASE)
+
+
+def fail_attempt(ticket: Ticket, error: str) -> TicketStatus:
+    """Record a failed attempt and schedule the next one, returns the new ticket status."""
+    ticket.last_error = error[:1000]
+    ticket.lease_expires_at = None
+    if (ticket.attempts or 0) >= settings.TICKET_MAX_ATTEMPTS:
+        ticket.status = TicketStatus.FAILED
+        ticket.next_attempt_at = None
+        logger.warning(f"Ticket {ticket.id} failed {ticket.attempts} times, dead lettered: "
+                       f"{error}")
+    else:
+        ticket.status = TicketStatus.SUBMITTED
+        ticket.next_attempt_at = datetime.utcnow() + timedelta(
+            seconds=backoff_delay(ticket.attempts or 0))
+    return ticket.status
+
+
+def record_failed(tickets: List[Ticket]):
+    """Record the transitions of tickets whose attempt failed, from processing."""
+    failed = sum(1 for ticket in tickets if ticket.status == TicketStatus.FAILED)
+    for status, count in ((TicketStatus.SUBMITTED, len(tickets) - failed),
+                          (TicketStatus.FAILED, failed)):
+        if count:
+            record_transition(TicketStatus.PROCESSING, status, count)
+
+
+def finish_failed_streams(tickets: List[Ticket]):
+    """End the response streams of dead lettered tickets, so that their readers stop waiting."""
+    for ticket in tickets:
+        if ticket.status == TicketStatus.FAILED:
+            finish_response_stream(ticket.id, error=f"Processing failed: {ticket.last_error}")
+
+
+@asynccontextmanager
+async def heartbeat(ticket_ids: List[UUID]):
+    """Renew the leases of tickets every third of TICKET_LEASE while the block runs."""
+
+    def renew_now():
+        with SessionLocal() as db:
+            renew_leases(db, ticket_ids, lease_until())
+
+    async def renew():
+        while True:
+            await asyncio.sleep(settings.TICKET_LEASE / 3)
+            try:
+                # off the event loop, the db calls block
+                await asyncio.to_thread(renew_now)
+            except Exception as e:
+                logger.warning(f"Renew leases of {len(ticket_ids)} tickets failed: {e}")
+
+    task = asyncio.create_task(renew())
+    try:
+        yield
+    finally:
+        task.cancel()
+
+
+def retry_expired_leases(now: datetime, limit: int) -> int:
+    """Count an attempt as failed for the tickets whose lease expired."""
+    db = SessionLocal(expire_on_commit=False)
+    try:
+        with db.begin():
+            tickets = get_expired_leases(db, now, limit)
+            for ticket in tickets:
+                fail_attempt(ticket, f"Processing lease expired at {ticket.lease_expires_at}")
+        for ticket in tickets:
+            publish_ticket_done(ticket.id, cache_ticket(ticket))
+        finish_failed_streams(tickets)
+        record_failed(tickets)
+    finally:
+        db.close()
+    if tickets:
+        logger.warning(f"Retry {len(tickets)} tickets whose processing lease expired")
+    return len(tickets)
+
+
+def enqueue_claimed(db: Session, ticket_ids: List[UUID]):
+    """
+    Enqueue claimed tickets for batch processing, except the ones classified before their
+    response failed, only their response job is enqueued again.
+    """
+    priorities = get_priorities(db, ticket_ids)
+    classified = [(ticket_id, priority) for ticket_id, priority in priorities.items()
+                  if priority is not None]
+    if classified:
+        enqueue_responses(classified)
+    unclassified = [ticket_id for ticket_id in ticket_ids if priorities.get(ticket_id) is None]
+    if unclassified:
+        process_tickets(unclassified)
+
+
+def enqueue_due_retries(now: datetime, limit: int) -> int:
+    """Claim the tickets whose retry is due and enqueue them for processing."""
+    db = SessionLocal()
+    try:
+        ticket_ids = claim_due_retries(db, now, limit, lease_until(settings.TICKET_QUEUED_LEASE))
+        if not ticket_ids:
+            return 0
+        invalidate_tickets(ticket_ids)
+        record_transition(TicketStatus.SUBMITTED, TicketStatus.PROCESSING, len(ticket_ids))
+        try:
+            enqueue_claimed(db, ticket_ids)
+        except Exception as e:
+            logger.error(f"Enqueue {len(ticket_ids)} due retries failed: {e}")
+            released = release_tickets(db, ticket_ids)
+            invalidate_tickets(ticket_ids)
+            record_transition(TicketStatus.PROCESSING, TicketStatus.SUBMITTED, released)
+            raise
+    finally:
+        db.close()
+    logger.info(f"Enqueued {len(ticket_ids)} due retries")
+    return len(ticket_ids)
+
+
+def sweep_tickets(limit: int = None) -> Tuple[int, int]:
+    """Retry expired leases and enqueue due retries, returns both numbers of tickets."""
+    limit = limit or settings.SWEEP_BATCH_SIZE
+    now = datetime.utcnow()
+    return retry_expired_leases(now, limit), enqueue_due_retries(now, limit)
+
+
+def main():
+    expired, retried = sweep_tickets()
+    logger.info(f"Swept {expired} expired leases and {retried} due retries")
+
+
+if __name__ == "__main__":
+    main()
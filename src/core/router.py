@@ -0,0 +1,176 @@
+"""
+Routing of llm calls between providers. Every provider has a circuit breaker opened by a
+high error rate over its last calls, calls skip providers with an open circuit. A call still
+running past the p95 latency of its provider is hedged with the next provider and the first
+success wins, a failed call fails over to the next provider right away.
+Health is tracked per process, each worker learns it from its own calls.
+"""
+import asyncio
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple, TypeVar
+
+from langchain_core.exceptions import OutputParserException
+
+from src.core.metrics import LLM_ROUTED
+from src.core.utils import setup_logger
+
+logger = setup_logger(__name__)
+
+T = TypeVar("T")
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class NoProviderAvailable(Exception):
+    """Every provider of a call has an open circuit."""
+
+
+class CircuitBreaker:
+    """
+    Opens once at least error_rate of the last window calls failed(after min_calls calls),
+    then lets a single trial call through after cooldown seconds, which closes it on success
+    and opens it again on failure.
+    """
+
+    def __init__(self, window: int, error_rate: float, min_calls: int, cooldown: float):
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._outcomes: Deque[bool] = deque(maxlen=window)
+        self._trial = False
+
+    def allow(self) -> bool:
+        """Whether a call may be sent now, call it right before sending only."""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.cooldown:
+            self.state, self._trial = HALF_OPEN, False
+        if self.state == HALF_OPEN and not self._trial:
+            self._trial = True
+            return True
+        return self.state == CLOSED
+
+    def record(self, success: bool):
+        if self.state == HALF_OPEN:
+            if success:
+                self.state = CLOSED
+                self._outcomes.clear()
+            else:
+                self._open()
+            return
+        self._outcomes.append(success)
+        failures = self._outcomes.count(False)
+        if (self.state == CLOSED and len(self._outcomes) >= self.min_calls
+                and failures >= self.error_rate * len(self._outcomes)):
+            self._open()
+
+    def cancel(self):
+        """The allowed call was cancelled before its outcome was known."""
+        if self.state == HALF_OPEN:
+            self._trial = False
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self._outcomes.clear()
+
+
+class ProviderRouter:
+    """Hedges and fails over llm calls between providers, see the module docstring."""
+
+    def __init__(self, window: int, error_rate: float, min_calls: int, cooldown: float,
+                 hedge_min_samples: int, hedge_max_delay: float):
+        self.window = window
+        self.error_rate = error_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.hedge_min_samples = hedge_min_samples
+        self.hedge_max_delay = hedge_max_delay
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[Tuple[str, str], Deque[float]] = {}
+
+    def reset(self):
+        self.breakers.clear()
+        self._latencies.clear()
+
+    def breaker(self, provider: str) -> CircuitBreaker:
+        if provider not in self.breakers:
+            self.breakers[provider] = CircuitBreaker(self.window, self.error_rate,
+                                                     self.min_calls, self.cooldown)
+        return self.breakers[provider]
+
+    def _samples(self, provider: str, operation: str) -> Deque[float]:
+        key = (provider, operation)
+        if key not in self._latencies:
+            self._latencies[key] = deque(maxlen=self.window)
+        return self._latencies[key]
+
+    def hedge_delay(self, provider: str, operation: str) -> Optional[float]:
+        """p95 latency of the last calls, None until there are enough of them."""
+        samples = self._samples(provider, operation)
+        if len(samples) < self.hedge_min_samples:
+            return None
+        ordered = sorted(samples)
+        return min(ordered[int(len(ordered) * 0.95) - 1], self.hedge_max_delay)
+
+    def record_success(self, provider: str, operation: str, seconds: float):
+        self._samples(provider, operation).append(seconds)
+        self.breaker(provider).record(True)
+
+    def record_failure(self, provider: str, error: Exception):
+        # unparsable answers come from a healthy provider
+        self.breaker(provider).record(isinstance(error, OutputParserException))
+
+    async def call(self, operation: str, providers: List[str],
+                   call: Callable[[str], Awaitable[T]]) -> T:
+        """Call providers in order of preference until one succeeds, see the module docstring."""
+        remaining = list(providers)
+        pending: Dict[asyncio.Future, Tuple[str, float]] = {}
+        error: Optional[Exception] = None
+
+        def launch(reason: str) -> bool:
+            while remaining:
+                provider = remaining.pop(0)
+                if not self.breaker(provider).allow():
+                    LLM_ROUTED.labels(operation, provider, "circuit_open").inc()
+                    continue
+                if provider != providers[0]:
+                    LLM_ROUTED.labels(operation, provider, reason).inc()
+                    logger.info(f"Route {operation} call to {provider} by {reason}")
+                pending[asyncio.ensure_future(call(provider))] = (provider, time.perf_counter())
+                return True
+            return False
+
+        launch("failover")
+        try:
+            while pending:
+                delay = None
+                if remaining and len(pending) == 1:
+                    delay = self.hedge_delay(next(iter(pending.values()))[0], operation)
+                done, _ = await asyncio.wait(pending, timeout=delay,
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    launch("hedge")
+                    continue
+                for task in done:
+                    provider, start = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        logger.warning(f"{operation} call to {provider} failed: {e}")
+                        self.record_failure(provider, e)
+                        error = e
+                        continue
+                    self.record_success(provider, operation, time.perf_counter() - start)
+                    return result
+                if not pending:
+                    launch("failover")
+        finally:
+            for task, (provider, _) in pending.items():
+                task.cancel()
+                self.breaker(provider).cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        raise error or NoProviderAvailable(f"No llm provider available for {operation} among "
+                                           f"{providers}")
@@ -0,0 +1,249 @@
+"""
+Ticket statistics kept in redis hashes, incremented by the api and the workers as tickets
+are created and change status, so reading them costs the same whatever the tickets count.
+The counters are not updated in the database transactions, reconcile_stats rebuilds them
+from the live and archived tickets to fix any drift.
+"""
+from collections import defaultdict
+from itertools import chain
+from datetime import datetime, timedelta
+from typing import Dict, Iterable, Iterator, Optional, Union
+
+from redis.exceptions import RedisError
+from sqlalchemy import select
+
+from src.core.broker import redis_conn
+from src.core.metrics import PROCESS_BUCKETS
+from src.core.utils import setup_logger
+from src.models.database import SessionLocal
+from src.models.schemas import TicketStatus
+from src.models.ticket import TABLES, Ticket
+
+logger = setup_logger(__name__)
+
+STATS_KEY = "ticket-stats"
+LATENCY_KEY = "ticket-stats:latency"
+# rollup name: (bucket size, key time format, retention)
+ROLLUPS = {
+    "minute": (timedelta(minutes=1), "%Y%m%d%H%M", timedelta(days=1)),
+    "hour": (timedelta(hours=1), "%Y%m%d%H", timedelta(days=30)),
+}
+LATENCY_BUCKETS = [str(bucket) for bucket in PROCESS_BUCKETS] + ["+Inf"]
+
+Increments = Dict[str, Dict[str, Union[int, float]]]
+
+
+def _bucket_start(at: datetime, size: timedelta) -> datetime:
+    return datetime.min + (at - datetime.min) // size * size
+
+
+def _rollup_key(name: str, start: datetime) -> str:
+    return f"ticket-stats:{name}:{start.strftime(ROLLUPS[name][1])}"
+
+
+def _rollup_keys(at: datetime, since: Optional[Dict[str, datetime]] = None) -> Iterator[str]:
+    """Keys of the rollup buckets of a time, those starting before since of their rollup skipped."""
+    for name, (size, _, _) in ROLLUPS.items():
+        start = _bucket_start(at, size)
+        if since is None or start > since[name]:
+            yield _rollup_key(name, start)
+
+
+def _created(increments: Increments, count: int, created_at: datetime,
+             since: Optional[Dict[str, datetime]] = None):
+    increments[STATS_KEY]["total"] += count
+    increments[STATS_KEY][f"status:{TicketStatus.SUBMITTED.value}"] += count
+    for key in _rollup_keys(created_at, since):
+        increments[key]["created"] += count
+
+
+def _transition(increments: Increments, old: TicketStatus, new: TicketStatus, count: int = 1):
+    if old != new and count:
+        increments[STATS_KEY][f"status:{old.value}"] -= count
+        increments[STATS_KEY][f"status:{new.value}"] += count
+
+
+def _processed(increments: Increments, ticket: Ticket,
+               since: Optional[Dict[str, datetime]] = None):
+    """Ticket moved from processing to processed."""
+    _transition(increments, TicketStatus.PROCESSING, TicketStatus.PROCESSED)
+    increments[STATS_KEY][f"category:{ticket.category.value}"] += 1
+    increments[STATS_KEY][f"priority:{ticket.priority.value}"] += 1
+    seconds = (ticket.processed_at - ticket.created_at).total_seconds()
+    bucket = next((bucket for bucket, bound in zip(LATENCY_BUCKETS, PROCESS_BUCKETS)
+                   if seconds <= bound), "+Inf")
+    increments[LATENCY_KEY][bucket] += 1
+    increments[LATENCY_KEY]["count"] += 1
+    increments[LATENCY_KEY]["sum"] += seconds
+    for key in _rollup_keys(ticket.processed_at, since):
+        increments[key]["processed"] += 1
+        increments[key]["processing_seconds"] += seconds
+
+
+def _new_increments() -> Increments:
+    return defaultdict(lambda: defaultdict(int))
+
+
+def _expire_at(key: str) -> Optional[datetime]:
+    """Expiry time of a rollup key, None for the other keys."""
+    parts = key.split(":")
+    if len(parts) != 3 or parts[1] not in ROLLUPS:
+        return None
+    _, name, start = parts
+    size, time_format, retention = ROLLUPS[name]
+    return datetime.strptime(start, time_format) + size + retention
+
+
+def _apply(increments: Increments):
+    try:
+        with redis_conn.pipeline(transaction=False) as pipe:
+            for key, fields in increments.items():
+                for field, amount in fields.items():
+                    if isinstance(amount, float):
+                        pipe.hincrbyfloat(key, field, amount)
+                    elif amount:
+                        pipe.hincrby(key, field, amount)
+                expire_at = _expire_at(key)
+                if expire_at is not None:
+                    pipe.expireat(key, expire_at)
+            pipe.execute()
+    except RedisError as e:
+        logger.warning(f"Update ticket stats failed, they are fixed on next reconcile: {e}")
+
+
+def record_created(count: int = 1, created_at: Optional[datetime] = None):
+    increments = _new_increments()
+    _created(increments, count, created_at or datetime.utcnow())
+    _apply(increments)
+
+
+def record_transition(old: TicketStatus, new: TicketStatus, count: int = 1):
+    increments = _new_increments()
+    _transition(increments, old, new, count)
+    _apply(increments)
+
+
+def record_processed(tickets: Iterable[Ticket]):
+    increments = _new_increments()
+    for ticket in tickets:
+        _processed(increments, ticket)
+    _apply(increments)
+
+
+def percentile(histogram: Dict[str, float], p: float) -> Optional[float]:
+    """Estimate the p percentile of a latency histogram, interpolating within buckets."""
+    count = histogram.get("count", 0)
+    if not count:
+        return None
+    rank = p / 100 * count
+    cumulative, lower = 0, 0.0
+    for bucket, upper in zip(LATENCY_BUCKETS, PROCESS_BUCKETS):
+        in_bucket = histogram.get(bucket, 0)
+        if in_bucket and cumulative + in_bucket >= rank:
+            return lower + (upper - lower) * (rank - cumulative) / in_bucket
+        cumulative += in_bucket
+        lower = upper
+    # beyond the last bound, the best estimate is the last bound itself
+    return PROCESS_BUCKETS[-1]
+
+
+def _numbers(raw: Dict[bytes, bytes]) -> Dict[str, float]:
+    return {field.decode(): float(value) for field, value in raw.items()}
+
+
+def get_stats(now: Optional[datetime] = None, minutes: int = 60, hours: int = 24) -> dict:
+    """
+    Read the counters, latency percentiles and the last minutes and hours rollups
+    in one redis round trip.
+    """
+    now = now or datetime.utcnow()
+    windows = {"minute": minutes, "hour": hours}
+    starts = {name: [_bucket_start(now, ROLLUPS[name][0]) - ROLLUPS[name][0] * i
+                     for i in reversed(range(windows[name]))] for name in ROLLUPS}
+    with redis_conn.pipeline(transaction=False) as pipe:
+        pipe.hgetall(STATS_KEY)
+        pipe.hgetall(LATENCY_KEY)
+        for name in ROLLUPS:
+            for start in starts[name]:
+                pipe.hgetall(_rollup_key(name, start))
+        counters, latency, *rollups = [_numbers(raw) for raw in pipe.execute()]
+
+    grouped = defaultdict(dict)
+    for field, value in counters.items():
+        if ":" in field:
+            group, name = field.split(":", 1)
+            grouped[group][name] = int(value)
+    stats = {"total": int(counters.get("total", 0)),
+             "by_status": grouped["status"],
+             "by_category": grouped["category"],
+             "by_priority": grouped["priority"],
+             "processing_seconds": {
+                 "count": int(latency.get("count", 0)),
+                 "mean": latency["sum"] / latency["count"] if latency.get("count") else None,
+                 "p50": percentile(latency, 50),
+                 "p95": percentile(latency, 95),
+                 "p99": percentile(latency, 99)}}
+    for name in ROLLUPS:
+        buckets, rollups = rollups[:len(starts[name])], rollups[len(starts[name]):]
+        stats[f"per_{name}"] = [
+            {"start": start,
+             "created": int(bucket.get("created", 0)),
+             "processed": int(bucket.get("processed", 0)),
+             "mean_processing_seconds": (bucket["processing_seconds"] / bucket["processed"]
+                                         if bucket.get("processed") else None)}
+            for start, bucket in zip(starts[name], buckets)]
+    return stats
+
+
+def aggregate(rows: Iterable, now: datetime) -> Increments:
+    """
+    Stats of ticket rows as if each ticket went through every status change up to its own.
+    Rollup buckets past their retention are skipped, they would expire right away.
+    """
+    since = {name: now - size - retention for name, (size, _, retention) in ROLLUPS.items()}
+    increments = _new_increments()
+    for row in rows:
+        status = row.status or TicketStatus.SUBMITTED
+        _created(increments, 1, row.created_at, since)
+        if status == TicketStatus.PROCESSED:
+            _transition(increments, TicketStatus.SUBMITTED, TicketStatus.PROCESSING)
+            _processed(increments, row, since)
+        else:
+            _transition(increments, TicketStatus.SUBMITTED, status)
+    return increments
+
+
+def reconcile_stats(chunk_size: int = 10000) -> int:
+    """
+    Rebuild all the stats from the tickets and tickets_archive tables, returns the number of
+    tickets counted.
+    """
+    now = datetime.utcnow()
+    statements = [select(table.c.status, table.c.category, table.c.priority,
+                         table.c.created_at, table.c.processed_at)
+                  .execution_options(yield_per=chunk_size) for table in TABLES]
+    db = SessionLocal()
+    try:
+        stats = aggregate(chain.from_iterable(db.execute(statement) for statement in statements),
+                          now)
+    finally:
+        db.close()
+
+    with redis_conn.pipeline(transaction=True) as pipe:
+        old_keys = list(redis_conn.scan_iter(match="ticket-stats*", count=1000))
+        if old_keys:
+            pipe.delete(*old_keys)
+        for key, fields in stats.items():
+            if fields:
+                pipe.hset(key, mapping=fields)
+            expire_at = _expire_at(key)
+            if expire_at is not None:
+                pipe.expireat(key, expire_at)
+        pipe.execute()
+    total = int(stats[STATS_KEY]["total"]) if STATS_KEY in stats else 0
+    logger.info(f"Reconciled ticket stats of {total} tickets")
+    return total
+
+
+if __name__ == "__main__":
+    reconcile_stats()
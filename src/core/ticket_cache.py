@@ -0,0 +1,79 @@
+import asyncio
+import hashlib
+import json
+from datetime import timezone
+from email.utils import format_datetime
+from typing import Iterable, NamedTuple, Optional
+from uuid import UUID
+
+from src.core.broker import redis_conn
+from src.core.cache import TwoTierCache
+from src.core.config import settings
+from src.models import schemas
+from src.models.schemas import DONE_STATUSES, TicketStatus
+from src.models.ticket import Ticket
+
+# api processes keep entries for TICKET_CACHE_LOCAL_TTL seconds only, the workers update
+# the redis tier on every status change and are not able to reach the other processes
+ticket_cache = TwoTierCache("ticket",
+                            settings.TICKET_CACHE_SIZE,
+                            settings.TICKET_CACHE_TTL,
+                            redis_conn,
+                            local_ttl=settings.TICKET_CACHE_LOCAL_TTL)
+
+
+class CachedTicket(NamedTuple):
+    """Serialized ticket with its http validators."""
+    body: str
+    etag: str
+    last_modified: str
+    final: bool
+    # processed or failed, entries cached before it was added aren't
+    done: bool = False
+
+
+def ticket_cache_key(ticket_id: UUID) -> str:
+    return f"ticket-cache:{ticket_id}"
+
+
+def serialize_ticket(ticket: Ticket) -> CachedTicket:
+    body = schemas.Ticket.model_validate(ticket).model_dump_json()
+    modified = (ticket.processed_at or ticket.created_at).replace(tzinfo=timezone.utc)
+    return CachedTicket(body=body,
+                        etag=f'"{hashlib.sha1(body.encode()).hexdigest()}"',
+                        last_modified=format_datetime(modified, usegmt=True),
+                        final=ticket.status == TicketStatus.PROCESSED,
+                        done=ticket.status in DONE_STATUSES)
+
+
+def get_cached_ticket(ticket_id: UUID) -> Optional[CachedTicket]:
+    if not settings.TICKET_CACHE_ENABLED:
+        return None
+    value = ticket_cache.get(ticket_cache_key(ticket_id))
+    return CachedTicket(*json.loads(value)) if value is not None else None
+
+
+async def get_cached_ticket_async(ticket_id: UUID) -> Optional[CachedTicket]:
+    """Same as get_cached_ticket, only goes off the event loop when it has to ask redis."""
+    if not settings.TICKET_CACHE_ENABLED:
+        return None
+    value = ticket_cache.get_local(ticket_cache_key(ticket_id))
+    if value is not None:
+        return CachedTicket(*json.loads(value))
+    return await asyncio.to_thread(get_cached_ticket, ticket_id)
+
+
+def cache_ticket(ticket: Ticket, nx: bool = False) -> CachedTicket:
+    """
+    Serialize and cache ticket. Read-through fills pass nx so that a ticket read before a
+    status change never overwrites the entry written by the worker making the change.
+    """
+    cached = serialize_ticket(ticket)
+    if settings.TICKET_CACHE_ENABLED:
+        ticket_cache.set(ticket_cache_key(ticket.id), json.dumps(cached), nx=nx)
+    return cached
+
+
+def invalidate_tickets(ticket_ids: Iterable[UUID]):
+    if settings.TICKET_CACHE_ENABLED:
+        ticket_cache.delete(*(ticket_cache_key(ticket_id) for ticket_id in ticket_ids))
@@ -0,0 +1,106 @@
+"""
+Done events of tickets. Workers publish a ticket on a redis channel once it's done, processed
+or dead lettered as failed, serialized as it's cached. Every api process subscribes to the
+channel with a single connection shared by all the requests waiting for tickets to be done.
+Events are best effort, waiters missing one get the ticket as it is once their wait is over.
+"""
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Optional, Set
+from uuid import UUID
+
+from redis import asyncio as aioredis
+from redis.exceptions import RedisError
+
+from src.core.broker import redis_conn
+from src.core.config import settings
+from src.core.ticket_cache import CachedTicket
+from src.core.utils import setup_logger
+
+logger = setup_logger(__name__)
+
+TICKET_DONE_CHANNEL = "ticket-done"
+
+
+def publish_ticket_done(ticket_id: UUID, cached: CachedTicket):
+    """Publish the done event of a ticket, nothing is published if it's not done."""
+    if not cached.done:
+        return
+    try:
+        redis_conn.publish(TICKET_DONE_CHANNEL, json.dumps([str(ticket_id), *cached]))
+    except RedisError as e:
+        logger.warning(f"Publish done event of ticket {ticket_id} failed: {e}")
+
+
+class TicketWaiter:
+    """Resolves the requests waiting for tickets from one subscription per process."""
+
+    def __init__(self, redis_url: str, channel: str = TICKET_DONE_CHANNEL):
+        self.redis_url = redis_url
+        self.channel = channel
+        self._waiters: Dict[UUID, Set[asyncio.Future]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._subscribed: Optional[asyncio.Event] = None
+
+    @property
+    def waiting_count(self) -> int:
+        return sum(len(futures) for futures in self._waiters.values())
+
+    @asynccontextmanager
+    async def waiting(self, ticket_id: UUID) -> AsyncIterator[asyncio.Future]:
+        """
+        Future resolved with the cached ticket once it's done. It's yielded once subscribed,
+        so that tickets read after that can't be done without their event being received.
+        """
+        self._start()
+        future = asyncio.get_running_loop().create_future()
+        self._waiters.setdefault(ticket_id, set()).add(future)
+        try:
+            await self._subscribed.wait()
+            yield future
+        finally:
+            futures = self._waiters.get(ticket_id, set())
+            futures.discard(future)
+            if not futures:
+                self._waiters.pop(ticket_id, None)
+
+    def _start(self):
+        # started lazily by the first waiter, again if the event loop changed
+        loop = asyncio.get_running_loop()
+        if self._task is None or self._task.done() or self._task.get_loop() is not loop:
+            self._subscribed = asyncio.Event()
+            self._task = loop.create_task(self._listen())
+
+    async def _listen(self):
+        while True:
+            client = aioredis.Redis.from_url(self.redis_url)
+            try:
+                async with client.pubsub() as pubsub:
+                    await pubsub.subscribe(self.channel)
+                    self._subscribed.set()
+                    logger.info(f"Subscribed to {self.channel} events")
+                    async for message in pubsub.listen():
+                        if message["type"] == "message":
+                            self._dispatch(message["data"])
+            except RedisError as e:
+                logger.warning(f"Subscription to {self.channel} events failed, retry: {e}")
+            finally:
+                self._subscribed.clear()
+                await client.aclose()
+            await asyncio.sleep(1.0)
+
+    def _dispatch(self, data: bytes):
+        try:
+            ticket_id, *fields = json.loads(data)
+            cached = CachedTicket(*fields)
+            futures = self._waiters.get(UUID(ticket_id), ())
+        except (ValueError, TypeError) as e:
+            logger.warning(f"Invalid {self.channel} event {data!r}: {e}")
+            return
+        for future in futures:
+            if not future.done():
+                future.set_result(cached)
+
+
+ticket_waiter = TicketWaiter(settings.REDIS_URL)
@@ -1,73 +1,309 @@
 import asyncio
 from datetime import datetime
-from typing import List
+from typing import Dict, List, Optional
 from uuid import UUID
 
-from redis import Redis
-from rq import Queue
-from rq.job import Job
-from src.core.ai import categorize_prioritize_ticket, craft_ticket_response
+from rq import Worker, get_current_job
+from sqlalchemy.orm import Session
+
+from src.core.ai import categorize_prioritize_ticket, categorize_prioritize_tickets
+from src.core.ai import craft_ticket_response, take_ticket_tokens
+from src.core.broker import redis_conn, queue  # noqa: F401
+from src.core.classifier import get_local_classifier
 from src.core.config import settings
+from src.core.jobs import enqueue_responses
+from src.core.metrics import TICKET_PROCESS_SECONDS
+from src.core.response_stream import finish_response_stream, reset_response_stream
+from src.core.retry import enqueue_claimed, fail_attempt, finish_failed_streams, heartbeat
+from src.core.retry import lease_until, record_failed
+from src.core.stats import record_processed, record_transition
+from src.core.ticket_cache import cache_ticket, invalidate_tickets
+from src.core.ticket_events import publish_ticket_done
 from src.core.utils import setup_logger
 from src.models.database import SessionLocal
-from src.models.schemas import TicketStatus
-from src.models.ticket import get_ticket
+from src.models.schemas import TicketClassified, TicketStatus
+from src.models.ticket import Ticket, get_ticket, claim_ticket, claim_tickets, claim_unclassified
+from src.models.ticket import release_tickets
 
-redis_conn = Redis.from_url(settings.REDIS_URL)
-queue = Queue(connection=redis_conn)
 logger = setup_logger(__name__)
 
 
+def add_tokens(ticket: Ticket):
+    """Add the llm tokens spent on the ticket since last saved to its token counts."""
+    input_tokens, output_tokens = take_ticket_tokens(ticket.id)
+    if input_tokens or output_tokens:
+        ticket.input_tokens = (ticket.input_tokens or 0) + input_tokens
+        ticket.output_tokens = (ticket.output_tokens or 0) + output_tokens
+
+
+def set_classified(ticket: Ticket, ticket_classified: TicketClassified):
+    add_tokens(ticket)
+    ticket.category = ticket_classified.category
+    ticket.category_confidence = ticket_classified.category_confidence
+    ticket.priority = ticket_classified.priority
+    ticket.priority_confidence = ticket_classified.priority_confidence
+    ticket.classified_by = ticket_classified.classified_by
+
+
+def set_processed(ticket: Ticket, response: str):
+    add_tokens(ticket)
+    ticket.processed_at = datetime.utcnow()
+    ticket.initial_response = response
+    ticket.status = TicketStatus.PROCESSED
+    ticket.lease_expires_at = None
+    if ticket.created_at:
+        TICKET_PROCESS_SECONDS.labels(ticket.priority.value).observe(
+            (ticket.processed_at - ticket.created_at).total_seconds())
+
+
+def _revert(db: Session, tickets: List[Ticket], error: str):
+    """
+    Revert tickets being processed to submitted status with their retry scheduled after
+    a backoff, or to failed once they ran out of attempts.
+    """
+    with db.begin():
+        for ticket in tickets:
+            add_tokens(ticket)
+            fail_attempt(ticket, error)
+    for ticket in tickets:
+        publish_ticket_done(ticket.id, cache_ticket(ticket))
+    finish_failed_streams(tickets)
+    record_failed(tickets)
+
+
+# the db and redis calls of the processing stages below block, the coroutines run them in
+# threads so that the other jobs of the async worker keep going meanwhile
+
+def _claim_ticket(db: Session, ticket_id: UUID) -> Optional[Ticket]:
+    with db.begin():
+        # the ticket may have been claimed by a batch while this job was queued
+        ticket = claim_ticket(db, ticket_id, lease_until())
+        if ticket is None:
+            return None
+        if ticket.priority is not None:
+            ticket.lease_expires_at = lease_until(settings.TICKET_QUEUED_LEASE)
+    cache_ticket(ticket)
+    record_transition(TicketStatus.SUBMITTED, TicketStatus.PROCESSING)
+    return ticket
+
+
+def _claim_batch(db: Session, ticket_ids: List[UUID]) -> List[Ticket]:
+    with db.begin():
+        tickets = claim_unclassified(db, ticket_ids, lease_until())
+    for ticket in tickets:
+        cache_ticket(ticket)
+    return tickets
+
+
+def _save_classified(db: Session,
+                     tickets: List[Ticket],
+                     classified: Dict[UUID, TicketClassified]) -> List[Ticket]:
+    """Save the classified tickets, which wait for their response job then, and return them."""
+    done = [ticket for ticket in tickets if ticket.id in classified]
+    with db.begin():
+        for ticket in done:
+            set_classified(ticket, classified[ticket.id])
+            ticket.lease_expires_at = lease_until(settings.TICKET_QUEUED_LEASE)
+    for ticket in done:
+        cache_ticket(ticket)
+    return done
+
+
+def _start_response(db: Session, ticket_id: UUID) -> Optional[Ticket]:
+    with db.begin():
+        ticket = get_ticket(db, ticket_id)
+        if ticket is None or ticket.status != TicketStatus.PROCESSING or ticket.priority is None:
+            return None
+        ticket.lease_expires_at = lease_until()
+    reset_response_stream(ticket_id)
+    return ticket
+
+
+def _save_processed(db: Session, ticket: Ticket, response: str):
+    with db.begin():
+        set_processed(ticket, response)
+
+
+def _publish_processed(ticket: Ticket, response: str):
+    publish_ticket_done(ticket.id, cache_ticket(ticket))
+    finish_response_stream(ticket.id, response)
+    record_processed([ticket])
+
+
+def _revert_response(db: Session, ticket: Ticket, error: str):
+    _revert(db, [ticket], error)
+    if ticket.status == TicketStatus.SUBMITTED:
+        finish_response_stream(ticket.id, error="Response failed, ticket will be retried")
+
+
 async def process_ticket(ticket_id: UUID):
+    """
+    First stage of processing, classify the ticket and queue its response generation
+    on the queue of its priority. The classification is saved right away, a ticket classified
+    before its response failed only gets its response job queued again.
+    """
     logger.info(f"Processing ticket {ticket_id}")
-    db = SessionLocal()
+    # keep ticket loaded after commits, llm calls run outside of any transaction
+    # so that no db connection is held while waiting for the providers
+    db = SessionLocal(expire_on_commit=False)
+    ticket = None
     try:
-        with db.begin():
-            ticket = get_ticket(db, ticket_id)
-            ticket.status = TicketStatus.PROCESSING
-        logger.info(f"Set ticket {ticket_id} status to PROCESSING")
-
-        with db.begin():
-            classify_ticket = categorize_prioritize_ticket(ticket)
-            respond_ticket = craft_ticket_response(ticket)
-            ticket_classified, response = await asyncio.gather(classify_ticket, respond_ticket)
-            ticket.category = ticket_classified.category
-            ticket.category_confidence = ticket_classified.category_confidence
-            ticket.priority = ticket_classified.priority
-            ticket.priority_confidence = ticket_classified.priority_confidence
-            ticket.processed_at = datetime.utcnow()
-            ticket.initial_response = response
-            ticket.status = TicketStatus.PROCESSED
+        ticket = await asyncio.to_thread(_claim_ticket, db, ticket_id)
+        if ticket is None:
+            logger.info(f"Skip ticket {ticket_id}, not found or not submitted")
+            return
+        logger.info(f"Set ticket {ticket_id} status to PROCESSING, attempt {ticket.attempts}")
+        if ticket.priority is not None:
+            await asyncio.to_thread(enqueue_responses, [(ticket.id, ticket.priority)])
+            logger.info(f"Ticket {ticket_id} already classified, queued for its response")
+            return
 
-        logger.info(f"Process ticket {ticket_id} done")
+        async with heartbeat([ticket.id]):
+            ticket_classified = await categorize_prioritize_ticket(ticket)
+        await asyncio.to_thread(_save_classified, db, [ticket], {ticket.id: ticket_classified})
+        await asyncio.to_thread(enqueue_responses, [(ticket.id, ticket.priority)])
+
+        logger.info(f"Classify ticket {ticket_id} done, queued for {ticket.priority.value} "
+                    f"priority response")
 
     except Exception as e:
+        if ticket is None:
+            raise
         try:
-            # revert ticket status
-            with db.begin():
-                ticket.status = TicketStatus.SUBMITTED
-            logger.info(f"Revert ticket {ticket_id} to submitted status")
+            await asyncio.to_thread(_revert, db, [ticket], f"Process failed: {e}")
+            logger.info(f"Revert ticket {ticket_id} to {ticket.status.value} status")
         except Exception as e:
             logger.error(f"Failed to revert ticket {ticket_id} to submitted status: {e}")
             raise
         logger.error(f"Unexpected error while processing ticket {ticket_id}: {e}")
         raise
     finally:
-        db.close()
+        await asyncio.to_thread(db.close)
+
+
+async def process_ticket_batch(ticket_ids: List[UUID]):
+    """
+    First stage of processing for a batch of tickets, classifying them with one llm call
+    per batch and queuing their response generation by priority. The tickets are claimed for
+    the batch beforehand, the ones classified meanwhile are skipped.
+    Tickets failed to be classified are reverted to submitted status.
+    """
+    logger.info(f"Processing batch of {len(ticket_ids)} tickets")
+    db = SessionLocal(expire_on_commit=False)
+    try:
+        tickets = await asyncio.to_thread(_claim_batch, db, ticket_ids)
+        if not tickets:
+            logger.info("Skip batch, no ticket left to classify")
+            return
+        logger.info(f"Claimed {len(tickets)} of {len(ticket_ids)} tickets in batch")
+
+        try:
+            async with heartbeat([ticket.id for ticket in tickets]):
+                classified = await categorize_prioritize_tickets(tickets)
+        except Exception as e:
+            await asyncio.to_thread(_revert, db, tickets, f"Classify failed: {e}")
+            logger.error(f"Revert {len(tickets)} tickets in batch for retry, classify failed: {e}")
+            raise
+        done = await asyncio.to_thread(_save_classified, db, tickets, classified)
+        failed = [ticket for ticket in tickets if ticket.id not in classified]
+        error = "Classify failed in batch"
+        try:
+            await asyncio.to_thread(enqueue_responses,
+                                    [(ticket.id, ticket.priority) for ticket in done])
+        except Exception as e:
+            logger.error(f"Enqueue responses of {len(done)} tickets failed: {e}")
+            failed, error = tickets, f"Enqueue response failed: {e}"
+        if failed:
+            await asyncio.to_thread(_revert, db, failed, error)
+            logger.error(f"Revert {len(failed)} of {len(tickets)} tickets in batch for retry")
+        logger.info(f"Classify batch of {len(tickets)} tickets done")
+    finally:
+        await asyncio.to_thread(db.close)
+
+
+async def respond_ticket(ticket_id: UUID):
+    """
+    Second stage of processing, generate the response of a classified ticket. A failed response
+    keeps the classification, the retry of the ticket only generates its response again.
+    """
+    logger.info(f"Responding ticket {ticket_id}")
+    db = SessionLocal(expire_on_commit=False)
+    try:
+        ticket = await asyncio.to_thread(_start_response, db, ticket_id)
+        if ticket is None:
+            logger.info(f"Skip ticket {ticket_id}, not found or not waiting for a response")
+            return
+
+        try:
+            async with heartbeat([ticket.id]):
+                response = await craft_ticket_response(ticket)
+            await asyncio.to_thread(_save_processed, db, ticket, response)
+        except Exception as e:
+            logger.error(f"Unexpected error while responding ticket {ticket_id}: {e}")
+            await asyncio.to_thread(_revert_response, db, ticket, f"Respond failed: {e}")
+            logger.info(f"Revert ticket {ticket_id} to {ticket.status.value} status")
+            raise
+        await asyncio.to_thread(_publish_processed, ticket, response)
+        logger.info(f"Process ticket {ticket_id} done")
+    finally:
+        await asyncio.to_thread(db.close)
+
+
+class TicketWorker(Worker):
+    """
+    rq worker loading the local classifier before forking the work horse of every job, so that
+    it's loaded once per worker and shared by the jobs instead of unpickled by each of them.
+    Start it by `rq worker -w src.core.worker.TicketWorker`.
+    """
+
+    def work(self, *args, **kwargs):
+        get_local_classifier()
+        return super().work(*args, **kwargs)
 
 
 def process_ticket_job(ticket_id: UUID):
     asyncio.run(process_ticket(ticket_id))
 
 
-def enqueue_ticket(ticket_id: UUID) -> Job:
-    return queue.enqueue(process_ticket_job, ticket_id)
+def process_ticket_batch_job(ticket_ids: List[UUID]):
+    asyncio.run(process_ticket_batch(ticket_ids))
 
 
-def process_tickets(tickets: List[UUID]):
-    for ticket in tickets:
-        enqueue_ticket(ticket)
+def respond_ticket_job(ticket_id: UUID):
+    asyncio.run(respond_ticket(ticket_id))
 
 
-def enqueue_tickets(tickets: List[UUID]) -> Job:
-    return queue.enqueue(process_tickets, tickets)
+def claim_and_process_tickets() -> int:
+    """
+    Claim submitted tickets chunk by chunk and enqueue them for processing,
+    the number of claimed tickets is reported in the job meta as progress.
+    """
+    job = get_current_job()
+    db = SessionLocal()
+    claimed, after = 0, None
+    try:
+        while True:
+            ticket_ids, after = claim_tickets(db, settings.CLAIM_CHUNK_SIZE, after,
+                                              lease_until(settings.TICKET_QUEUED_LEASE))
+            if after is None:
+                break
+            if not ticket_ids:
+                continue
+            invalidate_tickets(ticket_ids)
+            record_transition(TicketStatus.SUBMITTED, TicketStatus.PROCESSING, len(ticket_ids))
+            try:
+                enqueue_claimed(db, ticket_ids)
+            except Exception as e:
+                logger.error(f"Enqueue {len(ticket_ids)} claimed tickets failed: {e}")
+                released = release_tickets(db, ticket_ids)
+                invalidate_tickets(ticket_ids)
+                record_transition(TicketStatus.PROCESSING, TicketStatus.SUBMITTED, released)
+                raise
+            claimed += len(ticket_ids)
+            if job is not None:
+                job.meta["claimed"] = claimed
+                job.save_meta()
+    finally:
+        db.close()
+    logger.info(f"Claimed and enqueued {claimed} tickets")
+    return claimed
@@ -1,10 +1,15 @@
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 from src.api.v1 import ticket_api
+from src.core.metrics import MetricsMiddleware
 from src.models.database import Base, engine
+from src.models.search import create_search_index
 
 # create tickets db
 Base.metadata.create_all(bind=engine)
+with engine.begin() as conn:
+    create_search_index(conn)
 
 app = FastAPI(title="ticket system api",
               description="Rest api for create, query and process tickets.",
@@ -13,6 +18,7 @@ app = FastAPI(title="ticket system api",
               docs_url="/docs",  # swagger UI
               redoc_url="/redoc")  # ReDoc
 app.include_router(ticket_api.router)
+app.add_middleware(MetricsMiddleware)
 
 
 @app.get("/ping")
@@ -23,6 +29,14 @@ def root_ping():
     return {"status": "ok", "message": "I'm up!"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """
+    Metrics in prometheus text format.
+    """
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -1,16 +1,71 @@
-from sqlalchemy import create_engine
+from typing import Dict
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import URL, make_url
 from sqlalchemy.exc import SQLAlchemyError
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base, Session
 
 from src.core.config import settings
+from src.core.metrics import instrument_engine
 from src.core.utils import setup_logger
 
 logger = setup_logger(__name__)
 
+# both engines are derived from DATABASE_URL whichever driver it names, the api reads through
+# the async one, workers and scripts use the sync one
+SYNC_DRIVERS = {"sqlite": "sqlite", "postgresql": "postgresql+psycopg2"}
+ASYNC_DRIVERS = {"sqlite": "sqlite+aiosqlite", "postgresql": "postgresql+asyncpg"}
+
+# WAL lets readers run alongside the writer and only fsyncs at checkpoints with synchronous
+# NORMAL, busy_timeout makes concurrent writers wait for the lock instead of failing
+SQLITE_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-65536",
+]
+
+
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    for pragma in SQLITE_PRAGMAS:
+        cursor.execute(pragma)
+    cursor.close()
+
+
+def _with_driver(url: str, drivers: Dict[str, str]) -> URL:
+    url = make_url(url)
+    return url.set(drivername=drivers.get(url.get_backend_name(), url.drivername))
+
+
+def sync_database_url(url: str) -> str:
+    """Switch a database url to the sync driver of its dialect."""
+    return _with_driver(url, SYNC_DRIVERS).render_as_string(hide_password=False)
+
+
+def async_database_url(url: str) -> str:
+    """Switch a database url to the async driver of its dialect."""
+    return _with_driver(url, ASYNC_DRIVERS).render_as_string(hide_password=False)
+
+
+def connect_args(url: str) -> dict:
+    # sqlite connections of the sync engine are used by the api threadpool and worker threads
+    return {"check_same_thread": False} if make_url(url).get_backend_name() == "sqlite" else {}
+
+
 try:
-    engine = create_engine(settings.DATABASE_URL, connect_args={"check_same_thread": False})
+    engine = create_engine(sync_database_url(settings.DATABASE_URL),
+                           connect_args=connect_args(settings.DATABASE_URL))
     SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    async_engine = create_async_engine(async_database_url(settings.DATABASE_URL))
+    AsyncSessionLocal = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
     Base = declarative_base()
+    for sync_engine in (engine, async_engine.sync_engine):
+        if sync_engine.dialect.name == "sqlite":
+            event.listen(sync_engine, "connect", set_sqlite_pragmas)
+        instrument_engine(sync_engine)
 except SQLAlchemyError as e:
     logger.error(f"Error connecting to the database: {e}")
     raise
@@ -25,3 +80,12 @@ def get_db() -> Session:
         raise
     finally:
         db.close()
+
+
+async def get_async_db() -> AsyncSession:
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+        except SQLAlchemyError as e:
+            logger.error(f"Database error: {e}")
+            raise
@@ -1,8 +1,8 @@
 from datetime import datetime
 from enum import Enum
-from typing import Optional, List
+from typing import Dict, Optional, List
 
-from pydantic import BaseModel, EmailStr, UUID4, ConfigDict
+from pydantic import BaseModel, EmailStr, Field, UUID4, ConfigDict
 
 
 class TicketBase(BaseModel):
@@ -21,10 +21,34 @@ class TicketCreateResponse(BaseModel):
     message: str
 
 
+class TicketBulkItem(BaseModel):
+    index: int
+    ticket_id: Optional[UUID4] = None
+    error: Optional[str] = None
+
+
+class TicketBulkResponse(BaseModel):
+    created: int
+    failed: int
+    items: List[TicketBulkItem]
+
+
 class TicketStatus(Enum):
     SUBMITTED = "submitted"
     PROCESSING = "processing"
     PROCESSED = "processed"
+    # dead letter, processing failed TICKET_MAX_ATTEMPTS times
+    FAILED = "failed"
+
+
+# statuses tickets are done processing in, they don't change anymore unless retried manually
+DONE_STATUSES = (TicketStatus.PROCESSED, TicketStatus.FAILED)
+
+
+# where the category and priority of a ticket come from, the local classifier only learns llm ones
+class ClassifiedBy(Enum):
+    LLM = "llm"
+    LOCAL = "local"
 
 
 class TicketPriority(Enum):
@@ -48,15 +72,69 @@ class Ticket(TicketBase):
     priority_confidence: Optional[float]
     created_at: datetime
     processed_at: Optional[datetime]
+    input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    attempts: Optional[int] = None
+    last_error: Optional[str] = None
+    next_attempt_at: Optional[datetime] = None
 
     model_config = ConfigDict(from_attributes=True)
 
 
+class TicketSummary(BaseModel):
+    """Ticket fields of listing views, listed by fields=summary, without the long texts."""
+    id: UUID4
+    subject: str
+    customer_email: EmailStr
+    status: Optional[TicketStatus]
+    category: Optional[TicketCategory]
+    priority: Optional[TicketPriority]
+    created_at: datetime
+    processed_at: Optional[datetime]
+
+
 class PaginatedTickets(BaseModel):
     tickets: List[Ticket]
     total: int
     page: int
     per_page: int
+    next_cursor: Optional[str] = None
+
+
+class TicketSearchResult(Ticket):
+    score: float
+
+
+class SearchTickets(BaseModel):
+    tickets: List[TicketSearchResult]
+    per_page: int
+    next_cursor: Optional[str] = None
+    truncated: bool = False
+
+
+class TicketLatencyStats(BaseModel):
+    count: int
+    mean: Optional[float]
+    p50: Optional[float]
+    p95: Optional[float]
+    p99: Optional[float]
+
+
+class TicketStatsBucket(BaseModel):
+    start: datetime
+    created: int
+    processed: int
+    mean_processing_seconds: Optional[float]
+
+
+class TicketStats(BaseModel):
+    total: int
+    by_status: Dict[str, int]
+    by_category: Dict[str, int]
+    by_priority: Dict[str, int]
+    processing_seconds: TicketLatencyStats
+    per_minute: List[TicketStatsBucket]
+    per_hour: List[TicketStatsBucket]
 
 
 class TicketProcess(BaseModel):
@@ -64,8 +142,24 @@ class TicketProcess(BaseModel):
     job_id: UUID4
 
 
+class TicketProcessStatus(BaseModel):
+    job_id: UUID4
+    status: str
+    claimed: int
+
+
 class TicketClassified(BaseModel):
     category: TicketCategory
     priority: TicketPriority
     category_confidence: float
     priority_confidence: float
+    # not part of llm answers nor of cached classifications, which come from the llm too
+    classified_by: ClassifiedBy = Field(ClassifiedBy.LLM, exclude=True)
+
+
+class TicketBatchClassified(TicketClassified):
+    ticket_id: UUID4
+
+
+class TicketsClassified(BaseModel):
+    tickets: List[TicketBatchClassified]
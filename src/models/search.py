@@ -0,0 +1,202 @@
+import base64
+import re
+import uuid
+from typing import List, Optional, Tuple
+
+from sqlalchemy import Select, and_, column, func, literal_column, or_, select, table, text
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+
+from src.core.config import settings
+from .schemas import TicketStatus, TicketCategory, TicketPriority
+from .ticket import Ticket, _filter_statement
+
+# sqlite keeps an external content fts5 table in sync with tickets by triggers, it only
+# stores the index and reads the text from tickets. Triggers on update only fire when an
+# indexed column changes, e.g. when processing sets the initial response, not on status
+# changes. VACUUM may renumber the tickets rowids, run rebuild_search_index after it.
+SQLITE_SEARCH_DDL = [
+    """CREATE VIRTUAL TABLE IF NOT EXISTS tickets_fts USING fts5(
+        subject, body, initial_response,
+        content='tickets', content_rowid='rowid', tokenize='porter unicode61')""",
+    """CREATE TRIGGER IF NOT EXISTS tickets_fts_insert AFTER INSERT ON tickets BEGIN
+        INSERT INTO tickets_fts(rowid, subject, body, initial_response)
+        VALUES (new.rowid, new.subject, new.body, new.initial_response);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tickets_fts_delete AFTER DELETE ON tickets BEGIN
+        INSERT INTO tickets_fts(tickets_fts, rowid, subject, body, initial_response)
+        VALUES ('delete', old.rowid, old.subject, old.body, old.initial_response);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS tickets_fts_update
+    AFTER UPDATE OF subject, body, initial_response ON tickets BEGIN
+        INSERT INTO tickets_fts(tickets_fts, rowid, subject, body, initial_response)
+        VALUES ('delete', old.rowid, old.subject, old.body, old.initial_response);
+        INSERT INTO tickets_fts(rowid, subject, body, initial_response)
+        VALUES (new.rowid, new.subject, new.body, new.initial_response);
+    END""",
+]
+# subject matches weigh more than body ones, which weigh more than the initial response,
+# bm25 is lower for better matches so it's negated into a higher is better score
+SQLITE_SCORE = literal_column("-bm25(tickets_fts, 4.0, 1.0, 0.5)")
+tickets_fts = table("tickets_fts", column("rowid"))
+
+# postgres maintains a gin expression index itself, queries must repeat the exact expression
+POSTGRES_DOCUMENT = ("to_tsvector('english', coalesce(subject, '') || ' ' || coalesce(body, '')"
+                     " || ' ' || coalesce(initial_response, ''))")
+POSTGRES_SEARCH_DDL = [
+    f"CREATE INDEX IF NOT EXISTS ix_tickets_search ON tickets USING gin (({POSTGRES_DOCUMENT}))",
+]
+
+SearchCursor = Tuple[float, uuid.UUID]
+
+
+def create_search_index(conn: Connection):
+    """Create the full text index of tickets if missing, indexing the existing tickets."""
+    if conn.dialect.name == "sqlite":
+        exists = conn.scalar(text("SELECT 1 FROM sqlite_master WHERE name = 'tickets_fts'"))
+        for ddl in SQLITE_SEARCH_DDL:
+            conn.execute(text(ddl))
+        if not exists:
+            rebuild_search_index(conn)
+    elif conn.dialect.name == "postgresql":
+        for ddl in POSTGRES_SEARCH_DDL:
+            conn.execute(text(ddl))
+
+
+def rebuild_search_index(conn: Connection):
+    if conn.dialect.name == "sqlite":
+        conn.execute(text("INSERT INTO tickets_fts(tickets_fts) VALUES ('rebuild')"))
+
+
+def encode_search_cursor(score: float, ticket_id: uuid.UUID) -> str:
+    """Opaque cursor pointing right after the search result of the given score and ticket."""
+    return base64.urlsafe_b64encode(f"{score!r}|{ticket_id}".encode()).decode()
+
+
+def decode_search_cursor(cursor: str) -> SearchCursor:
+    """Raise ValueError if the cursor is malformed."""
+    try:
+        score, ticket_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return float(score), uuid.UUID(ticket_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor {cursor}") from e
+
+
+def search_terms(q: str) -> List[str]:
+    return re.findall(r"\w+", q)
+
+
+def _sqlite_matches(q: str,
+                    status: Optional[TicketStatus] = None,
+                    category: Optional[TicketCategory] = None,
+                    priority: Optional[TicketPriority] = None) -> Select:
+    # every term is quoted so user input can't break the fts5 query syntax
+    match = " ".join(f'"{term}"' for term in search_terms(q))
+    matches = (select(literal_column("tickets.rowid").label("rowid"))
+               .select_from(tickets_fts)
+               .join(Ticket.__table__, tickets_fts.c.rowid == literal_column("tickets.rowid"))
+               .where(literal_column("tickets_fts").op("MATCH")(match)))
+    return _filter_statement(matches, status, category, priority)
+
+
+def _search_statement(dialect: str,
+                      q: str,
+                      per_page: int,
+                      status: Optional[TicketStatus] = None,
+                      category: Optional[TicketCategory] = None,
+                      priority: Optional[TicketPriority] = None,
+                      cursor: Optional[SearchCursor] = None,
+                      max_candidates: int = 0) -> Select:
+    if dialect == "sqlite":
+        candidates = (_sqlite_matches(q, status, category, priority)
+                      .add_columns(SQLITE_SCORE.label("score")))
+        if max_candidates:
+            # bm25 costs a few microseconds per match, rank only the most recent matches
+            # so that words found in most tickets still return in milliseconds
+            candidates = candidates.order_by(tickets_fts.c.rowid.desc()).limit(max_candidates)
+        candidates = candidates.subquery("candidates")
+        score = candidates.c.score
+        statement = (select(Ticket, score)
+                     .join(candidates, candidates.c.rowid == literal_column("tickets.rowid")))
+    elif dialect == "postgresql":
+        query = func.plainto_tsquery("english", q)
+        score = func.ts_rank_cd(literal_column(POSTGRES_DOCUMENT), query)
+        statement = (select(Ticket, score.label("score"))
+                     .where(literal_column(POSTGRES_DOCUMENT).op("@@")(query)))
+        statement = _filter_statement(statement, status, category, priority)
+    else:
+        raise NotImplementedError(f"Full text search is not supported on {dialect}")
+
+    if cursor:
+        after_score, ticket_id = cursor
+        statement = statement.where(or_(score < after_score,
+                                        and_(score == after_score, Ticket.id > ticket_id)))
+    return statement.order_by(score.desc(), Ticket.id).limit(per_page)
+
+
+def _truncated_statement(dialect: str,
+                         q: str,
+                         status: Optional[TicketStatus] = None,
+                         category: Optional[TicketCategory] = None,
+                         priority: Optional[TicketPriority] = None,
+                         max_candidates: int = 0) -> Optional[Select]:
+    if dialect != "sqlite" or not max_candidates:
+        return None
+    # matches are counted without ranking them, up to one past the candidates
+    matches = _sqlite_matches(q, status, category, priority).limit(max_candidates + 1)
+    return select(func.count() > max_candidates).select_from(matches.subquery())
+
+
+def search_tickets(db: Session,
+                   q: str,
+                   per_page: int,
+                   status: Optional[TicketStatus] = None,
+                   category: Optional[TicketCategory] = None,
+                   priority: Optional[TicketPriority] = None,
+                   cursor: Optional[SearchCursor] = None) -> List[Tuple[Ticket, float]]:
+    """
+    Search tickets whose subject, body or initial response contain all words of q,
+    best matches first. Returns (ticket, score) pairs, pass the last ones as cursor.
+    On sqlite only the SEARCH_MAX_CANDIDATES most recent matches are ranked, search_truncated
+    tells whether some matches were left out.
+    """
+    statement = _search_statement(db.get_bind().dialect.name, q, per_page,
+                                  status, category, priority, cursor,
+                                  settings.SEARCH_MAX_CANDIDATES)
+    return [(row.Ticket, row.score) for row in db.execute(statement)]
+
+
+def search_truncated(db: Session,
+                     q: str,
+                     status: Optional[TicketStatus] = None,
+                     category: Optional[TicketCategory] = None,
+                     priority: Optional[TicketPriority] = None) -> bool:
+    """Whether more tickets match than the SEARCH_MAX_CANDIDATES ranked by the search."""
+    statement = _truncated_statement(db.get_bind().dialect.name, q, status, category, priority,
+                                     settings.SEARCH_MAX_CANDIDATES)
+    return statement is not None and bool(db.scalar(statement))
+
+
+async def search_tickets_async(db: AsyncSession,
+                               q: str,
+                               per_page: int,
+                               status: Optional[TicketStatus] = None,
+                               category: Optional[TicketCategory] = None,
+                               priority: Optional[TicketPriority] = None,
+                               cursor: Optional[SearchCursor] = None
+                               ) -> List[Tuple[Ticket, float]]:
+    statement = _search_statement(db.get_bind().dialect.name, q, per_page,
+                                  status, category, priority, cursor,
+                                  settings.SEARCH_MAX_CANDIDATES)
+    return [(row.Ticket, row.score) for row in await db.execute(statement)]
+
+
+async def search_truncated_async(db: AsyncSession,
+                                 q: str,
+                                 status: Optional[TicketStatus] = None,
+                                 category: Optional[TicketCategory] = None,
+                                 priority: Optional[TicketPriority] = None) -> bool:
+    statement = _truncated_statement(db.get_bind().dialect.name, q, status, category, priority,
+                                     settings.SEARCH_MAX_CANDIDATES)
+    return statement is not None and bool(await db.scalar(statement))
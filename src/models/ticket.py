@@ -1,19 +1,20 @@
+import base64
 import uuid
 from datetime import datetime
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
 
-from sqlalchemy import Column, String, DateTime, Enum, Float
+from sqlalchemy import Column, String, DateTime, Enum, Float, Index, Integer, and_, func, insert
+from sqlalchemy import Row, Select, Subquery, Table, delete, or_, select, union_all, update
 from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
 from .database import Base
-from .schemas import TicketStatus, TicketCategory, TicketPriority
+from .schemas import ClassifiedBy, TicketStatus, TicketCategory, TicketPriority
 
 
-class Ticket(Base):
-    """tickets table definition"""
-    __tablename__ = "tickets"
-
+class TicketColumns:
+    """columns of the tickets and tickets_archive tables"""
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
     subject = Column(String, index=True)
     body = Column(String)
@@ -24,41 +25,413 @@ class Ticket(Base):
     initial_response = Column(String, nullable=True)
     category_confidence = Column(Float(precision=2), nullable=True)
     priority_confidence = Column(Float(precision=2), nullable=True)
+    classified_by = Column(Enum(ClassifiedBy), nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
     processed_at = Column(DateTime, nullable=True)
+    # llm tokens spent on the ticket, summed over its classification and response calls
+    input_tokens = Column(Integer, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    # processing attempts, the error of the last failed one and when the next one is due
+    attempts = Column(Integer, default=0)
+    last_error = Column(String, nullable=True)
+    next_attempt_at = Column(DateTime, nullable=True)
+    # a ticket still processing past its lease is considered lost and retried
+    lease_expires_at = Column(DateTime, nullable=True)
+
+
+class Ticket(TicketColumns, Base):
+    """tickets table definition, the live tickets"""
+    __tablename__ = "tickets"
+
+    # keyset pagination orders by (created_at, id), optionally after an equality filter
+    __table_args__ = (
+        Index("ix_tickets_created_at_id", "created_at", "id"),
+        Index("ix_tickets_status_created_at_id", "status", "created_at", "id"),
+        Index("ix_tickets_category_created_at_id", "category", "created_at", "id"),
+        Index("ix_tickets_priority_created_at_id", "priority", "created_at", "id"),
+        # sweeps of due retries and expired leases
+        Index("ix_tickets_status_next_attempt_at", "status", "next_attempt_at"),
+        Index("ix_tickets_status_lease_expires_at", "status", "lease_expires_at"),
+    )
+
+
+class ArchivedTicket(TicketColumns, Base):
+    """tickets_archive table definition, old processed tickets moved out of the tickets table"""
+    __tablename__ = "tickets_archive"
+
+    __table_args__ = (
+        Index("ix_tickets_archive_created_at_id", "created_at", "id"),
+    )
+
+
+TABLES = (Ticket.__table__, ArchivedTicket.__table__)
+TICKET_COLUMNS = [column.name for column in Ticket.__table__.columns]
+
+Cursor = Tuple[datetime, uuid.UUID]
+
+
+def encode_cursor(ticket: Ticket) -> str:
+    """Opaque pagination cursor pointing right after the given ticket."""
+    raw = f"{ticket.created_at.isoformat()}|{ticket.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Cursor:
+    """Raise ValueError if the cursor is malformed."""
+    try:
+        created_at, ticket_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(created_at), uuid.UUID(ticket_id)
+    except Exception as e:
+        raise ValueError(f"Invalid cursor {cursor}") from e
 
 
 def save_ticket(db: Session, ticket: Ticket):
     db.add(ticket)
     db.commit()
-    db.refresh(ticket)
+
+
+def save_tickets(db: Session, tickets: List[dict]):
+    """Insert ticket rows with a single executemany and commit them in one transaction."""
+    db.execute(insert(Ticket), tickets)
+    db.commit()
 
 
 def get_ticket(db: Session, ticket_id: UUID) -> Optional[Ticket]:
     return db.query(Ticket).filter(Ticket.id == ticket_id).first()
 
 
+def get_tickets(db: Session, ticket_ids: List[UUID]) -> List[Ticket]:
+    return db.query(Ticket).filter(Ticket.id.in_(ticket_ids)).all()
+
+
+def _filter_statement(statement: Select,
+                      status: Optional[TicketStatus] = None,
+                      category: Optional[TicketCategory] = None,
+                      priority: Optional[TicketPriority] = None,
+                      table: Table = Ticket.__table__) -> Select:
+    if status:
+        statement = statement.where(table.c.status == status)
+    if category:
+        statement = statement.where(table.c.category == category)
+    if priority:
+        statement = statement.where(table.c.priority == priority)
+    return statement
+
+
+def _seek_statement(statement: Select,
+                    cursor: Optional[Cursor],
+                    table: Union[Table, Subquery] = Ticket.__table__) -> Select:
+    """Tickets after the cursor ordered by (created_at, id)."""
+    if cursor:
+        created_at, ticket_id = cursor
+        statement = statement.where(or_(table.c.created_at > created_at,
+                                        and_(table.c.created_at == created_at,
+                                             table.c.id > ticket_id)))
+    return statement.order_by(table.c.created_at, table.c.id)
+
+
+def _page_statement(page: int,
+                    per_page: int,
+                    status: Optional[TicketStatus] = None,
+                    category: Optional[TicketCategory] = None,
+                    priority: Optional[TicketPriority] = None,
+                    cursor: Optional[Cursor] = None,
+                    fields: Optional[Sequence[str]] = None,
+                    archived: bool = False) -> Select:
+    """
+    Page of tickets, or of the given columns only. With archived, the live and archived
+    tickets are paged as one, which needs fields including created_at and id.
+    """
+    offset = 0 if cursor else (page - 1) * per_page
+    if archived:
+        # each table gives the rows the page may need, through its own index
+        parts = [select(_seek_statement(
+            _filter_statement(select(*(table.c[field] for field in fields)),
+                              status, category, priority, table),
+            cursor, table).limit(offset + per_page).subquery()) for table in TABLES]
+        union = union_all(*parts).subquery()
+        statement = select(union).order_by(union.c.created_at, union.c.id)
+    else:
+        columns = [Ticket.__table__.c[field] for field in fields] if fields else [Ticket]
+        statement = _seek_statement(_filter_statement(select(*columns), status, category,
+                                                      priority), cursor)
+    return statement.offset(offset).limit(per_page)
+
+
+def _count_statement(status: Optional[TicketStatus] = None,
+                     category: Optional[TicketCategory] = None,
+                     priority: Optional[TicketPriority] = None,
+                     table: Table = Ticket.__table__) -> Select:
+    return _filter_statement(select(func.count(table.c.id)), status, category, priority, table)
+
+
 def filter_ticket(db: Session,
                   page: int,
                   per_page: int,
                   status: Optional[TicketStatus] = None,
                   category: Optional[TicketCategory] = None,
-                  priority: Optional[TicketPriority] = None
+                  priority: Optional[TicketPriority] = None,
+                  cursor: Optional[Cursor] = None
                   ) -> List[Ticket]:
-    query = db.query(Ticket)
-    if status:
-        query = query.filter(Ticket.status == status)
-    if category:
-        query = query.filter(Ticket.category == category)
-    if priority:
-        query = query.filter(Ticket.priority == priority)
+    """
+    Filter tickets ordered by (created_at, id).
+    With a cursor, seek right after it through the index and ignore page,
+    otherwise fall back to offset pagination.
+    """
+    return db.scalars(_page_statement(page, per_page, status, category, priority, cursor)).all()
 
-    # Calculate the offset
-    offset = (page - 1) * per_page
 
-    # Apply limit and offset for pagination
-    return query.offset(offset).limit(per_page).all()
+def count_ticket(db: Session,
+                 status: Optional[TicketStatus] = None,
+                 category: Optional[TicketCategory] = None,
+                 priority: Optional[TicketPriority] = None) -> int:
+    return db.scalar(_count_statement(status, category, priority))
+
+
+def export_ticket_rows(db: Session,
+                       fields: Sequence[str],
+                       status: Optional[TicketStatus] = None,
+                       category: Optional[TicketCategory] = None,
+                       priority: Optional[TicketPriority] = None,
+                       created_from: Optional[datetime] = None,
+                       created_to: Optional[datetime] = None,
+                       chunk_size: int = 10000) -> Iterator[List[Row]]:
+    """
+    Stream the given columns of filtered tickets ordered by (created_at, id), in chunks of
+    chunk_size rows read from a server side cursor, so memory stays flat whatever the size.
+    Tickets are created in [created_from, created_to).
+    """
+    statement = _filter_statement(select(*(Ticket.__table__.c[field] for field in fields)),
+                                  status, category, priority)
+    if created_from:
+        statement = statement.where(Ticket.created_at >= created_from)
+    if created_to:
+        statement = statement.where(Ticket.created_at < created_to)
+    statement = (statement.order_by(Ticket.created_at, Ticket.id)
+                 .execution_options(yield_per=chunk_size))
+    # core execution, rows need no orm processing
+    yield from db.connection().execute(statement).partitions()
 
 
 def filter_ticket_status(db: Session, status: Optional[TicketStatus]) -> List[Ticket]:
     return db.query(Ticket).filter(Ticket.status == status).all()
+
+
+def _start_attempt(lease_until: Optional[datetime]) -> dict:
+    """values of a claimed ticket, claiming it starts its next processing attempt"""
+    return dict(status=TicketStatus.PROCESSING, attempts=func.coalesce(Ticket.attempts, 0) + 1,
+                next_attempt_at=None, lease_expires_at=lease_until)
+
+
+def _claim(db: Session, ticket_ids: List[UUID], lease_until: Optional[datetime]) -> List[UUID]:
+    claimed = db.scalars(update(Ticket)
+                         .where(Ticket.id.in_(ticket_ids),
+                                Ticket.status == TicketStatus.SUBMITTED)
+                         .values(**_start_attempt(lease_until))
+                         .returning(Ticket.id),
+                         execution_options={"synchronize_session": False}).all()
+    db.commit()
+    return claimed
+
+
+def claim_ticket(db: Session,
+                 ticket_id: UUID,
+                 lease_until: Optional[datetime] = None) -> Optional[Ticket]:
+    """
+    Claim a submitted ticket whose retry, if any, is due with the same conditional update as
+    claim_tickets, within the transaction of the caller. Returns None when it's not found or
+    not submitted anymore, e.g. claimed concurrently by /v1/process or the sweeper.
+    """
+    result = db.execute(update(Ticket)
+                        .where(Ticket.id == ticket_id, Ticket.status == TicketStatus.SUBMITTED,
+                               or_(Ticket.next_attempt_at.is_(None),
+                                   Ticket.next_attempt_at <= datetime.utcnow()))
+                        .values(**_start_attempt(lease_until)),
+                        execution_options={"synchronize_session": False})
+    return get_ticket(db, ticket_id) if result.rowcount == 1 else None
+
+
+def claim_unclassified(db: Session,
+                       ticket_ids: List[UUID],
+                       lease_until: Optional[datetime] = None) -> List[Ticket]:
+    """
+    Take over claimed tickets still waiting for their classification with a conditional update,
+    within the transaction of the caller. Tickets classified meanwhile, e.g. by another batch
+    after their lease expired, wait for their response job already and are left out.
+    """
+    claimed = db.scalars(update(Ticket)
+                         .where(Ticket.id.in_(ticket_ids),
+                                Ticket.status == TicketStatus.PROCESSING,
+                                Ticket.priority.is_(None))
+                         .values(lease_expires_at=lease_until)
+                         .returning(Ticket.id),
+                         execution_options={"synchronize_session": False}).all()
+    return get_tickets(db, claimed) if claimed else []
+
+
+def get_priorities(db: Session, ticket_ids: List[UUID]) -> Dict[UUID, Optional[TicketPriority]]:
+    """Priorities of tickets, None for the ones not classified yet."""
+    return dict(db.execute(select(Ticket.id, Ticket.priority)
+                           .where(Ticket.id.in_(ticket_ids))).all())
+
+
+def claim_tickets(db: Session,
+                  limit: int,
+                  after: Optional[Cursor] = None,
+                  lease_until: Optional[datetime] = None) -> Tuple[List[UUID], Optional[Cursor]]:
+    """
+    Claim up to limit submitted tickets after the cursor by switching them to processing
+    with a conditional update, so tickets claimed concurrently by others are skipped.
+    Tickets waiting for a retry are skipped until it's due. Only ids are selected.
+    Returns the claimed ids and the cursor of the last scanned ticket, which is None once
+    no submitted ticket is left.
+    """
+    statement = select(Ticket.id, Ticket.created_at).where(
+        Ticket.status == TicketStatus.SUBMITTED,
+        or_(Ticket.next_attempt_at.is_(None), Ticket.next_attempt_at <= datetime.utcnow()))
+    if after:
+        created_at, ticket_id = after
+        statement = statement.where(or_(Ticket.created_at > created_at,
+                                        and_(Ticket.created_at == created_at,
+                                             Ticket.id > ticket_id)))
+    rows = db.execute(statement.order_by(Ticket.created_at, Ticket.id).limit(limit)).all()
+    if not rows:
+        return [], None
+    return _claim(db, [row.id for row in rows], lease_until), (rows[-1].created_at, rows[-1].id)
+
+
+def claim_due_retries(db: Session,
+                      now: datetime,
+                      limit: int,
+                      lease_until: Optional[datetime] = None) -> List[UUID]:
+    """Claim up to limit submitted tickets whose retry is due, the longest waiting first."""
+    ticket_ids = db.scalars(select(Ticket.id)
+                            .where(Ticket.status == TicketStatus.SUBMITTED,
+                                   Ticket.next_attempt_at <= now)
+                            .order_by(Ticket.next_attempt_at)
+                            .limit(limit)).all()
+    return _claim(db, ticket_ids, lease_until) if ticket_ids else []
+
+
+def get_expired_leases(db: Session, now: datetime, limit: int) -> List[Ticket]:
+    """Tickets still processing past their lease, their worker is gone or stuck."""
+    return db.scalars(select(Ticket)
+                      .where(Ticket.status == TicketStatus.PROCESSING,
+                             Ticket.lease_expires_at < now)
+                      .order_by(Ticket.lease_expires_at)
+                      .limit(limit)).all()
+
+
+def renew_leases(db: Session, ticket_ids: List[UUID], lease_until: datetime) -> int:
+    """Extend the leases of tickets still processing, returns their number."""
+    result = db.execute(update(Ticket)
+                        .where(Ticket.id.in_(ticket_ids), Ticket.status == TicketStatus.PROCESSING)
+                        .values(lease_expires_at=lease_until),
+                        execution_options={"synchronize_session": False})
+    db.commit()
+    return result.rowcount
+
+
+def release_tickets(db: Session, ticket_ids: List[UUID]) -> int:
+    """
+    Revert claimed tickets which are still processing to submitted, giving back the attempt
+    started by their claim. Returns their number.
+    """
+    result = db.execute(update(Ticket)
+                        .where(Ticket.id.in_(ticket_ids), Ticket.status == TicketStatus.PROCESSING)
+                        .values(status=TicketStatus.SUBMITTED, lease_expires_at=None,
+                                attempts=Ticket.attempts - 1),
+                        execution_options={"synchronize_session": False})
+    db.commit()
+    return result.rowcount
+
+
+def archive_tickets(db: Session, before: datetime, limit: int) -> int:
+    """
+    Move up to limit processed tickets created before the given time to the archive table,
+    the oldest first, in one short transaction. Returns the number of moved tickets.
+    """
+    ticket_ids = db.scalars(select(Ticket.id)
+                            .where(Ticket.status == TicketStatus.PROCESSED,
+                                   Ticket.created_at < before)
+                            .order_by(Ticket.created_at, Ticket.id)
+                            .limit(limit)).all()
+    if not ticket_ids:
+        db.rollback()
+        return 0
+    moved = Ticket.__table__.c.id.in_(ticket_ids)
+    db.execute(insert(ArchivedTicket).from_select(TICKET_COLUMNS,
+                                                  select(*Ticket.__table__.c).where(moved)))
+    db.execute(delete(Ticket).where(moved), execution_options={"synchronize_session": False})
+    db.commit()
+    return len(ticket_ids)
+
+
+async def save_ticket_async(db: AsyncSession, ticket: Ticket):
+    db.add(ticket)
+    await db.commit()
+
+
+async def save_tickets_async(db: AsyncSession, tickets: List[dict]):
+    await db.execute(insert(Ticket), tickets)
+    await db.commit()
+
+
+async def get_ticket_async(db: AsyncSession,
+                           ticket_id: UUID) -> Optional[Union[Ticket, ArchivedTicket]]:
+    """Get a live ticket, or an archived one if there's no live ticket of that id."""
+    return await db.get(Ticket, ticket_id) or await db.get(ArchivedTicket, ticket_id)
+
+
+async def requeue_failed_ticket_async(db: AsyncSession, ticket_id: UUID) -> bool:
+    """Give a failed ticket a fresh set of attempts, returns whether it was failed."""
+    result = await db.execute(update(Ticket)
+                              .where(Ticket.id == ticket_id, Ticket.status == TicketStatus.FAILED)
+                              .values(status=TicketStatus.SUBMITTED, attempts=0,
+                                      next_attempt_at=None),
+                              execution_options={"synchronize_session": False})
+    await db.commit()
+    return result.rowcount == 1
+
+
+async def filter_ticket_async(db: AsyncSession,
+                              page: int,
+                              per_page: int,
+                              status: Optional[TicketStatus] = None,
+                              category: Optional[TicketCategory] = None,
+                              priority: Optional[TicketPriority] = None,
+                              cursor: Optional[Cursor] = None
+                              ) -> List[Ticket]:
+    statement = _page_statement(page, per_page, status, category, priority, cursor)
+    return (await db.scalars(statement)).all()
+
+
+async def filter_ticket_rows_async(db: AsyncSession,
+                                   fields: Sequence[str],
+                                   page: int,
+                                   per_page: int,
+                                   status: Optional[TicketStatus] = None,
+                                   category: Optional[TicketCategory] = None,
+                                   priority: Optional[TicketPriority] = None,
+                                   cursor: Optional[Cursor] = None,
+                                   archived: bool = False
+                                   ) -> List[Row]:
+    """
+    Like filter_ticket_async, but only the given columns as plain rows, without orm objects.
+    With archived, archived tickets are filtered too, fields must include created_at and id.
+    """
+    statement = _page_statement(page, per_page, status, category, priority, cursor, fields,
+                                archived)
+    return (await db.execute(statement)).all()
+
+
+async def count_ticket_async(db: AsyncSession,
+                             status: Optional[TicketStatus] = None,
+                             category: Optional[TicketCategory] = None,
+                             priority: Optional[TicketPriority] = None,
+                             archived: bool = False) -> int:
+    count = await db.scalar(_count_statement(status, category, priority))
+    if archived:
+        count += await db.scalar(_count_statement(status, category, priority,
+                                                  ArchivedTicket.__table__))
+    return count
@@ -0,0 +1,84 @@
+import asyncio
+from typing import Callable, List, Optional, Set, Tuple
+
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.core.config import settings
+from src.core.utils import setup_logger
+from .database import AsyncSessionLocal
+from .ticket import save_tickets_async
+
+logger = setup_logger(__name__)
+
+
+class GroupCommitWriter:
+    """
+    Coalesces concurrent ticket inserts into one transaction. A batch is committed once it
+    has max_size tickets or its first ticket has waited max_wait seconds, every caller
+    still gets its own result or error.
+    """
+
+    def __init__(self, session_factory: Callable[[], AsyncSession], max_size: int, max_wait: float):
+        self.session_factory = session_factory
+        self.max_size = max_size
+        self.max_wait = max_wait
+        self._pending: List[Tuple[dict, asyncio.Future]] = []
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._writes: Set[asyncio.Task] = set()
+
+    async def save(self, ticket: dict):
+        """Insert a ticket row, returns once the batch containing it is committed."""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((ticket, future))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.create_task(self._write(batch))
+            self._writes.add(task)
+            task.add_done_callback(self._writes.discard)
+
+    async def _insert(self, tickets: List[dict]):
+        async with self.session_factory() as db:
+            await save_tickets_async(db, tickets)
+
+    async def _write(self, batch: List[Tuple[dict, asyncio.Future]]):
+        try:
+            await self._insert([ticket for ticket, _ in batch])
+            results = [None] * len(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                results = [e]
+            else:
+                # retry one by one so that a bad ticket only fails its own caller
+                logger.warning(f"Group commit of {len(batch)} tickets failed, "
+                               f"retry one by one: {e}")
+                results = []
+                for ticket, _ in batch:
+                    try:
+                        await self._insert([ticket])
+                        results.append(None)
+                    except Exception as e:
+                        results.append(e)
+
+        for (_, future), result in zip(batch, results):
+            if future.done():
+                continue
+            if result is None:
+                future.set_result(None)
+            else:
+                future.set_exception(result)
+
+
+ticket_writer = GroupCommitWriter(AsyncSessionLocal,
+                                  settings.GROUP_COMMIT_MAX_SIZE,
+                                  settings.GROUP_COMMIT_MAX_WAIT)
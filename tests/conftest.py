@@ -0,0 +1,38 @@
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+from src.models.database import Base
+
+
+@pytest.fixture
+def engine():
+    """In-memory sqlite database with the tables created, shared by every session of a test."""
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False},
+                           poolclass=StaticPool)
+    Base.metadata.create_all(bind=engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session_modules():
+    """Modules whose SessionLocal is patched by session_factory, overridden by test modules."""
+    return []
+
+
+@pytest.fixture
+def session_factory(mocker, engine, session_modules):
+    """Sessions of the in-memory database, set as SessionLocal of the session_modules."""
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    for module in session_modules:
+        mocker.patch.object(module, "SessionLocal", factory)
+    return factory
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    yield session
+    session.close()
@@ -0,0 +1,285 @@
+import asyncio
+import json
+import uuid
+
+import pytest
+from langchain_core.exceptions import OutputParserException
+from prometheus_client import REGISTRY
+
+from src.core import ai
+from src.core.fake_llm import FakeChatModel, FakeLLMError
+from src.models.schemas import TicketsClassified, TicketBatchClassified, TicketClassified
+from src.models.schemas import TicketCategory, TicketPriority
+from src.models.ticket import Ticket
+
+
+@pytest.fixture(autouse=True)
+def offline(mocker):
+    for cache in (ai.classify_cache, ai.response_cache):
+        mocker.patch.object(cache, "redis", None)
+        cache.clear()
+    for limiter in (ai.anthropic_limiter, ai.openai_limiter):
+        mocker.patch.object(limiter, "redis", None)
+    mocker.patch.object(ai, "classify_locally", return_value=None)
+    mocker.patch.object(ai.settings, "LLM_ROUTER_ENABLED", False)
+
+
+@pytest.fixture
+def tickets():
+    return [Ticket(id=uuid.uuid4(), subject=f"subject {i}", body=f"body {i}") for i in range(4)]
+
+
+def classified(ticket_id=None):
+    fields = dict(category=TicketCategory.ACCOUNT_ACCESS,
+                  category_confidence=0.9,
+                  priority=TicketPriority.HIGH,
+                  priority_confidence=0.8)
+    if ticket_id is None:
+        return TicketClassified(**fields)
+    return TicketBatchClassified(ticket_id=ticket_id, **fields)
+
+
+def test_classify_tickets_in_one_batch(mocker, tickets):
+    chain = mocker.patch.object(ai, "get_batch_classify_chain").return_value
+    chain.ainvoke = mocker.AsyncMock(
+        return_value=TicketsClassified(tickets=[classified(t.id) for t in tickets]))
+
+    result = asyncio.run(ai.categorize_prioritize_tickets(tickets))
+
+    assert chain.ainvoke.call_count == 1
+    assert set(result) == {t.id for t in tickets}
+    assert result[tickets[0].id].category == TicketCategory.ACCOUNT_ACCESS
+
+
+def test_classify_tickets_retry_missing_part(mocker, tickets):
+    chain = mocker.patch.object(ai, "get_batch_classify_chain").return_value
+    chain.ainvoke = mocker.AsyncMock(side_effect=[
+        TicketsClassified(tickets=[classified(t.id) for t in tickets[:2]]),
+        TicketsClassified(tickets=[classified(t.id) for t in tickets[2:]]),
+    ])
+
+    result = asyncio.run(ai.categorize_prioritize_tickets(tickets))
+
+    assert chain.ainvoke.call_count == 2
+    retried = chain.ainvoke.call_args_list[1].args[0]["tickets"]
+    assert str(tickets[0].id) not in retried
+    assert str(tickets[2].id) in retried
+    assert set(result) == {t.id for t in tickets}
+
+
+def test_classify_tickets_split_failed_batch(mocker, tickets):
+    chain = mocker.patch.object(ai, "get_batch_classify_chain").return_value
+    chain.ainvoke = mocker.AsyncMock(side_effect=OutputParserException("invalid json"))
+    single = mocker.patch.object(ai, "_classify_ticket", mocker.AsyncMock())
+    single.side_effect = [("anthropic", classified()), ("anthropic", classified()),
+                          ("anthropic", classified()), OutputParserException("invalid json")]
+
+    result = asyncio.run(ai.categorize_prioritize_tickets(tickets))
+
+    # whole batch, then both halves fail and fall back to single ticket calls
+    assert chain.ainvoke.call_count == 3
+    assert single.call_count == 4
+    assert len(result) == 3
+
+
+def test_classify_tickets_provider_error_not_split(mocker, tickets):
+    chain = mocker.patch.object(ai, "get_batch_classify_chain").return_value
+    chain.ainvoke = mocker.AsyncMock(side_effect=FakeLLMError(429))
+    single = mocker.patch.object(ai, "_classify_ticket", mocker.AsyncMock())
+
+    with pytest.raises(FakeLLMError):
+        asyncio.run(ai.categorize_prioritize_tickets(tickets))
+
+    # the worker retries the whole batch after a backoff
+    assert chain.ainvoke.call_count == 1
+    assert single.call_count == 0
+
+
+def test_classify_ticket_cache_hit(mocker, tickets):
+    chain = mocker.patch.object(ai, "get_classify_chain").return_value
+    chain.ainvoke = mocker.AsyncMock(return_value=classified())
+    duplicate = Ticket(id=uuid.uuid4(), subject="Subject 0 ", body="BODY   0")
+
+    labels = {"cache": "classify", "result": "local_hit"}
+    hits = REGISTRY.get_sample_value("cache_lookups_total", labels) or 0
+
+    asyncio.run(ai.categorize_prioritize_ticket(tickets[0]))
+    result = asyncio.run(ai.categorize_prioritize_ticket(duplicate))
+
+    assert chain.ainvoke.call_count == 1
+    assert result == classified()
+    assert ai.classify_cache.stats()["hits"] == 1
+    assert REGISTRY.get_sample_value("cache_lookups_total", labels) == hits + 1
+
+
+def test_classify_tickets_skip_cached(mocker, tickets):
+    asyncio.run(ai._cache_classified(tickets[0], "anthropic", classified()))
+    chain = mocker.patch.object(ai, "get_batch_classify_chain").return_value
+    chain.ainvoke = mocker.AsyncMock(
+        return_value=TicketsClassified(tickets=[classified(t.id) for t in tickets[1:]]))
+
+    result = asyncio.run(ai.categorize_prioritize_tickets(tickets))
+
+    assert str(tickets[0].id) not in chain.ainvoke.call_args.args[0]["tickets"]
+    assert set(result) == {t.id for t in tickets}
+
+
+def test_craft_response_cache_hit(mocker, tickets):
+    mocker.patch.object(ai.settings, "RESPONSE_STREAM_ENABLED", False)
+    chain = mocker.patch.object(ai, "get_response_chain").return_value
+    chain.ainvoke = mocker.AsyncMock(return_value="We are on it.")
+
+    first = asyncio.run(ai.craft_ticket_response(tickets[0]))
+    second = asyncio.run(ai.craft_ticket_response(tickets[0]))
+
+    assert first == second == "We are on it."
+    assert chain.ainvoke.call_count == 1
+
+
+def test_craft_response_streamed(mocker, tickets):
+    async def astream(chain_input, config):
+        for chunk in ("We are ", "on it."):
+            yield chunk
+
+    async def stream_response(ticket_id, chunks):
+        return "".join([chunk async for chunk in chunks])
+
+    chain = mocker.patch.object(ai, "get_response_chain").return_value
+    chain.astream = astream
+    stream_response = mocker.patch.object(ai, "stream_response", side_effect=stream_response)
+
+    assert asyncio.run(ai.craft_ticket_response(tickets[0])) == "We are on it."
+    assert stream_response.await_args.args[0] == tickets[0].id
+    assert not chain.ainvoke.called
+
+
+def test_fake_llm_streams_response(mocker):
+    llm = FakeChatModel(latency=0, jitter=0)
+    callback = ai.LLMMetricsCallback("fake")
+    observe = mocker.patch.object(ai.LLM_FIRST_TOKEN_SECONDS, "labels").return_value.observe
+
+    async def stream():
+        return [chunk async for chunk in (ai.response_prompt | llm).astream(
+            {"ticket_subject": "subject", "ticket_body": "body"}, {"callbacks": [callback]})]
+
+    chunks = asyncio.run(stream())
+
+    assert len(chunks) > 1
+    assert "".join(chunk.content for chunk in chunks).startswith("Thanks for reaching out")
+    observe.assert_called_once()
+
+
+def test_classify_ticket_budget_and_token_usage(mocker, tickets):
+    mocker.patch.object(ai, "get_llm", return_value=FakeChatModel(latency=0, jitter=0))
+    mocker.patch.object(ai.settings, "CLASSIFY_BODY_MAX_TOKENS", 50)
+    ai.get_classify_chain.cache_clear()
+    ticket = Ticket(id=uuid.uuid4(), subject="export fails", body="DEBUG polling export\n" * 1000)
+    try:
+        asyncio.run(ai.categorize_prioritize_ticket(ticket))
+        asyncio.run(ai.categorize_prioritize_ticket(tickets[0]))
+    finally:
+        ai.get_classify_chain.cache_clear()
+
+    # the body is collapsed to one line, the static instructions dominate the prompt
+    input_tokens, output_tokens = ai.take_ticket_tokens(ticket.id)
+    assert 0 < input_tokens < 300
+    assert output_tokens > 0
+    assert ai.take_ticket_tokens(tickets[0].id)[0] < input_tokens
+    # cache hits are free
+    asyncio.run(ai.categorize_prioritize_ticket(ticket))
+    assert ai.take_ticket_tokens(ticket.id) == (0, 0)
+
+
+def test_token_usage_split_between_batch_tickets(tickets):
+    usage = ai.TokenUsageCallback()
+    usage.input_tokens, usage.output_tokens = 10, 7
+
+    usage.charge(tickets)
+    usage.charge(tickets[:1])
+
+    assert [ai.take_ticket_tokens(t.id) for t in tickets] == [(13, 9), (3, 2), (2, 2), (2, 1)]
+
+
+def test_classify_prompts_cache_static_instructions():
+    for prompt in (ai.classify_prompt, ai.batch_classify_prompt):
+        system, human = prompt.format_messages(ticket_subject="subject", ticket_body="body",
+                                               tickets="[]")
+        block, = system.content
+        assert block["cache_control"] == {"type": "ephemeral"}
+        assert ai.CATEGORIES in block["text"] and ai.PRIORITIES in block["text"]
+        assert "{" not in human.content
+
+
+def test_classify_ticket_fails_over(mocker, tickets):
+    mocker.patch.object(ai.settings, "LLM_ROUTER_ENABLED", True)
+    mocker.patch.object(ai.settings, "FAKE_LLM", True)
+    mocker.patch.object(ai, "provider_router", ai.ProviderRouter(10, 0.5, 2, 30, 5, 10))
+    chains = {"anthropic": mocker.Mock(ainvoke=mocker.AsyncMock(side_effect=Exception("529"))),
+              "openai": mocker.Mock(ainvoke=mocker.AsyncMock(return_value=classified()))}
+    mocker.patch.object(ai, "get_classify_chain", side_effect=chains.get)
+
+    for ticket in tickets[:3]:
+        assert asyncio.run(ai.categorize_prioritize_ticket(ticket)) == classified()
+
+    # the circuit of anthropic opens after two failures, the third ticket skips it
+    assert chains["anthropic"].ainvoke.call_count == 2
+    assert chains["openai"].ainvoke.call_count == 3
+    assert ai.provider_router.breaker("anthropic").state == "open"
+
+
+def test_classify_ticket_locally(mocker, tickets):
+    mocker.patch.object(ai, "classify_locally", return_value=classified())
+    chain = mocker.patch.object(ai, "get_classify_chain").return_value
+    batch_chain = mocker.patch.object(ai, "get_batch_classify_chain").return_value
+
+    assert asyncio.run(ai.categorize_prioritize_ticket(tickets[0])) == classified()
+    assert len(asyncio.run(ai.categorize_prioritize_tickets(tickets))) == len(tickets)
+    assert not chain.ainvoke.called
+    assert not batch_chain.ainvoke.called
+
+
+def test_fake_llm_answers_prompts(tickets):
+    llm = FakeChatModel(latency=0, jitter=0)
+    batch_chain = ai.batch_classify_prompt | llm | ai.batch_output_parser
+    chain_input = {"tickets": json.dumps([{"id": str(t.id), "subject": t.subject,
+                                           "content": t.body} for t in tickets])}
+
+    result = asyncio.run(batch_chain.ainvoke(chain_input))
+
+    assert [item.ticket_id for item in result.tickets] == [t.id for t in tickets]
+    response = asyncio.run((ai.response_prompt | llm).ainvoke({"ticket_subject": "subject",
+                                                              "ticket_body": "body"}))
+    assert response.content
+
+
+def test_llm_metrics_callback():
+    llm = FakeChatModel(latency=0, jitter=0, error_rate=1.0)
+    llm.callbacks = [ai.LLMMetricsCallback("fake")]
+    errors = REGISTRY.get_sample_value("llm_errors_total", {"provider": "fake"}) or 0
+
+    with pytest.raises(FakeLLMError):
+        asyncio.run(llm.ainvoke("hi"))
+    llm.error_rate = 0
+    asyncio.run(llm.ainvoke("hi"))
+
+    assert REGISTRY.get_sample_value("llm_errors_total", {"provider": "fake"}) == errors + 1
+    assert REGISTRY.get_sample_value("llm_request_duration_seconds_count", {"provider": "fake"})
+
+
+def test_classify_cache_keyed_by_answering_model(mocker, tickets):
+    mocker.patch.object(ai.settings, "LLM_ROUTER_ENABLED", True)
+    mocker.patch.object(ai.settings, "FAKE_LLM", True)
+    mocker.patch.object(ai, "provider_router", ai.ProviderRouter(10, 0.5, 2, 30, 5, 10))
+    chains = {"anthropic": mocker.Mock(ainvoke=mocker.AsyncMock(side_effect=Exception("529"))),
+              "openai": mocker.Mock(ainvoke=mocker.AsyncMock(return_value=classified()))}
+    mocker.patch.object(ai, "get_classify_chain", side_effect=chains.get)
+
+    asyncio.run(ai.categorize_prioritize_ticket(tickets[0]))
+    # the failed over answer is cached for openai and found there
+    assert asyncio.run(ai.categorize_prioritize_ticket(tickets[0])) == classified()
+    assert chains["openai"].ainvoke.call_count == 1
+    assert ai.classify_cache.get(ai._classify_cache_key(tickets[0], "openai")) is not None
+    assert ai.classify_cache.get(ai._classify_cache_key(tickets[0], "anthropic")) is None
+    # answers of the fake llm aren't served for the real models
+    mocker.patch.object(ai.settings, "FAKE_LLM", False)
+    assert ai.classify_cache.get(ai._classify_cache_key(tickets[0], "openai")) is None
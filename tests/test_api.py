@@ -1,13 +1,24 @@
+import asyncio
+import subprocess
+import sys
 import uuid
+from collections import namedtuple
+from contextlib import asynccontextmanager
 from datetime import datetime
 
 import pytest
 from fastapi.testclient import TestClient
+from rq.exceptions import NoSuchJobError
+from rq.job import JobStatus
 
+from src.core.response_stream import ResponseEvent
+from src.core.ticket_cache import serialize_ticket, ticket_cache
+from src.core.ticket_events import ticket_waiter
 from src.main import app
-from src.models.database import get_db
+from src.models import schemas
+from src.models.database import get_async_db
 from src.models.schemas import TicketStatus
-from src.models.ticket import Ticket
+from src.models.ticket import Ticket, encode_cursor
 
 client = TestClient(app)
 
@@ -21,7 +32,18 @@ def mock_db_session(mocker):
 @pytest.fixture(autouse=True)
 def override_get_db():
     # Override the get_db dependency to return the mock DB session
-    app.dependency_overrides[get_db] = lambda: mock_db_session
+    app.dependency_overrides[get_async_db] = lambda: mock_db_session
+
+
+@pytest.fixture(autouse=True)
+def local_ticket_cache(mocker):
+    mocker.patch.object(ticket_cache, "redis", None)
+    ticket_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def record_created(mocker):
+    return mocker.patch("src.api.v1.ticket_api.record_created")
 
 
 @pytest.fixture
@@ -39,8 +61,28 @@ def test_root_ping():
     assert response.json() == {"status": "ok", "message": "I'm up!"}
 
 
-def test_create_ticket(mocker):
-    save_ticket = mocker.patch("src.api.v1.ticket_api.save_ticket")
+def test_metrics():
+    client.get("/ping")
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert 'http_request_duration_seconds_count{method="GET",route="/ping",status="200"}' \
+        in response.text
+    assert "rq_queue_depth" in response.text
+
+
+def test_app_does_not_import_llm_stack():
+    # the llm clients and local classifier are loaded by the workers only
+    script = ("import sys, src.main; "
+              "print(sorted({m.split('.')[0] for m in sys.modules} "
+              "& {'langchain', 'langchain_anthropic', 'langchain_openai', 'sklearn'}))")
+    output = subprocess.run([sys.executable, "-c", script], check=True,
+                            capture_output=True, text=True).stdout
+
+    assert output.strip() == "[]"
+
+
+def test_create_ticket(mocker, record_created):
+    save_ticket = mocker.patch("src.api.v1.ticket_api.save_ticket_async")
     enqueue_ticket = mocker.patch("src.api.v1.ticket_api.enqueue_ticket")
 
     response = client.post("/v1/ticket",
@@ -57,10 +99,26 @@ def test_create_ticket(mocker):
     assert data["status"] == "submitted"
     assert "ticket_id" in data
     assert "message" in data
+    assert record_created.call_args.args[0] == 1
+
+
+def test_create_ticket_group_commit(mocker):
+    mocker.patch("src.api.v1.ticket_api.settings.GROUP_COMMIT_ENABLED", True)
+    save_ticket = mocker.patch("src.api.v1.ticket_api.save_ticket_async")
+    writer_save = mocker.patch("src.api.v1.ticket_api.ticket_writer.save")
+    mocker.patch("src.api.v1.ticket_api.enqueue_ticket")
+
+    response = client.post("/v1/ticket",
+                           json={"subject": "title", "body": "body",
+                                 "customer_email": "user@example.com"})
+
+    assert response.status_code == 201
+    assert save_ticket.call_count == 0
+    assert writer_save.call_args.args[0]["id"] == uuid.UUID(response.json()["ticket_id"])
 
 
 def test_get_ticket(mocker, mock_ticket):
-    get_ticket = mocker.patch("src.api.v1.ticket_api.query_ticket")
+    get_ticket = mocker.patch("src.api.v1.ticket_api.get_ticket_async")
     get_ticket.return_value = mock_ticket
 
     query_response = client.get("/v1/ticket/%s" % mock_ticket.id)
@@ -68,8 +126,87 @@ def test_get_ticket(mocker, mock_ticket):
     get_ticket.assert_called_once_with(mock_db_session, mock_ticket.id)
 
 
+def test_get_ticket_cached(mocker, mock_ticket):
+    get_ticket = mocker.patch("src.api.v1.ticket_api.get_ticket_async")
+    get_ticket.return_value = mock_ticket
+
+    response = client.get(f"/v1/ticket/{mock_ticket.id}")
+    etag = response.headers["etag"]
+    assert response.json()["id"] == str(mock_ticket.id)
+
+    response = client.get(f"/v1/ticket/{mock_ticket.id}")
+    assert response.status_code == 200
+    assert response.headers["etag"] == etag
+    assert get_ticket.call_count == 1
+
+    response = client.get(f"/v1/ticket/{mock_ticket.id}", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.content == b""
+
+    response = client.get(f"/v1/ticket/{mock_ticket.id}", headers={"If-None-Match": '"stale"'})
+    assert response.status_code == 200
+    assert get_ticket.call_count == 1
+
+
+def test_get_ticket_if_modified_since(mocker, mock_ticket):
+    mock_ticket.status = TicketStatus.PROCESSED
+    mock_ticket.processed_at = datetime.utcnow()
+    mocker.patch("src.api.v1.ticket_api.get_ticket_async", return_value=mock_ticket)
+
+    last_modified = client.get(f"/v1/ticket/{mock_ticket.id}").headers["last-modified"]
+    response = client.get(f"/v1/ticket/{mock_ticket.id}",
+                          headers={"If-Modified-Since": last_modified})
+
+    assert response.status_code == 304
+
+
+@pytest.fixture
+def waiting(mocker):
+    """Ticket waiter resolving the waits with the given tickets, never if None."""
+    done = []
+
+    @asynccontextmanager
+    async def waiting(ticket_id):
+        future = asyncio.get_running_loop().create_future()
+        if done[0] is not None:
+            future.set_result(serialize_ticket(done[0]))
+        yield future
+
+    mocker.patch.object(ticket_waiter, "waiting", side_effect=waiting)
+    return done
+
+
+def test_get_ticket_wait(mocker, mock_ticket, waiting):
+    mock_ticket.status = TicketStatus.PROCESSING
+    db = mocker.AsyncMock()
+    app.dependency_overrides[get_async_db] = lambda: db
+    mocker.patch("src.api.v1.ticket_api.get_ticket_async", return_value=mock_ticket)
+    waiting.append(Ticket(id=mock_ticket.id, subject="test", body="test",
+                          customer_email="test@email.com", created_at=mock_ticket.created_at,
+                          processed_at=datetime.utcnow(), status=TicketStatus.PROCESSED))
+
+    response = client.get(f"/v1/ticket/{mock_ticket.id}", params={"wait": 5})
+
+    assert response.json()["status"] == "processed"
+    # the db connection is released while waiting
+    db.close.assert_awaited()
+    assert client.get(f"/v1/ticket/{mock_ticket.id}", params={"wait": 600}).status_code == 422
+
+
+def test_get_ticket_wait_timeout(mocker, mock_ticket, waiting):
+    mock_ticket.status = TicketStatus.PROCESSING
+    app.dependency_overrides[get_async_db] = lambda: mocker.AsyncMock()
+    mocker.patch("src.api.v1.ticket_api.get_ticket_async", return_value=mock_ticket)
+    waiting.append(None)
+
+    response = client.get(f"/v1/ticket/{mock_ticket.id}", params={"wait": 0.1})
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "processing"
+
+
 def test_get_non_exist_ticket(mocker):
-    get_ticket = mocker.patch("src.api.v1.ticket_api.query_ticket")
+    get_ticket = mocker.patch("src.api.v1.ticket_api.get_ticket_async")
     get_ticket.return_value = None
 
     ticket_id = uuid.uuid4()
@@ -79,11 +216,227 @@ def test_get_non_exist_ticket(mocker):
     assert 'detail' in response.json()
 
 
-def test_process_ticket(mocker, mock_ticket):
-    mock_filter = mocker.patch("src.api.v1.ticket_api.filter_ticket_status")
-    mock_filter.return_value = [mock_ticket, mock_ticket]
+def test_stream_ticket_response(mocker, mock_ticket):
+    mock_ticket.status = TicketStatus.PROCESSING
+    mocker.patch("src.api.v1.ticket_api.get_ticket_async", return_value=mock_ticket)
+
+    async def events(ticket_id, last_id, timeout):
+        yield ResponseEvent("1-0", "token", "Thanks ")
+        yield None
+        yield ResponseEvent("1-1", "done", "Thanks for reaching out")
+
+    read = mocker.patch("src.api.v1.ticket_api.read_response_stream", side_effect=events)
+
+    response = client.get(f"/v1/ticket/{mock_ticket.id}/response/stream",
+                          headers={"Last-Event-ID": "0-5"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/event-stream")
+    assert response.text == ('id: 1-0\nevent: token\ndata: "Thanks "\n\n'
+                             ': keep-alive\n\n'
+                             'id: 1-1\nevent: done\ndata: "Thanks for reaching out"\n\n')
+    assert read.call_args.args == (mock_ticket.id, "0-5")
+
+
+def test_stream_processed_ticket_response(mocker, mock_ticket):
+    mock_ticket.status = TicketStatus.PROCESSED
+    mock_ticket.initial_response = "Thanks!"
+    mocker.patch("src.api.v1.ticket_api.get_ticket_async", return_value=mock_ticket)
+    read = mocker.patch("src.api.v1.ticket_api.read_response_stream")
+
+    response = client.get(f"/v1/ticket/{mock_ticket.id}/response/stream")
+
+    assert response.text == 'event: done\ndata: "Thanks!"\n\n'
+    read.assert_not_called()
+    mocker.patch("src.api.v1.ticket_api.get_ticket_async", return_value=None)
+    assert client.get(f"/v1/ticket/{uuid.uuid4()}/response/stream").status_code == 404
+
+
+def test_stream_failed_ticket_response(mocker, mock_ticket):
+    mock_ticket.status = TicketStatus.FAILED
+    mock_ticket.last_error = "Classify failed"
+    mocker.patch("src.api.v1.ticket_api.get_ticket_async", return_value=mock_ticket)
+
+    response = client.get(f"/v1/ticket/{mock_ticket.id}/response/stream")
+
+    assert response.text == 'event: error\ndata: "Processing failed: Classify failed"\n\n'
+
+
+def test_retry_ticket(mocker):
+    mocker.patch("src.api.v1.ticket_api.requeue_failed_ticket_async", return_value=True)
+    enqueue = mocker.patch("src.api.v1.ticket_api.enqueue_ticket")
+    record_transition = mocker.patch("src.api.v1.ticket_api.record_transition")
+
+    ticket_id = uuid.uuid4()
+    response = client.post(f"/v1/ticket/{ticket_id}/retry")
+
+    assert response.status_code == 200
+    assert response.json()["status"] == "submitted"
+    enqueue.assert_called_once_with(ticket_id)
+    record_transition.assert_called_once_with(TicketStatus.FAILED, TicketStatus.SUBMITTED)
+
+
+def test_retry_not_failed_ticket(mocker, mock_ticket):
+    mocker.patch("src.api.v1.ticket_api.requeue_failed_ticket_async", return_value=False)
+    get_ticket = mocker.patch("src.api.v1.ticket_api.get_ticket_async", return_value=mock_ticket)
+    enqueue = mocker.patch("src.api.v1.ticket_api.enqueue_ticket")
+
+    assert client.post(f"/v1/ticket/{mock_ticket.id}/retry").status_code == 409
+    get_ticket.return_value = None
+    assert client.post(f"/v1/ticket/{mock_ticket.id}/retry").status_code == 404
+    enqueue.assert_not_called()
+
+
+def ticket_rows(tickets, fields):
+    return [namedtuple("Row", fields)(*(getattr(t, field) for field in fields)) for t in tickets]
+
 
-    mock_enqueue = mocker.patch("src.api.v1.ticket_api.enqueue_tickets")
+def test_get_tickets_with_cursor(mocker, mock_ticket):
+    mock_ticket.status = TicketStatus.SUBMITTED
+    mock_ticket.category_confidence = 0.5
+    mock_filter = mocker.patch("src.api.v1.ticket_api.filter_ticket_rows_async")
+    mock_filter.side_effect = lambda db, fields, *args: ticket_rows([mock_ticket], fields)
+    mock_count = mocker.patch("src.api.v1.ticket_api.count_ticket_async")
+    mock_count.return_value = 42
+
+    response = client.get("/v1/tickets", params={"per_page": 1})
+    assert response.status_code == 200
+    json = response.json()
+    assert json["total"] == 42
+    assert json["next_cursor"] == encode_cursor(mock_ticket)
+    # serialized from the rows as the response model would
+    assert json["tickets"] == [schemas.Ticket.model_validate(mock_ticket).model_dump(mode="json")]
+
+    response = client.get("/v1/tickets", params={"per_page": 1, "cursor": json["next_cursor"]})
+    assert response.status_code == 200
+    cursor = mock_filter.call_args.args[-2]
+    assert cursor == (mock_ticket.created_at, mock_ticket.id)
+
+
+def test_get_tickets_fields(mocker, mock_ticket):
+    mock_filter = mocker.patch("src.api.v1.ticket_api.filter_ticket_rows_async")
+    mock_filter.side_effect = lambda db, fields, *args: ticket_rows([mock_ticket], fields)
+    mocker.patch("src.api.v1.ticket_api.count_ticket_async", return_value=1)
+
+    response = client.get("/v1/tickets", params={"per_page": 1, "fields": "subject,status"})
+    assert response.json()["tickets"] == [{"subject": "test", "status": None}]
+    # the cursor columns are read too
+    assert mock_filter.call_args.args[1] == ["subject", "status", "created_at", "id"]
+    assert response.json()["next_cursor"] == encode_cursor(mock_ticket)
+
+    response = client.get("/v1/tickets", params={"fields": "summary"})
+    assert list(response.json()["tickets"][0]) == list(schemas.TicketSummary.model_fields)
+
+    assert client.get("/v1/tickets", params={"fields": "subject,password"}).status_code == 400
+
+
+def test_get_tickets_include_archived(mocker, mock_ticket):
+    mock_filter = mocker.patch("src.api.v1.ticket_api.filter_ticket_rows_async", return_value=[])
+    mock_count = mocker.patch("src.api.v1.ticket_api.count_ticket_async", return_value=0)
+
+    response = client.get("/v1/tickets", params={"include_archived": True})
+
+    assert response.json()["tickets"] == []
+    assert mock_filter.call_args.args[-1] is True
+    assert mock_count.call_args.args[-1] is True
+
+
+def test_get_tickets_invalid_cursor(mocker):
+    mock_filter = mocker.patch("src.api.v1.ticket_api.filter_ticket_rows_async")
+
+    response = client.get("/v1/tickets", params={"cursor": "invalid"})
+
+    assert response.status_code == 400
+    assert mock_filter.call_count == 0
+
+
+def test_search_tickets(mocker, mock_ticket):
+    mock_search = mocker.patch("src.api.v1.ticket_api.search_tickets_async")
+    mock_search.return_value = [(mock_ticket, 1.5)]
+    mock_truncated = mocker.patch("src.api.v1.ticket_api.search_truncated_async",
+                                  return_value=True)
+
+    response = client.get("/v1/tickets/search", params={"q": "login", "per_page": 1,
+                                                        "status": "submitted"})
+    assert response.status_code == 200
+    json = response.json()
+    assert json["tickets"][0]["score"] == 1.5
+    assert json["next_cursor"]
+    assert json["truncated"]
+    assert mock_truncated.call_args.args[1:] == ("login", TicketStatus.SUBMITTED, None, None)
+
+    client.get("/v1/tickets/search", params={"q": "login", "cursor": json["next_cursor"]})
+    assert mock_search.call_args.args[-1] == (1.5, mock_ticket.id)
+    assert json["tickets"][0]["id"] == str(mock_ticket.id)
+
+
+def test_search_tickets_invalid_query(mocker):
+    mock_search = mocker.patch("src.api.v1.ticket_api.search_tickets_async")
+
+    assert client.get("/v1/tickets/search", params={"q": "?!"}).status_code == 400
+    assert client.get("/v1/tickets/search", params={"q": "a", "cursor": "x"}).status_code == 400
+    assert mock_search.call_count == 0
+
+
+def test_export_tickets(mocker):
+    export_tickets = mocker.patch("src.api.v1.ticket_api.export_tickets",
+                                  return_value=iter([b"subject,status\r\n", b"test,submitted\r\n"]))
+
+    response = client.get("/v1/tickets/export", params={"format": "csv", "status": "submitted",
+                                                        "fields": "subject,status"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/csv")
+    assert response.headers["content-disposition"] == 'attachment; filename="tickets.csv"'
+    assert response.text == "subject,status\r\ntest,submitted\r\n"
+    args = export_tickets.call_args.args
+    assert args[:3] == ("csv", ["subject", "status"], TicketStatus.SUBMITTED)
+
+
+def test_export_tickets_invalid_fields(mocker):
+    export_tickets = mocker.patch("src.api.v1.ticket_api.export_tickets")
+
+    assert client.get("/v1/tickets/export", params={"fields": "password"}).status_code == 400
+    assert client.get("/v1/tickets/export", params={"format": "xml"}).status_code == 422
+    mocker.patch("src.api.v1.ticket_api.parquet_available", return_value=False)
+    assert client.get("/v1/tickets/export", params={"format": "parquet"}).status_code == 501
+    export_tickets.assert_not_called()
+
+
+def test_ticket_stats(mocker):
+    stats = {"total": 3,
+             "by_status": {"submitted": 1, "processed": 2},
+             "by_category": {"Unknown": 2},
+             "by_priority": {"Low": 2},
+             "processing_seconds": {"count": 2, "mean": 1.5, "p50": 1.0, "p95": 2.0, "p99": 2.0},
+             "per_minute": [{"start": datetime(2024, 1, 1), "created": 3, "processed": 2,
+                             "mean_processing_seconds": 1.5}],
+             "per_hour": []}
+    mocker.patch("src.api.v1.ticket_api.get_stats", return_value=stats)
+
+    response = client.get("/v1/tickets/stats")
+
+    assert response.status_code == 200
+    assert response.json()["by_status"] == {"submitted": 1, "processed": 2}
+    assert response.json()["per_minute"][0]["created"] == 3
+
+
+def test_reconcile_ticket_stats(mocker):
+    job_id = uuid.uuid4()
+    mocker.patch("src.api.v1.ticket_api.enqueue_reconcile_stats",
+                 return_value=mocker.Mock(id=str(job_id)))
+
+    response = client.post("/v1/tickets/stats/reconcile")
+
+    assert response.status_code == 200
+    assert response.json()["job_id"] == str(job_id)
+
+
+def test_process_ticket(mocker):
+    mock_count = mocker.patch("src.api.v1.ticket_api.count_ticket_async")
+    mock_count.return_value = 2
+
+    mock_enqueue = mocker.patch("src.api.v1.ticket_api.enqueue_claim_tickets")
     job_id = uuid.uuid4()
     mock_enqueue.return_value.id = job_id
 
@@ -92,15 +445,78 @@ def test_process_ticket(mocker, mock_ticket):
     assert response.status_code == 200
     json = response.json()
     assert json['job_id'] == str(job_id)
-    assert f"{len(mock_filter.return_value)} tickets" in json['message']
-    mock_filter.assert_called_once_with(mock_db_session, TicketStatus.SUBMITTED)
+    assert f"{mock_count.return_value} tickets" in json['message']
+    mock_count.assert_called_once_with(mock_db_session, status=TicketStatus.SUBMITTED)
+    assert mock_enqueue.call_count == 1
 
 
 def test_process_empty_ticket(mocker):
-    mock_filter = mocker.patch("src.api.v1.ticket_api.filter_ticket_status")
-    mock_filter.return_value = []
+    mock_count = mocker.patch("src.api.v1.ticket_api.count_ticket_async")
+    mock_count.return_value = 0
+    mock_enqueue = mocker.patch("src.api.v1.ticket_api.enqueue_claim_tickets")
 
     response = client.post("/v1/process")
 
-    assert mock_filter.call_count == 1
+    assert mock_count.call_count == 1
+    assert mock_enqueue.call_count == 0
     assert response.status_code == 404
+
+
+def test_get_process_status(mocker):
+    job_id = uuid.uuid4()
+    mock_fetch = mocker.patch("src.api.v1.ticket_api.Job.fetch")
+    mock_fetch.return_value.id = str(job_id)
+    mock_fetch.return_value.get_status.return_value = JobStatus.STARTED
+    mock_fetch.return_value.meta = {"claimed": 3000}
+
+    response = client.get(f"/v1/process/{job_id}")
+
+    assert response.status_code == 200
+    assert response.json() == {"job_id": str(job_id), "status": "started", "claimed": 3000}
+
+
+def test_get_non_exist_process_status(mocker):
+    mocker.patch("src.api.v1.ticket_api.Job.fetch", side_effect=NoSuchJobError)
+    response = client.get(f"/v1/process/{uuid.uuid4()}")
+    assert response.status_code == 404
+
+
+def test_create_tickets_bulk(mocker):
+    save_tickets = mocker.patch("src.api.v1.ticket_api.save_tickets_async")
+    bulk_enqueue = mocker.patch("src.api.v1.ticket_api.bulk_enqueue_tickets")
+    mocker.patch("src.api.v1.ticket_api.settings.BULK_CHUNK_SIZE", 2)
+    ticket = {"subject": "title", "body": "body", "customer_email": "user@example.com"}
+
+    response = client.post("/v1/tickets/bulk",
+                           json=[ticket, {"subject": "no body"}, ticket, ticket])
+
+    assert response.status_code == 201
+    json = response.json()
+    assert json["created"] == 3
+    assert json["failed"] == 1
+    assert [item["index"] for item in json["items"]] == [0, 1, 2, 3]
+    assert json["items"][1]["error"] and json["items"][1]["ticket_id"] is None
+    # chunks of 2 valid tickets, each inserted once and enqueued through one pipeline
+    assert save_tickets.call_count == 2
+    assert bulk_enqueue.call_count == 2
+    assert len(bulk_enqueue.call_args_list[0].args[0]) == 2
+
+
+def test_create_tickets_bulk_ndjson(mocker):
+    mocker.patch("src.api.v1.ticket_api.save_tickets_async")
+    mocker.patch("src.api.v1.ticket_api.bulk_enqueue_tickets")
+    lines = ['{"subject": "a", "body": "b", "customer_email": "user@example.com"}',
+             'not json',
+             '{"subject": "c", "body": "d", "customer_email": "user@example.com"}']
+
+    response = client.post("/v1/tickets/bulk", content="\n".join(lines) + "\n",
+                           headers={"content-type": "application/x-ndjson"})
+
+    assert response.status_code == 201
+    assert response.json()["created"] == 2
+    assert response.json()["items"][1]["error"]
+
+
+def test_create_tickets_bulk_invalid_body():
+    response = client.post("/v1/tickets/bulk", json={"subject": "not an array"})
+    assert response.status_code == 400
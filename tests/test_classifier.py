@@ -0,0 +1,73 @@
+import uuid
+
+import pytest
+
+from src.core import classifier
+from src.models.schemas import ClassifiedBy, TicketCategory, TicketPriority, TicketStatus
+from src.models.ticket import Ticket
+
+pytest.importorskip("sklearn")
+
+
+@pytest.fixture
+def db(session_factory):
+    session = session_factory()
+    samples = [("Can't log in", "I forgot my password and can't login to my account",
+                TicketCategory.ACCOUNT_ACCESS, TicketPriority.HIGH),
+               ("Dark mode please", "It would be great to add a dark mode feature to the app",
+                TicketCategory.FEATURE_REQUEST, TicketPriority.LOW)]
+    session.add_all([Ticket(id=uuid.uuid4(), subject=subject, body=body,
+                            customer_email="test@email.com",
+                            status=TicketStatus.PROCESSED,
+                            category=category, category_confidence=0.95,
+                            priority=priority, priority_confidence=0.9,
+                            classified_by=classified_by)
+                     for _ in range(20) for subject, body, category, priority in samples
+                     for classified_by in (ClassifiedBy.LLM, None)])
+    # wrong local predictions aren't learned
+    session.add_all([Ticket(id=uuid.uuid4(), subject=subject, body=body,
+                            customer_email="test@email.com",
+                            status=TicketStatus.PROCESSED,
+                            category=TicketCategory.UNKNOWN, category_confidence=0.99,
+                            priority=TicketPriority.LOW, priority_confidence=0.99,
+                            classified_by=ClassifiedBy.LOCAL)
+                     for _ in range(100) for subject, body, _, _ in samples])
+    session.commit()
+    yield session
+    session.close()
+
+
+def test_train_save_and_predict(db, tmp_path):
+    model = classifier.train(db, epochs=5)
+    path = str(tmp_path / "classifier.pkl")
+    model.save(path)
+
+    result = classifier.LocalClassifier.load(path).predict("Login", "can't access my account")
+
+    assert result.category == TicketCategory.ACCOUNT_ACCESS
+    assert result.priority == TicketPriority.HIGH
+    assert result.category_confidence > 0.5
+    assert result.classified_by == ClassifiedBy.LOCAL
+
+
+def test_worker_preloads_classifier(mocker):
+    from rq import Worker
+
+    from src.core import worker
+    load = mocker.patch.object(worker, "get_local_classifier")
+    work = mocker.patch.object(Worker, "work", return_value=True)
+
+    assert worker.TicketWorker.work(mocker.Mock(spec=worker.TicketWorker), burst=True)
+    load.assert_called_once_with()
+    work.assert_called_once()
+
+
+def test_classify_locally_threshold(mocker, db):
+    mocker.patch.object(classifier, "get_local_classifier", return_value=classifier.train(db))
+    ticket = Ticket(id=uuid.uuid4(), subject="Dark mode", body="please add a dark mode feature")
+
+    mocker.patch.object(classifier.settings, "LOCAL_CLASSIFIER_THRESHOLD", 0.0)
+    assert classifier.classify_locally(ticket).category == TicketCategory.FEATURE_REQUEST
+
+    mocker.patch.object(classifier.settings, "LOCAL_CLASSIFIER_THRESHOLD", 1.0)
+    assert classifier.classify_locally(ticket) is None
@@ -0,0 +1,91 @@
+import csv
+import io
+import json
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.core import export
+from src.core.export import EXPORT_FIELDS, export_tickets, parse_fields
+from src.models.schemas import TicketStatus, TicketCategory
+from src.models.ticket import save_tickets
+
+START = datetime(2024, 1, 1)
+
+
+def rows(count):
+    return [dict(id=uuid.uuid4(), subject=f"subject {i}", body=f"body, \"quoted\"\n{i}",
+                 customer_email="test@email.com",
+                 status=TicketStatus.PROCESSED if i % 2 else TicketStatus.SUBMITTED,
+                 category=TicketCategory.ACCOUNT_ACCESS if i % 2 else None,
+                 category_confidence=0.5 if i % 2 else None,
+                 created_at=START + timedelta(hours=i)) for i in range(count)]
+
+
+@pytest.fixture
+def session_modules():
+    return [export]
+
+
+@pytest.fixture(autouse=True)
+def tickets(db):
+    save_tickets(db, rows(25))
+
+
+def test_parse_fields():
+    assert parse_fields(None) == EXPORT_FIELDS
+    assert parse_fields(" id, subject ") == ["id", "subject"]
+    with pytest.raises(ValueError):
+        parse_fields("id,password")
+    with pytest.raises(ValueError):
+        parse_fields(",")
+
+
+def test_export_ndjson_in_chunks():
+    chunks = list(export_tickets("ndjson", EXPORT_FIELDS, chunk_size=10))
+
+    assert len(chunks) == 3
+    tickets = [json.loads(line) for chunk in chunks for line in chunk.decode().splitlines()]
+    assert len(tickets) == 25
+    assert tickets[0]["subject"] == "subject 0"
+    assert tickets[0]["created_at"] == START.isoformat()
+    assert tickets[0]["category"] is None
+    assert tickets[1]["status"] == "processed"
+    assert tickets[1]["category"] == "Account Access"
+    assert tickets[1]["category_confidence"] == 0.5
+    uuid.UUID(tickets[1]["id"])
+
+
+def test_export_csv_filtered_projection():
+    data = b"".join(export_tickets("csv", ["subject", "body", "status"],
+                                   status=TicketStatus.PROCESSED,
+                                   created_from=START + timedelta(hours=5),
+                                   created_to=START + timedelta(hours=11), chunk_size=2))
+
+    tickets = list(csv.reader(io.StringIO(data.decode())))
+    assert tickets[0] == ["subject", "body", "status"]
+    assert [ticket[0] for ticket in tickets[1:]] == ["subject 5", "subject 7", "subject 9"]
+    assert tickets[1][1] == "body, \"quoted\"\n5"
+    assert tickets[1][2] == "processed"
+
+
+def test_export_csv_empty():
+    data = b"".join(export_tickets("csv", ["id", "subject"], category=TicketCategory.UNKNOWN))
+
+    assert data == b"id,subject\r\n"
+
+
+def test_export_parquet_row_group_per_chunk():
+    pq = pytest.importorskip("pyarrow.parquet")
+
+    data = b"".join(export_tickets("parquet", ["id", "status", "created_at",
+                                               "category_confidence"], chunk_size=10))
+
+    parquet = pq.ParquetFile(io.BytesIO(data))
+    assert parquet.metadata.num_rows == 25
+    assert parquet.metadata.num_row_groups == 3
+    tickets = parquet.read().to_pylist()
+    assert tickets[1]["status"] == "processed"
+    assert tickets[1]["created_at"] == START + timedelta(hours=1)
+    assert tickets[0]["category_confidence"] is None
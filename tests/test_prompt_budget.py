@@ -0,0 +1,40 @@
+from src.core.prompt_budget import fit_body
+from src.core.ratelimit import estimate_tokens
+
+
+def test_fit_body_within_budget():
+    assert fit_body("short body", 100) == "short body"
+    assert fit_body("", 100) == ""
+
+
+def test_fit_body_collapses_repeated_lines():
+    body = "export fails\n" + "retrying\n" * 200 + "thanks"
+
+    assert fit_body(body, 100) == "export fails\nretrying [repeated 200 times]\nthanks"
+
+
+def test_fit_body_keeps_head_tail_and_relevant_lines():
+    body = "\n".join(["Hi, my export fails."]
+                     + [f"DEBUG step {i}" for i in range(1000)]
+                     + ["ERROR export failed: timeout"]
+                     + [f"DEBUG after {i}" for i in range(1000)]
+                     + ["Thanks, Bob"])
+
+    fitted = fit_body(body, 300)
+
+    assert estimate_tokens(fitted) <= 300
+    lines = fitted.splitlines()
+    assert lines[:2] == ["Hi, my export fails.", "DEBUG step 0"]
+    assert lines[-1] == "Thanks, Bob"
+    assert "ERROR export failed: timeout" in lines
+    assert lines[lines.index("ERROR export failed: timeout") - 1].endswith("lines omitted ...]")
+
+
+def test_fit_body_cuts_long_lines():
+    body = "a" * 5000 + "b" * 5000
+
+    fitted = fit_body(body, 100)
+
+    assert estimate_tokens(fitted) <= 100
+    assert fitted.startswith("aaa") and fitted.endswith("bbb")
+    assert "[... truncated ...]" in fitted
@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+from prometheus_client import REGISTRY
+
+from src.core.ratelimit import RateLimiter, estimate_tokens, retry_after
+
+
+class RateLimited(Exception):
+    status_code = 429
+
+    def __init__(self, headers):
+        super().__init__("rate limited")
+        self.response = type("Response", (), {"headers": headers})()
+
+
+@pytest.fixture
+def limiter(mocker):
+    limiter = RateLimiter("anthropic", 60, 1000, mocker.Mock())
+    limiter._acquire = mocker.Mock(return_value=[b"0", b"1"])
+    limiter._penalize = mocker.Mock(return_value=b"0.5")
+    limiter._recover = mocker.Mock(return_value=b"0.55")
+    return limiter
+
+
+def test_estimate_tokens():
+    assert estimate_tokens("a" * 40, "b" * 4) == 11
+
+
+def test_acquire_waits_for_bucket(mocker, limiter):
+    limiter._acquire.side_effect = [[b"0.01", b"1"], [b"0", b"1"]]
+
+    asyncio.run(limiter.acquire(100))
+
+    assert limiter._acquire.call_count == 2
+    assert limiter._acquire.call_args.kwargs["args"] == [60, 1000, 100]
+    assert limiter.stats()["avg_wait_seconds"] >= 0.01
+    assert limiter.stats()["waiting"] == 0
+
+
+def test_rate_limited_call_backs_off(limiter):
+    async def call():
+        async with limiter.limit(10):
+            raise RateLimited({"retry-after": "3"})
+
+    with pytest.raises(RateLimited):
+        asyncio.run(call())
+
+    assert limiter._penalize.call_args.kwargs["args"] == [RateLimiter.MIN_FACTOR, 3.0]
+    assert limiter.stats()["requests_per_minute"] == 30
+    assert limiter.stats()["rate_limited"] == 1
+
+
+def test_rate_limit_gauges(limiter):
+    limiter.factor = 0.5
+    limiter.acquired, limiter.wait_seconds = 4, 2.0
+
+    assert REGISTRY.get_sample_value("llm_rate_limit",
+                                     {"provider": "anthropic", "type": "tokens"}) == 500
+    assert REGISTRY.get_sample_value("llm_rate_limit_avg_wait_seconds",
+                                     {"provider": "anthropic"}) == 0.5
+
+
+def test_successful_call_recovers_limit(limiter):
+    limiter._acquire.return_value = [b"0", b"0.5"]
+
+    async def call():
+        async with limiter.limit(10):
+            pass
+
+    asyncio.run(call())
+
+    assert limiter._recover.call_count == 1
+    assert limiter.factor == 0.55
+
+
+def test_retry_after_missing():
+    assert retry_after(RateLimited({})) is None
+    assert retry_after(Exception()) is None
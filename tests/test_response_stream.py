@@ -0,0 +1,95 @@
+import asyncio
+import uuid
+
+import pytest
+
+from src.core import response_stream
+from src.core.response_stream import ResponseEvent, read_response_stream, sse_event
+from src.core.response_stream import finish_response_stream, reset_response_stream
+from src.core.response_stream import stream_response
+
+
+@pytest.fixture
+def client(mocker):
+    client = mocker.AsyncMock()
+    mocker.patch.object(response_stream.aioredis.Redis, "from_url", return_value=client)
+    return client
+
+
+async def chunks(*parts):
+    for part in parts:
+        yield part
+
+
+def test_stream_response(client):
+    ticket_id = uuid.uuid4()
+
+    response = asyncio.run(stream_response(ticket_id, chunks("Thanks ", "", "for reaching out")))
+
+    assert response == "Thanks for reaching out"
+    assert [call.args for call in client.xadd.call_args_list] == \
+        [(f"ticket-response:{ticket_id}", {"token": "Thanks "}),
+         (f"ticket-response:{ticket_id}", {"token": "for reaching out"})]
+    client.aclose.assert_awaited_once()
+
+
+def test_stream_response_redis_down(client):
+    client.xadd.side_effect = response_stream.RedisError("down")
+
+    response = asyncio.run(stream_response(uuid.uuid4(), chunks("Thanks ", "for reaching out")))
+
+    # tokens aren't published anymore, the response is still generated
+    assert response == "Thanks for reaching out"
+    assert client.xadd.await_count == 1
+
+
+def test_reset_response_stream(mocker):
+    redis_conn = mocker.patch.object(response_stream, "redis_conn")
+    ticket_id = uuid.uuid4()
+
+    # the events of a failed attempt and their expiry are dropped for the retry
+    finish_response_stream(ticket_id, error="Response failed, ticket will be retried")
+    reset_response_stream(ticket_id)
+
+    redis_conn.delete.assert_called_once_with(f"ticket-response:{ticket_id}")
+    redis_conn.delete.side_effect = response_stream.RedisError("down")
+    reset_response_stream(ticket_id)
+
+
+def test_read_response_stream(client):
+    ticket_id = uuid.uuid4()
+    key = f"ticket-response:{ticket_id}".encode()
+    client.xread.side_effect = [
+        [[key, [(b"1-0", {b"token": b"Thanks "}), (b"1-1", {b"token": b"for"})]]],
+        [],
+        [[key, [(b"2-0", {b"done": b"Thanks for"}), (b"2-1", {b"token": b"ignored"})]]],
+    ]
+
+    async def read():
+        return [event async for event in read_response_stream(ticket_id, "0-1", block=1)]
+
+    events = asyncio.run(read())
+
+    assert events == [ResponseEvent("1-0", "token", "Thanks "),
+                      ResponseEvent("1-1", "token", "for"),
+                      None,
+                      ResponseEvent("2-0", "done", "Thanks for")]
+    # reads resume after the last event
+    assert [call.args[0] for call in client.xread.call_args_list] == \
+        [{f"ticket-response:{ticket_id}": "0-1"}, {f"ticket-response:{ticket_id}": "1-1"},
+         {f"ticket-response:{ticket_id}": "1-1"}]
+
+
+def test_read_response_stream_timeout(client):
+    client.xread.return_value = []
+
+    async def read():
+        return [event async for event in read_response_stream(uuid.uuid4(), block=1, timeout=3)]
+
+    assert asyncio.run(read()) == [None, None, None]
+
+
+def test_sse_event():
+    assert sse_event("token", "line\nbreak", "1-0") == \
+        'id: 1-0\nevent: token\ndata: "line\\nbreak"\n\n'
+    assert sse_event("done", "ok") == 'event: done\ndata: "ok"\n\n'
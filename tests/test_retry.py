@@ -0,0 +1,136 @@
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from src.core import retry
+from src.core.config import settings
+from src.core.ticket_cache import ticket_cache
+from src.models.schemas import TicketPriority, TicketStatus
+from src.models.ticket import Ticket, claim_tickets
+
+
+@pytest.fixture(autouse=True)
+def local_ticket_cache(mocker):
+    mocker.patch.object(ticket_cache, "redis", None)
+    ticket_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def record_transition(mocker):
+    return mocker.patch.object(retry, "record_transition")
+
+
+@pytest.fixture(autouse=True)
+def process_tickets(mocker):
+    return mocker.patch.object(retry, "process_tickets")
+
+
+@pytest.fixture(autouse=True)
+def enqueue_responses(mocker):
+    return mocker.patch.object(retry, "enqueue_responses")
+
+
+@pytest.fixture
+def session_modules():
+    return [retry]
+
+
+def add_ticket(factory, **fields) -> uuid.UUID:
+    ticket_id = uuid.uuid4()
+    with factory() as db:
+        db.add(Ticket(id=ticket_id, subject="subject", body="body",
+                      customer_email="test@email.com", **fields))
+        db.commit()
+    return ticket_id
+
+
+def test_backoff_delay(mocker):
+    mocker.patch.object(settings, "RETRY_BACKOFF_BASE", 30.0)
+    mocker.patch.object(settings, "RETRY_BACKOFF_MAX", 100.0)
+
+    assert 15 <= retry.backoff_delay(1) <= 30
+    assert 30 <= retry.backoff_delay(2) <= 60
+    # capped, and still jittered
+    assert 50 <= retry.backoff_delay(10) <= 100
+
+
+def test_fail_attempt_dead_letters(mocker):
+    mocker.patch.object(settings, "TICKET_MAX_ATTEMPTS", 2)
+    ticket = Ticket(id=uuid.uuid4(), attempts=1)
+
+    assert retry.fail_attempt(ticket, "boom") == TicketStatus.SUBMITTED
+    assert ticket.next_attempt_at > datetime.utcnow()
+    assert ticket.lease_expires_at is None
+
+    ticket.attempts = 2
+    assert retry.fail_attempt(ticket, "boom again") == TicketStatus.FAILED
+    assert ticket.attempts == 2
+    assert ticket.next_attempt_at is None
+    assert ticket.last_error == "boom again"
+
+
+def test_sweep_tickets(session_factory, process_tickets, record_transition):
+    now = datetime.utcnow()
+    expired = add_ticket(session_factory, status=TicketStatus.PROCESSING, attempts=1,
+                         lease_expires_at=now - timedelta(seconds=1))
+    leased = add_ticket(session_factory, status=TicketStatus.PROCESSING, attempts=1,
+                        lease_expires_at=now + timedelta(seconds=60))
+    due = add_ticket(session_factory, attempts=1, next_attempt_at=now - timedelta(seconds=1))
+    add_ticket(session_factory, attempts=1, next_attempt_at=now + timedelta(seconds=60))
+
+    assert retry.sweep_tickets() == (1, 1)
+
+    # the due retry is claimed and enqueued, the expired lease waits for its backoff
+    process_tickets.assert_called_once_with([due])
+    with session_factory() as db:
+        ticket = db.get(Ticket, expired)
+        assert ticket.status == TicketStatus.SUBMITTED
+        assert ticket.next_attempt_at > now
+        assert ticket.last_error.startswith("Processing lease expired")
+        assert db.get(Ticket, leased).status == TicketStatus.PROCESSING
+        assert db.get(Ticket, due).status == TicketStatus.PROCESSING
+    assert [call.args for call in record_transition.call_args_list] == [
+        (TicketStatus.PROCESSING, TicketStatus.SUBMITTED, 1),
+        (TicketStatus.SUBMITTED, TicketStatus.PROCESSING, 1)
+    ]
+
+
+def test_sweep_tickets_classified(session_factory, process_tickets, enqueue_responses):
+    due = datetime.utcnow() - timedelta(seconds=1)
+    unclassified = add_ticket(session_factory, attempts=1, next_attempt_at=due)
+    # its response failed, only the response is retried
+    classified = add_ticket(session_factory, attempts=1, next_attempt_at=due,
+                            priority=TicketPriority.HIGH)
+
+    assert retry.sweep_tickets() == (0, 2)
+
+    enqueue_responses.assert_called_once_with([(classified, TicketPriority.HIGH)])
+    process_tickets.assert_called_once_with([unclassified])
+    with session_factory() as db:
+        ticket = db.get(Ticket, classified)
+        assert ticket.status == TicketStatus.PROCESSING
+        assert ticket.attempts == 2
+
+
+def test_sweep_tickets_enqueue_failed(session_factory, process_tickets):
+    due = add_ticket(session_factory, attempts=1,
+                     next_attempt_at=datetime.utcnow() - timedelta(seconds=1))
+    process_tickets.side_effect = ConnectionError("redis down")
+
+    with pytest.raises(ConnectionError):
+        retry.sweep_tickets()
+
+    with session_factory() as db:
+        ticket = db.get(Ticket, due)
+        assert ticket.status == TicketStatus.SUBMITTED
+        assert ticket.lease_expires_at is None
+
+
+def test_claim_tickets_skips_pending_retries(session_factory):
+    now = datetime.utcnow()
+    fresh = add_ticket(session_factory)
+    add_ticket(session_factory, attempts=1, next_attempt_at=now + timedelta(seconds=60))
+
+    with session_factory() as db:
+        ticket_ids, after = claim_tickets(db, 10)
+        assert ticket_ids == [fresh]
@@ -0,0 +1,98 @@
+import asyncio
+
+import pytest
+from langchain_core.exceptions import OutputParserException
+
+from src.core.router import CircuitBreaker, NoProviderAvailable, ProviderRouter
+
+
+@pytest.fixture
+def router():
+    return ProviderRouter(window=10, error_rate=0.5, min_calls=4, cooldown=30.0,
+                          hedge_min_samples=3, hedge_max_delay=10.0)
+
+
+def calls(**latencies):
+    """Provider call sleeping its latency, raising it instead if it's an exception."""
+    called = []
+
+    async def call(provider):
+        called.append(provider)
+        latency = latencies[provider]
+        if isinstance(latency, Exception):
+            raise latency
+        await asyncio.sleep(latency)
+        return provider
+
+    return call, called
+
+
+def test_circuit_breaker(mocker):
+    monotonic = mocker.patch("src.core.router.time.monotonic", return_value=0.0)
+    breaker = CircuitBreaker(window=10, error_rate=0.5, min_calls=4, cooldown=30.0)
+
+    for success in (True, False, True, False):
+        assert breaker.allow()
+        breaker.record(success)
+    assert breaker.state == "open"
+    assert not breaker.allow()
+
+    # a single trial call after the cooldown, cancelling it lets another one through
+    monotonic.return_value = 31.0
+    assert breaker.allow()
+    assert not breaker.allow()
+    breaker.cancel()
+    assert breaker.allow()
+    breaker.record(True)
+    assert breaker.state == "closed"
+
+
+def test_router_hedges_slow_primary(router):
+    for _ in range(3):
+        router.record_success("primary", "classify", 0.01)
+    call, called = calls(primary=5.0, secondary=0.01)
+
+    result = asyncio.run(asyncio.wait_for(router.call("classify", ["primary", "secondary"], call),
+                                          timeout=1.0))
+
+    assert result == "secondary"
+    assert called == ["primary", "secondary"]
+
+
+def test_router_no_hedge_without_samples(router):
+    call, called = calls(primary=0.05, secondary=0.01)
+
+    assert asyncio.run(router.call("classify", ["primary", "secondary"], call)) == "primary"
+    assert called == ["primary"]
+
+
+def test_router_fails_over(router):
+    call, called = calls(primary=Exception("529"), secondary=0.01)
+
+    for _ in range(5):
+        assert asyncio.run(router.call("classify", ["primary", "secondary"], call)) == "secondary"
+
+    # the circuit of primary opens after 4 failures
+    assert called.count("primary") == 4
+    assert router.breaker("primary").state == "open"
+
+
+def test_router_parse_errors_keep_circuit_closed(router):
+    call, _ = calls(primary=OutputParserException("invalid json"), secondary=0.01)
+
+    for _ in range(5):
+        asyncio.run(router.call("classify", ["primary", "secondary"], call))
+
+    assert router.breaker("primary").state == "closed"
+
+
+def test_router_all_failed(router):
+    call, _ = calls(primary=Exception("529"), secondary=Exception("500"))
+
+    with pytest.raises(Exception, match="500"):
+        asyncio.run(router.call("classify", ["primary", "secondary"], call))
+    for _ in range(4):
+        router.breaker("primary").record(False)
+        router.breaker("secondary").record(False)
+    with pytest.raises(NoProviderAvailable):
+        asyncio.run(router.call("classify", ["primary", "secondary"], call))
@@ -0,0 +1,100 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+from sqlalchemy import update
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.models.database import Base
+from src.models.schemas import TicketStatus
+from src.models.search import create_search_index, search_tickets, search_tickets_async
+from src.models.search import search_truncated, search_truncated_async
+from src.models.search import encode_search_cursor, decode_search_cursor
+from src.models.ticket import Ticket, save_tickets
+
+
+def rows(count, subject="password reset", body="I can't login to my account"):
+    return [dict(id=uuid.uuid4(), subject=subject, body=f"{body} {i}",
+                 customer_email="test@email.com",
+                 status=TicketStatus.PROCESSED if i % 2 else TicketStatus.SUBMITTED,
+                 created_at=datetime.utcnow()) for i in range(count)]
+
+
+def test_index_existing_and_new_tickets(engine, db):
+    save_tickets(db, rows(3))
+    with engine.begin() as conn:
+        create_search_index(conn)
+    save_tickets(db, rows(2, subject="feature request", body="please add dark mode"))
+
+    assert len(search_tickets(db, "passwords", 10)) == 3
+    assert len(search_tickets(db, "Dark-Mode", 10)) == 2
+    assert search_tickets(db, "password mode", 10) == []
+    # fts5 syntax in the query is searched as words
+    assert search_tickets(db, 'dark" OR "password', 10) == []
+
+
+def test_index_processing_updates(engine, db):
+    with engine.begin() as conn:
+        create_search_index(conn)
+    save_tickets(db, rows(2))
+    ticket_id = search_tickets(db, "login", 1)[0][0].id
+
+    db.execute(update(Ticket).where(Ticket.id == ticket_id)
+               .values(initial_response="We sent you a reset link"))
+    db.commit()
+
+    assert [ticket.id for ticket, _ in search_tickets(db, "link", 10)] == [ticket_id]
+
+
+def test_search_ranks_filters_and_paginates(engine, db):
+    with engine.begin() as conn:
+        create_search_index(conn)
+    save_tickets(db, rows(7) + rows(1, subject="refund", body="refund refund refund"))
+
+    assert search_tickets(db, "refund", 1)[0][0].subject == "refund"
+    submitted = search_tickets(db, "login", 10, status=TicketStatus.SUBMITTED)
+    assert len(submitted) == 4
+    assert {ticket.status for ticket, _ in submitted} == {TicketStatus.SUBMITTED}
+
+    pages, cursor = [], None
+    while True:
+        page = search_tickets(db, "login", 3, cursor=cursor)
+        if not page:
+            break
+        pages.extend(page)
+        cursor = decode_search_cursor(encode_search_cursor(page[-1][1], page[-1][0].id))
+    assert len({ticket.id for ticket, _ in pages}) == 7
+    assert [score for _, score in pages] == sorted((score for _, score in pages), reverse=True)
+
+
+def test_search_ranks_most_recent_candidates(mocker, engine, db):
+    mocker.patch("src.models.search.settings.SEARCH_MAX_CANDIDATES", 2)
+    with engine.begin() as conn:
+        create_search_index(conn)
+    save_tickets(db, rows(1, subject="refund", body="refund refund refund") + rows(3))
+
+    results = search_tickets(db, "refund", 10)
+    assert len(search_tickets(db, "login", 10)) == 2
+    assert [ticket.subject for ticket, _ in results] == ["refund"]
+    # the oldest login ticket is left out
+    assert search_truncated(db, "login")
+    assert not search_truncated(db, "login", status=TicketStatus.PROCESSED)
+    assert not search_truncated(db, "refund")
+
+
+def test_search_tickets_async(tmp_path):
+    async def run():
+        async_engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/tickets.db")
+        async with async_engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+            await conn.run_sync(create_search_index)
+        async with async_sessionmaker(async_engine)() as db:
+            await db.run_sync(lambda session: save_tickets(session, rows(2)))
+            results = await search_tickets_async(db, "account", 10)
+            truncated = await search_truncated_async(db, "account")
+        await async_engine.dispose()
+        return results, truncated
+
+    results, truncated = asyncio.run(run())
+    assert len(results) == 2
+    assert not truncated
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from src.core import stats
+from src.models.schemas import TicketCategory, TicketPriority, TicketStatus
+
+NOW = datetime(2024, 1, 2, 12, 30, 15)
+
+
+def row(status, created_at=NOW - timedelta(minutes=1), seconds=None):
+    return SimpleNamespace(status=status,
+                           category=TicketCategory.UNKNOWN if seconds is not None else None,
+                           priority=TicketPriority.LOW if seconds is not None else None,
+                           created_at=created_at,
+                           processed_at=created_at + timedelta(seconds=seconds)
+                           if seconds is not None else None)
+
+
+def test_aggregate():
+    rows = [row(TicketStatus.SUBMITTED),
+            row(TicketStatus.PROCESSING),
+            row(TicketStatus.PROCESSED, seconds=0.3),
+            row(TicketStatus.PROCESSED, seconds=45),
+            # older than the minute rollups retention
+            row(TicketStatus.SUBMITTED, created_at=NOW - timedelta(days=2))]
+
+    result = stats.aggregate(rows, NOW)
+
+    assert result[stats.STATS_KEY] == {"total": 5, "status:submitted": 2, "status:processing": 1,
+                                       "status:processed": 2, "category:Unknown": 2,
+                                       "priority:Low": 2}
+    assert result[stats.LATENCY_KEY] == {"0.5": 1, "60": 1, "count": 2, "sum": 45.3}
+    minute = result["ticket-stats:minute:202401021229"]
+    assert minute["created"] == 4
+    assert minute["processed"] == 1
+    assert "ticket-stats:minute:202312311229" not in result
+    assert result["ticket-stats:hour:2023123112"]["created"] == 1
+
+
+def test_percentile():
+    histogram = {"0.1": 0, "0.5": 50, "1": 50, "count": 100}
+
+    assert stats.percentile(histogram, 50) == 0.5
+    assert stats.percentile(histogram, 75) == 0.75
+    assert stats.percentile({"count": 0}, 50) is None
+
+
+def test_record_processed(mocker):
+    redis_conn = mocker.patch.object(stats, "redis_conn")
+    pipe = redis_conn.pipeline.return_value.__enter__.return_value
+
+    stats.record_processed([row(TicketStatus.PROCESSED, seconds=2)])
+
+    calls = {(call.args[0], call.args[1]): call.args[2] for call in pipe.hincrby.call_args_list}
+    assert calls[(stats.STATS_KEY, "status:processing")] == -1
+    assert calls[(stats.STATS_KEY, "status:processed")] == 1
+    assert calls[(stats.LATENCY_KEY, "2.5")] == 1
+    assert pipe.hincrbyfloat.call_args_list[0].args == (stats.LATENCY_KEY, "sum", 2.0)
+    assert pipe.expireat.called
+    pipe.execute.assert_called_once()
+
+
+def test_get_stats(mocker):
+    redis_conn = mocker.patch.object(stats, "redis_conn")
+    pipe = redis_conn.pipeline.return_value.__enter__.return_value
+    minute = {b"created": b"3", b"processed": b"2", b"processing_seconds": b"3.0"}
+    pipe.execute.return_value = ([{b"total": b"3", b"status:processed": b"2"},
+                                  {b"1": b"2", b"count": b"2", b"sum": b"1.5"}]
+                                 + [{}] * 59 + [minute] + [{}] * 24)
+
+    result = stats.get_stats(NOW)
+
+    assert result["total"] == 3
+    assert result["by_status"] == {"processed": 2}
+    assert result["processing_seconds"]["mean"] == 0.75
+    assert result["per_minute"][-1] == {"start": datetime(2024, 1, 2, 12, 30), "created": 3,
+                                        "processed": 2, "mean_processing_seconds": 1.5}
+    assert len(result["per_hour"]) == 24
@@ -0,0 +1,139 @@
+import asyncio
+import uuid
+from datetime import datetime, timedelta
+
+import pytest
+from sqlalchemy import insert, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.models.database import Base
+from src.models.schemas import TicketStatus
+from src.models.ticket import Ticket, filter_ticket, count_ticket, encode_cursor, decode_cursor
+from src.models.ticket import save_ticket_async, get_ticket_async, count_ticket_async
+from src.models.ticket import filter_ticket_async, claim_tickets, release_tickets
+from src.models.ticket import filter_ticket_rows_async, archive_tickets, ArchivedTicket
+from src.models.ticket import TICKET_COLUMNS
+
+
+@pytest.fixture
+def tickets(db):
+    created_at = datetime(2024, 1, 1)
+    tickets = [Ticket(id=uuid.uuid4(),
+                      subject=f"subject {i}",
+                      body=f"body {i}",
+                      customer_email="test@email.com",
+                      status=TicketStatus.PROCESSED if i % 2 else TicketStatus.SUBMITTED,
+                      # pairs of tickets share the same created_at
+                      created_at=created_at + timedelta(seconds=i // 2)) for i in range(10)]
+    db.add_all(tickets)
+    db.commit()
+    return sorted(tickets, key=lambda t: (t.created_at, t.id))
+
+
+def test_cursor_roundtrip(tickets):
+    assert decode_cursor(encode_cursor(tickets[0])) == (tickets[0].created_at, tickets[0].id)
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor")
+
+
+def test_filter_ticket_by_cursor(db, tickets):
+    pages, cursor = [], None
+    while True:
+        page = filter_ticket(db, 1, 3, cursor=cursor)
+        if not page:
+            break
+        pages.extend(page)
+        cursor = decode_cursor(encode_cursor(page[-1]))
+
+    assert [t.id for t in pages] == [t.id for t in tickets]
+    assert filter_ticket(db, 2, 3) == tickets[3:6]
+
+
+def test_count_ticket(db, tickets):
+    assert count_ticket(db) == 10
+    assert count_ticket(db, status=TicketStatus.SUBMITTED) == 5
+    assert len(filter_ticket(db, 1, 3, status=TicketStatus.SUBMITTED)) == 3
+
+
+def test_claim_tickets(db, tickets):
+    submitted = [t.id for t in tickets if t.status == TicketStatus.SUBMITTED]
+    claimed, after = claim_tickets(db, 3)
+    assert sorted(claimed) == sorted(submitted[:3])
+    claimed, after = claim_tickets(db, 3, after)
+    assert sorted(claimed) == sorted(submitted[3:])
+    assert claim_tickets(db, 3, after) == ([], None)
+    # claimed tickets are not claimed twice
+    assert claim_tickets(db, 10) == ([], None)
+    db.expire_all()
+    assert count_ticket(db, status=TicketStatus.PROCESSING) == 5
+
+    release_tickets(db, submitted[:2])
+    assert count_ticket(db, status=TicketStatus.SUBMITTED) == 2
+
+
+def test_async_ticket_functions(tmp_path):
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/tickets.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        async with async_sessionmaker(engine, expire_on_commit=False)() as db:
+            ticket = Ticket(id=uuid.uuid4(), subject="s", body="b", customer_email="a@b.com")
+            await save_ticket_async(db, ticket)
+            assert ticket.created_at is not None
+            assert (await get_ticket_async(db, ticket.id)).subject == "s"
+            assert await count_ticket_async(db, status=TicketStatus.SUBMITTED) == 1
+            assert await filter_ticket_async(db, 1, 10, cursor=(ticket.created_at, ticket.id)) == []
+            rows = await filter_ticket_rows_async(db, ["subject", "status"], 1, 10)
+            assert [tuple(row) for row in rows] == [("s", TicketStatus.SUBMITTED)]
+        await engine.dispose()
+
+    asyncio.run(run())
+
+
+def test_archive_tickets(db, tickets):
+    processed = [t.id for t in tickets if t.status == TicketStatus.PROCESSED]
+    subjects = {t.id: t.subject for t in tickets}
+
+    assert archive_tickets(db, datetime(2024, 1, 1, 0, 0, 3), 2) == 2
+    assert archive_tickets(db, datetime(2024, 1, 1, 0, 0, 3), 2) == 1
+    assert archive_tickets(db, datetime(2024, 1, 1, 0, 0, 3), 2) == 0
+
+    # the oldest processed tickets are moved, submitted ones are kept
+    archived = db.scalars(select(ArchivedTicket.id).order_by(ArchivedTicket.created_at)).all()
+    assert archived == processed[:3]
+    assert count_ticket(db) == 7
+    assert db.get(ArchivedTicket, processed[0]).subject == subjects[processed[0]]
+
+
+def test_filter_archived_tickets(tmp_path, tickets):
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/tickets.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        # even tickets live, odd ones archived
+        async with engine.begin() as conn:
+            for i, ticket in enumerate(tickets):
+                table = ArchivedTicket if i % 2 else Ticket
+                await conn.execute(insert(table), [{column: getattr(ticket, column)
+                                                    for column in TICKET_COLUMNS}])
+        async with async_sessionmaker(engine, expire_on_commit=False)() as db:
+            fields = ["id", "created_at"]
+            assert await count_ticket_async(db) == 5
+            assert await count_ticket_async(db, archived=True) == 10
+            assert len(await filter_ticket_rows_async(db, fields, 1, 10)) == 5
+
+            pages, cursor = [], None
+            while page := await filter_ticket_rows_async(db, fields, 1, 3, cursor=cursor,
+                                                         archived=True):
+                pages.extend(page)
+                cursor = (page[-1].created_at, page[-1].id)
+            assert [row.id for row in pages] == [t.id for t in tickets]
+            page = await filter_ticket_rows_async(db, fields, 2, 3, archived=True)
+            assert [row.id for row in page] == [t.id for t in tickets[3:6]]
+
+            # archived tickets are still found by id
+            assert isinstance(await get_ticket_async(db, tickets[1].id), ArchivedTicket)
+            assert isinstance(await get_ticket_async(db, tickets[0].id), Ticket)
+        await engine.dispose()
+
+    asyncio.run(run())
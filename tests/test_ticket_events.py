@@ -0,0 +1,85 @@
+import asyncio
+import json
+import uuid
+from datetime import datetime
+
+import pytest
+
+from src.core import ticket_events
+from src.core.ticket_cache import serialize_ticket
+from src.core.ticket_events import TicketWaiter, publish_ticket_done
+from src.models.schemas import TicketStatus
+from src.models.ticket import Ticket
+
+
+def make_ticket(status: TicketStatus) -> Ticket:
+    return Ticket(id=uuid.uuid4(), subject="test", body="test", customer_email="test@email.com",
+                  created_at=datetime.utcnow(), status=status)
+
+
+class FakePubSub:
+    """Pubsub delivering the messages put on its queue."""
+
+    def __init__(self):
+        self.messages = asyncio.Queue()
+        self.channels = []
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def subscribe(self, channel):
+        self.channels.append(channel)
+
+    async def listen(self):
+        yield {"type": "subscribe", "data": 1}
+        while True:
+            yield await self.messages.get()
+
+
+@pytest.fixture
+def redis_conn(mocker):
+    return mocker.patch.object(ticket_events, "redis_conn")
+
+
+def test_publish_ticket_done(redis_conn):
+    ticket = make_ticket(TicketStatus.PROCESSED)
+
+    publish_ticket_done(ticket.id, serialize_ticket(ticket))
+    publish_ticket_done(ticket.id, serialize_ticket(make_ticket(TicketStatus.PROCESSING)))
+
+    channel, data = redis_conn.publish.call_args.args
+    assert redis_conn.publish.call_count == 1
+    assert json.loads(data) == [str(ticket.id), *serialize_ticket(ticket)]
+
+
+def test_ticket_waiter(mocker):
+    pubsub = FakePubSub()
+    mocker.patch.object(ticket_events.aioredis.Redis, "from_url",
+                        return_value=mocker.Mock(pubsub=lambda: pubsub,
+                                                 aclose=mocker.AsyncMock()))
+    waiter = TicketWaiter("redis://test")
+    ticket, other = make_ticket(TicketStatus.FAILED), make_ticket(TicketStatus.PROCESSED)
+
+    async def run():
+        async def wait():
+            async with waiter.waiting(ticket.id) as done:
+                return await done
+
+        waits = [asyncio.create_task(wait()) for _ in range(3)]
+        await asyncio.sleep(0)
+        # a single subscription is shared by the waiters
+        assert waiter.waiting_count == 3
+        for done in (other, ticket):
+            await pubsub.messages.put({"type": "message", "data": json.dumps(
+                [str(done.id), *serialize_ticket(done)]).encode()})
+        return await asyncio.gather(*waits)
+
+    results = asyncio.run(run())
+
+    assert pubsub.channels == ["ticket-done"]
+    assert [cached.done for cached in results] == [True] * 3
+    assert all('"status":"failed"' in cached.body for cached in results)
+    assert waiter.waiting_count == 0
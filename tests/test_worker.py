@@ -0,0 +1,430 @@
+import asyncio
+import uuid
+
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from src.core import retry, worker
+from src.core.ticket_cache import get_cached_ticket, ticket_cache
+from src.models.database import Base
+from src.models.schemas import ClassifiedBy, TicketClassified, TicketCategory, TicketPriority
+from src.models.schemas import TicketStatus
+from src.models.ticket import Ticket, claim_tickets
+
+
+@pytest.fixture(autouse=True)
+def local_ticket_cache(mocker):
+    mocker.patch.object(ticket_cache, "redis", None)
+    ticket_cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def stats(mocker):
+    record_transition = mocker.patch.object(worker, "record_transition")
+    mocker.patch.object(retry, "record_transition", record_transition)
+    return mocker.Mock(record_transition=record_transition,
+                       record_processed=mocker.patch.object(worker, "record_processed"))
+
+
+@pytest.fixture
+def session_modules():
+    return [worker]
+
+
+@pytest.fixture
+def ticket_ids(session_factory):
+    ids = [uuid.uuid4() for _ in range(3)]
+    with session_factory() as db:
+        db.add_all([Ticket(id=ticket_id, subject="subject", body="body",
+                           customer_email="test@email.com") for ticket_id in ids])
+        db.commit()
+    return ids
+
+
+@pytest.fixture
+def classified():
+    return TicketClassified(category=TicketCategory.FEATURE_REQUEST,
+                            category_confidence=0.7,
+                            priority=TicketPriority.LOW,
+                            priority_confidence=0.6)
+
+
+@pytest.fixture(autouse=True)
+def enqueue_responses(mocker):
+    return mocker.patch.object(worker, "enqueue_responses")
+
+
+@pytest.fixture(autouse=True)
+def finish_response_stream(mocker):
+    finish_response_stream = mocker.patch.object(worker, "finish_response_stream")
+    mocker.patch.object(retry, "finish_response_stream", finish_response_stream)
+    return finish_response_stream
+
+
+@pytest.fixture(autouse=True)
+def reset_response_stream(mocker):
+    return mocker.patch.object(worker, "reset_response_stream")
+
+
+def claim(factory):
+    """claim the submitted tickets for a batch job, as /v1/process and the sweeper do"""
+    with factory() as db:
+        return claim_tickets(db, 10)[0]
+
+
+def test_process_ticket(mocker, session_factory, ticket_ids, classified, enqueue_responses):
+    mocker.patch.object(worker, "categorize_prioritize_ticket", return_value=classified)
+
+    asyncio.run(worker.process_ticket(ticket_ids[0]))
+
+    # classification is saved and the response is queued by priority
+    with session_factory() as db:
+        ticket = db.get(Ticket, ticket_ids[0])
+        assert ticket.status == TicketStatus.PROCESSING
+        assert ticket.category == TicketCategory.FEATURE_REQUEST
+        assert ticket.priority == TicketPriority.LOW
+        assert ticket.classified_by == ClassifiedBy.LLM
+        assert ticket.initial_response is None
+    assert '"category":"Feature Request"' in get_cached_ticket(ticket_ids[0]).body
+    enqueue_responses.assert_called_once_with([(ticket_ids[0], TicketPriority.LOW)])
+
+
+def test_process_ticket_claimed(mocker, session_factory, ticket_ids, stats, enqueue_responses):
+    categorize = mocker.patch.object(worker, "categorize_prioritize_ticket")
+    # claimed for a batch while the job of the ticket was queued
+    with session_factory() as db:
+        assert ticket_ids[0] in claim_tickets(db, 3)[0]
+
+    asyncio.run(worker.process_ticket(ticket_ids[0]))
+
+    categorize.assert_not_called()
+    enqueue_responses.assert_not_called()
+    stats.record_transition.assert_not_called()
+    with session_factory() as db:
+        ticket = db.get(Ticket, ticket_ids[0])
+        assert ticket.status == TicketStatus.PROCESSING
+        # the attempt started by the batch claim only
+        assert ticket.attempts == 1
+
+
+def test_process_ticket_failed(mocker, session_factory, ticket_ids, enqueue_responses):
+    mocker.patch.object(worker, "categorize_prioritize_ticket", side_effect=Exception("429"))
+
+    with pytest.raises(Exception):
+        asyncio.run(worker.process_ticket(ticket_ids[0]))
+
+    with session_factory() as db:
+        assert db.get(Ticket, ticket_ids[0]).status == TicketStatus.SUBMITTED
+    assert '"status":"submitted"' in get_cached_ticket(ticket_ids[0]).body
+    enqueue_responses.assert_not_called()
+
+
+def test_process_ticket_dead_lettered(mocker, session_factory, ticket_ids,
+                                      finish_response_stream):
+    mocker.patch.object(worker.settings, "TICKET_MAX_ATTEMPTS", 1)
+    mocker.patch.object(worker, "categorize_prioritize_ticket", side_effect=Exception("429"))
+
+    with pytest.raises(Exception):
+        asyncio.run(worker.process_ticket(ticket_ids[0]))
+
+    with session_factory() as db:
+        assert db.get(Ticket, ticket_ids[0]).status == TicketStatus.FAILED
+    # readers of the response stream don't wait for a response that won't come
+    finish_response_stream.assert_called_once_with(
+        ticket_ids[0], error="Processing failed: Process failed: 429")
+
+
+def test_process_ticket_batch(mocker, session_factory, ticket_ids, classified, stats,
+                              enqueue_responses):
+    # the last ticket fails to be classified
+    mocker.patch.object(worker, "categorize_prioritize_tickets",
+                        return_value={ticket_id: classified for ticket_id in ticket_ids[:2]})
+    claim(session_factory)
+
+    asyncio.run(worker.process_ticket_batch(ticket_ids))
+
+    with session_factory() as db:
+        statuses = [db.get(Ticket, ticket_id).status for ticket_id in ticket_ids]
+    assert statuses == [TicketStatus.PROCESSING, TicketStatus.PROCESSING, TicketStatus.SUBMITTED]
+    assert set(enqueue_responses.call_args.args[0]) == \
+        {(ticket_id, TicketPriority.LOW) for ticket_id in ticket_ids[:2]}
+    assert stats.record_transition.call_args_list[-1].args == \
+        (TicketStatus.PROCESSING, TicketStatus.SUBMITTED, 1)
+
+
+def test_process_ticket_batch_enqueue_failed(mocker, session_factory, ticket_ids, classified,
+                                             enqueue_responses):
+    mocker.patch.object(worker, "categorize_prioritize_tickets",
+                        return_value={ticket_id: classified for ticket_id in ticket_ids})
+    enqueue_responses.side_effect = Exception("redis down")
+    claim(session_factory)
+
+    asyncio.run(worker.process_ticket_batch(ticket_ids))
+
+    with session_factory() as db:
+        assert {db.get(Ticket, ticket_id).status for ticket_id in ticket_ids} == \
+            {TicketStatus.SUBMITTED}
+
+
+@pytest.fixture
+def file_session_factory(mocker, tmp_path):
+    """Sessions of a sqlite file database, with the transactions of a real deployment."""
+    engine = create_engine(f"sqlite:///{tmp_path}/tickets.db",
+                           connect_args={"check_same_thread": False})
+    Base.metadata.create_all(bind=engine)
+    factory = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    mocker.patch.object(worker, "SessionLocal", factory)
+    mocker.patch.object(retry, "SessionLocal", factory)
+    ids = [uuid.uuid4() for _ in range(3)]
+    with factory() as db:
+        db.add_all([Ticket(id=ticket_id, subject="subject", body="body",
+                           customer_email="test@email.com") for ticket_id in ids])
+        db.commit()
+    yield factory, ids
+    engine.dispose()
+
+
+def test_process_ticket_batch_file_db(mocker, file_session_factory, classified,
+                                      enqueue_responses):
+    factory, ticket_ids = file_session_factory
+    mocker.patch.object(worker, "categorize_prioritize_tickets",
+                        return_value={ticket_id: classified for ticket_id in ticket_ids})
+    claim(factory)
+
+    asyncio.run(worker.process_ticket_batch(ticket_ids))
+
+    with factory() as db:
+        tickets = [db.get(Ticket, ticket_id) for ticket_id in ticket_ids]
+        assert {ticket.status for ticket in tickets} == {TicketStatus.PROCESSING}
+        assert {ticket.category for ticket in tickets} == {TicketCategory.FEATURE_REQUEST}
+    assert len(enqueue_responses.call_args.args[0]) == 3
+
+
+def test_process_ticket_batch_classify_failed(mocker, file_session_factory, enqueue_responses):
+    factory, ticket_ids = file_session_factory
+    mocker.patch.object(worker, "categorize_prioritize_tickets", side_effect=Exception("529"))
+    claim(factory)
+
+    with pytest.raises(Exception):
+        asyncio.run(worker.process_ticket_batch(ticket_ids))
+
+    # every ticket is reverted for a retry, none is left processing
+    with factory() as db:
+        tickets = [db.get(Ticket, ticket_id) for ticket_id in ticket_ids]
+        assert {ticket.status for ticket in tickets} == {TicketStatus.SUBMITTED}
+        assert {ticket.last_error for ticket in tickets} == {"Classify failed: 529"}
+        assert {ticket.attempts for ticket in tickets} == {1}
+    enqueue_responses.assert_not_called()
+
+
+def test_process_ticket_batch_skips_classified(mocker, session_factory, ticket_ids, classified,
+                                               stats, enqueue_responses):
+    categorize = mocker.patch.object(worker, "categorize_prioritize_tickets",
+                                     return_value={ticket_ids[0]: classified})
+    claim(session_factory)
+    asyncio.run(worker.process_ticket_batch(ticket_ids[:1]))
+    enqueue_responses.reset_mock()
+
+    # another batch of the first ticket, e.g. enqueued again after its lease expired
+    categorize.return_value = {ticket_id: classified for ticket_id in ticket_ids[1:]}
+    asyncio.run(worker.process_ticket_batch(ticket_ids))
+
+    assert {ticket.id for ticket in categorize.call_args.args[0]} == set(ticket_ids[1:])
+    assert {ticket_id for ticket_id, _ in enqueue_responses.call_args.args[0]} == \
+        set(ticket_ids[1:])
+    # a batch of tickets classified already does nothing
+    asyncio.run(worker.process_ticket_batch(ticket_ids))
+    assert categorize.call_count == 2
+    assert enqueue_responses.call_count == 1
+    stats.record_transition.assert_not_called()
+
+
+def test_respond_ticket(mocker, session_factory, ticket_ids, classified, stats,
+                        finish_response_stream, reset_response_stream):
+    mocker.patch.object(worker, "categorize_prioritize_ticket", return_value=classified)
+
+    mocker.patch.object(worker, "craft_ticket_response", return_value="Thanks!")
+    # tokens charged to the ticket by the llm calls
+    mocker.patch.object(worker, "take_ticket_tokens", return_value=(60, 15))
+    asyncio.run(worker.process_ticket(ticket_ids[0]))
+
+    asyncio.run(worker.respond_ticket(ticket_ids[0]))
+    # processed tickets are skipped
+    asyncio.run(worker.respond_ticket(ticket_ids[0]))
+
+    with session_factory() as db:
+        ticket = db.get(Ticket, ticket_ids[0])
+        assert ticket.status == TicketStatus.PROCESSED
+        assert ticket.initial_response == "Thanks!"
+        assert ticket.processed_at is not None
+        assert (ticket.input_tokens, ticket.output_tokens) == (120, 30)
+    assert '"status":"processed"' in get_cached_ticket(ticket_ids[0]).body
+    assert worker.craft_ticket_response.call_count == 1
+    stats.record_processed.assert_called_once()
+    finish_response_stream.assert_called_once_with(ticket_ids[0], "Thanks!")
+    reset_response_stream.assert_called_once_with(ticket_ids[0])
+
+
+def test_respond_ticket_failed(mocker, session_factory, ticket_ids, classified,
+                               finish_response_stream):
+    mocker.patch.object(worker, "categorize_prioritize_ticket", return_value=classified)
+    mocker.patch.object(worker, "craft_ticket_response", side_effect=Exception("500"))
+    asyncio.run(worker.process_ticket(ticket_ids[0]))
+
+    with pytest.raises(Exception):
+        asyncio.run(worker.respond_ticket(ticket_ids[0]))
+
+    with session_factory() as db:
+        ticket = db.get(Ticket, ticket_ids[0])
+        assert ticket.status == TicketStatus.SUBMITTED
+        assert ticket.priority == TicketPriority.LOW
+    assert "error" in finish_response_stream.call_args.kwargs
+
+
+def test_respond_ticket_retried(mocker, session_factory, ticket_ids, classified,
+                                enqueue_responses):
+    categorize = mocker.patch.object(worker, "categorize_prioritize_ticket",
+                                     return_value=classified)
+    mocker.patch.object(worker, "craft_ticket_response", side_effect=[Exception("500"), "Hi!"])
+    asyncio.run(worker.process_ticket(ticket_ids[0]))
+    with pytest.raises(Exception):
+        asyncio.run(worker.respond_ticket(ticket_ids[0]))
+    with session_factory() as db:
+        db.get(Ticket, ticket_ids[0]).next_attempt_at = None
+        db.commit()
+
+    # the retry keeps the classification and only queues the response again
+    asyncio.run(worker.process_ticket(ticket_ids[0]))
+    categorize.assert_called_once()
+    assert enqueue_responses.call_args_list[-1].args[0] == [(ticket_ids[0], TicketPriority.LOW)]
+    asyncio.run(worker.respond_ticket(ticket_ids[0]))
+
+    with session_factory() as db:
+        ticket = db.get(Ticket, ticket_ids[0])
+        assert ticket.status == TicketStatus.PROCESSED
+        assert ticket.initial_response == "Hi!"
+        assert ticket.attempts == 2
+
+
+def test_async_worker_perform(mocker):
+    from src.core import async_worker
+    process = mocker.AsyncMock()
+    mocker.patch.dict(async_worker.ASYNC_JOBS, {"src.core.worker.process_ticket_job": process})
+    job = mocker.Mock(func_name="src.core.worker.process_ticket_job", args=("id",), kwargs={},
+                      timeout=None)
+    worker = async_worker.AsyncWorker(concurrency=1)
+    finish = mocker.patch.object(worker, "_finish")
+
+    asyncio.run(worker._perform(job))
+
+    process.assert_awaited_once_with("id")
+    finish.assert_called_once_with(job, None)
+
+
+def test_async_worker_perform_failed(mocker):
+    from src.core import async_worker
+    process = mocker.AsyncMock(side_effect=ValueError("529"))
+    mocker.patch.dict(async_worker.ASYNC_JOBS, {"src.core.worker.process_ticket_job": process})
+    job = mocker.Mock(func_name="src.core.worker.process_ticket_job", args=("id",), kwargs={},
+                      timeout=None)
+    worker = async_worker.AsyncWorker(concurrency=1)
+    finish = mocker.patch.object(worker, "_finish")
+
+    asyncio.run(worker._perform(job))
+
+    # the job goes to the failed job registry with its traceback
+    job_finished, exc_string = finish.call_args.args
+    assert job_finished is job
+    assert exc_string.startswith("Traceback") and "ValueError: 529" in exc_string
+
+
+def test_async_worker_perform_timeout(mocker):
+    from src.core import async_worker
+
+    async def process(ticket_id):
+        await asyncio.sleep(10)
+
+    mocker.patch.dict(async_worker.ASYNC_JOBS, {"src.core.worker.process_ticket_job": process})
+    job = mocker.Mock(func_name="src.core.worker.process_ticket_job", args=("id",), kwargs={},
+                      timeout=0.01)
+    worker = async_worker.AsyncWorker(concurrency=1)
+    finish = mocker.patch.object(worker, "_finish")
+
+    asyncio.run(worker._perform(job))
+
+    # the job is cancelled and fails like an rq job past its timeout
+    assert "TimeoutError" in finish.call_args.args[1]
+
+
+def test_process_ticket_off_event_loop(mocker, session_factory, ticket_ids, classified):
+    mocker.patch.object(worker, "categorize_prioritize_ticket", return_value=classified)
+    to_thread = mocker.spy(worker.asyncio, "to_thread")
+
+    asyncio.run(worker.process_ticket(ticket_ids[0]))
+
+    # db and redis calls run in threads
+    assert [call.args[0] for call in to_thread.call_args_list[:3]] == \
+        [worker._claim_ticket, worker._save_classified, worker.enqueue_responses]
+
+
+def test_weighted_round_robin():
+    from src.core.async_worker import WeightedRoundRobin
+    scheduler = WeightedRoundRobin({"high": 6, "default": 3, "low": 1, "off": 0})
+
+    assert scheduler.picks(10) == {"high": 6, "default": 3, "low": 1}
+    # shares hold over small pulls too, low gets its slot every 10 picks
+    picks = [scheduler.picks(1) for _ in range(20)]
+    assert sum(pick["low"] for pick in picks) == 2
+    assert sum(pick["high"] for pick in picks) == 12
+
+
+def test_async_worker_pop(mocker):
+    from src.core import async_worker
+    queued = {"rq:queue:high": [b"h1", b"h2", b"h3"], "rq:queue:low": [b"l1", b"l2"]}
+
+    async def lpop(key, count):
+        job_ids, queued[key] = queued[key][:count], queued[key][count:]
+        return job_ids or None
+
+    async def lpop_many(counts):
+        return [job_id for key, count in counts.items() if count
+                for job_id in await lpop(key, count) or []]
+
+    worker = async_worker.AsyncWorker(concurrency=4, weights={"high": 3, "low": 1})
+    mocker.patch.object(worker, "redis", mocker.Mock(lpop=lpop, blpop=mocker.AsyncMock()))
+    mocker.patch.object(worker, "_lpop", lpop_many)
+    worker.redis.blpop.return_value = None
+
+    assert asyncio.run(worker._pop(4)) == ["h1", "h2", "h3", "l1"]
+    # the empty high queue leaves its slots to low
+    assert asyncio.run(worker._pop(4)) == ["l2"]
+    assert asyncio.run(worker._pop(4)) == []
+    assert worker.redis.blpop.call_args.args[0] == ["rq:queue:high", "rq:queue:low"]
+
+
+def test_claim_and_process_tickets(mocker, session_factory, ticket_ids):
+    mocker.patch.object(worker.settings, "CLAIM_CHUNK_SIZE", 2)
+    process_tickets = mocker.patch.object(retry, "process_tickets")
+
+    assert worker.claim_and_process_tickets() == 3
+    # nothing left to claim on a second run
+    assert worker.claim_and_process_tickets() == 0
+
+    assert [len(call.args[0]) for call in process_tickets.call_args_list] == [2, 1]
+    with session_factory() as db:
+        assert {db.get(Ticket, ticket_id).status for ticket_id in ticket_ids} == \
+            {TicketStatus.PROCESSING}
+
+
+def test_claim_and_process_tickets_enqueue_failed(mocker, session_factory, ticket_ids):
+    mocker.patch.object(retry, "process_tickets", side_effect=Exception("redis down"))
+
+    with pytest.raises(Exception):
+        worker.claim_and_process_tickets()
+
+    with session_factory() as db:
+        tickets = [db.get(Ticket, ticket_id) for ticket_id in ticket_ids]
+        assert {ticket.status for ticket in tickets} == {TicketStatus.SUBMITTED}
+        # the released claim gives its attempt back
+        assert {ticket.attempts for ticket in tickets} == {0}
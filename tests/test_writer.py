@@ -0,0 +1,44 @@
+import asyncio
+import uuid
+from datetime import datetime
+
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+
+from src.models.database import Base
+from src.models.schemas import TicketStatus
+from src.models.ticket import Ticket
+from src.models.writer import GroupCommitWriter
+
+
+def row(**kwargs):
+    return dict(dict(id=uuid.uuid4(), subject="s", body="b", customer_email="a@b.com",
+                     status=TicketStatus.SUBMITTED, created_at=datetime.utcnow()), **kwargs)
+
+
+def test_group_commit(mocker, tmp_path):
+    async def run():
+        engine = create_async_engine(f"sqlite+aiosqlite:///{tmp_path}/tickets.db")
+        async with engine.begin() as conn:
+            await conn.run_sync(Base.metadata.create_all)
+        factory = async_sessionmaker(engine, expire_on_commit=False)
+        writer = GroupCommitWriter(factory, max_size=4, max_wait=0.01)
+        insert = mocker.spy(writer, "_insert")
+
+        duplicate = row()
+        results = await asyncio.gather(*[writer.save(row()) for _ in range(5)],
+                                       writer.save(duplicate), writer.save(duplicate),
+                                       return_exceptions=True)
+
+        async with factory() as db:
+            count = await db.scalar(select(func.count(Ticket.id)))
+        await engine.dispose()
+        return results, count, insert
+
+    results, count, insert = asyncio.run(run())
+
+    # a full batch of 4, then the second batch fails on the duplicated id and is retried one by one
+    assert [len(call.args[0]) for call in insert.call_args_list] == [4, 3, 1, 1, 1]
+    assert results[:6] == [None] * 6
+    assert isinstance(results[6], Exception)
+    assert count == 6